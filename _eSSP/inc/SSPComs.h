@@ -26,6 +26,51 @@ typedef struct {
 	unsigned char PacketData[255];
 } SSP_PACKET;
 
+#define SSP_RTT_BUCKETS 12
+
+/* link health of one command code, counted in place, nothing is allocated per command  */
+typedef struct {
+	unsigned long Commands;			/* commands sent, however many times their frame went out  */
+	unsigned long Replies;			/* commands answered  */
+	unsigned long Retries;			/* frames sent again for want of a reply  */
+	unsigned long Timeouts;			/* commands left unanswered after all retries  */
+	unsigned long CrcErrors;		/* reply frames or decrypted packets with a bad CRC  */
+	unsigned long CounterErrors;	/* encrypted replies with the wrong packet counter  */
+	unsigned long PortErrors;
+	unsigned long long BytesOut;	/* on the wire, stuffing included  */
+	unsigned long long BytesIn;
+	unsigned long long RttTotal;	/* us from sending the answered frame to its reply  */
+	unsigned long RttMax;
+	unsigned long RttBuckets[SSP_RTT_BUCKETS];	/* replies by round trip, bounds in SSPRttBounds  */
+} SSP_COMMAND_METRICS;
+
+typedef struct {
+	SSP_COMMAND_METRICS Command[256];	/* by command code  */
+} SSP_METRICS;
+
+/* upper bounds in us of all but the last RttBuckets, the last one takes the rest  */
+extern const unsigned long SSPRttBounds[SSP_RTT_BUCKETS - 1];
+
+#define SSP_CAPTURE_TX 0
+#define SSP_CAPTURE_RX 1
+
+/* one plain frame: command data before encryption, reply data after decryption  */
+typedef struct {
+	unsigned long long Time;		/* us, CLOCK_MONOTONIC  */
+	unsigned char Direction;		/* SSP_CAPTURE_TX or SSP_CAPTURE_RX  */
+	unsigned char Address;			/* address and seq bit  */
+	unsigned char Status;			/* PORT_STATUS of a reply, SSP_REPLY_OK for commands  */
+	unsigned char Length;
+	unsigned char Data[255];
+} SSP_CAPTURE_RECORD;
+
+/* ring of the last Size frames, allocated once  */
+typedef struct {
+	unsigned long Size;
+	unsigned long long Written;		/* frames ever captured, the next one goes to Written % Size  */
+	SSP_CAPTURE_RECORD* Records;
+} SSP_CAPTURE;
+
 typedef struct {
 	SSP_FULL_KEY Key;
 	unsigned long BaudRate;
@@ -40,6 +85,15 @@ typedef struct {
 	unsigned char ResponseDataLength;
 	unsigned char ResponseData[255];
 	unsigned char IgnoreError;
+	unsigned long TxTime;			/* us spent handing the last frame to the port  */
+	unsigned long TxFrames;			/* frames sent, retries included  */
+	unsigned long long TxTimeTotal;	/* us spent handing all of them to the port  */
+	/* per connection state, used by the *Port* calls instead of the process wide tables  */
+	SSP_PORT Port;
+	unsigned char Sequence;			/* seq bit of the next packet  */
+	unsigned int EncPktCount;		/* encrypted packet counter  */
+	SSP_METRICS* Metrics;			/* counted into when not NULL  */
+	SSP_CAPTURE* Capture;			/* frames are recorded into when not NULL  */
 } SSP_COMMAND;
 
 typedef struct {
@@ -52,6 +106,7 @@ typedef struct {
 	unsigned char SSPAddress;
 	unsigned char NewResponse;
 	unsigned char CheckStuff;
+	unsigned char CrcErrors;
 } SSP_TX_RX_PACKET;
 
 typedef struct {
@@ -140,6 +195,22 @@ Notes:
 */
 int  SSPSendCommand(const SSP_PORT,SSP_COMMAND* cmd);
 
+/*
+Name: SSPSendPortCommand
+Inputs:
+    SSP_COMMAND The command structure to be used.
+Return:
+    1 on success
+    0 on failure
+Notes:
+    As SSPSendCommand, but the port, sequence bit and encryption counter are
+    cmd->Port, cmd->Sequence and cmd->EncPktCount instead of being shared by
+    everything in the process talking to the same address. Each unit then has
+    its own SSP_COMMAND and units can be driven from different threads at once.
+    Set Sequence to 0x80 and EncPktCount to 0 when the port is opened.
+*/
+int  SSPSendPortCommand(SSP_COMMAND* cmd);
+
 /*
 Name: OpenSSPPort
 Inputs:
@@ -150,6 +221,24 @@ Notes:
 */
 SSP_PORT OpenSSPPort(const char * port);
 
+/*
+Name: GetPortError
+Return:
+    Why the last OpenSSPPort of the calling thread failed, empty if it didn't
+*/
+const char * GetPortError(void);
+
+/*
+Name: GetPortReconnects
+Inputs:
+    SSP_PORT port: An open port
+Return:
+    How many times the connection dropped and was made again, 0 for a local tty
+Notes:
+    Counted from when the port was opened; a frame in flight when it happened is sent again
+*/
+unsigned long GetPortReconnects(const SSP_PORT port);
+
 /*
 Name: CloseSSPPort
 Inputs:
@@ -160,6 +249,35 @@ Notes:
 */
 void CloseSSPPort(const SSP_PORT port);
 
+/*
+Name: SetBaud
+Inputs:
+    SSP_PORT port: The port to change
+    unsigned long baud: 9600, 19200, 38400, 57600 or 115200
+Return:
+    1 on success
+    0 if the rate is not supported or can't be set
+Notes:
+    Only changes the host side, the unit has to be told with SSP_CMD_SET_BAUD_RATE
+*/
+int SetBaud(const SSP_PORT port, const unsigned long baud);
+
+/*
+Name: CanSetBaud
+Inputs:
+    SSP_PORT port: The port to ask
+    unsigned long baud: The rate SetBaud would be given
+Return:
+    1 if SetBaud would take the rate on this port
+    0 if not, e.g. over TCP, which only follows 9600
+Notes:
+    Changes nothing, for checking before the unit is told to switch
+*/
+int CanSetBaud(const SSP_PORT port, const unsigned long baud);
+
+/* Called after every block of a DownloadFileToPort: block number, number of blocks, bytes sent, blocks sent again */
+typedef void (*SSP_DOWNLOAD_PROGRESS)(unsigned long block, unsigned long blocks, unsigned long bytes, unsigned long retries);
+
 /*
 Name: DownloadFileToTarget
 Inputs:
@@ -221,6 +339,24 @@ Notes:
 */
 int DownloadDataToTarget(const unsigned char* data, const unsigned long dlength, const char * cPort, const unsigned char sspAddress,const unsigned long long key);
 
+/*
+Name:   DownloadFileToPort
+Inputs:
+    SSP_COMMAND * sspC: The open session with the unit, encrypted or not
+    char * file: The full path of the file to download, mapped rather than read
+    char * port: The name of the port of the session, opened again when the unit restarts into its loader
+    unsigned char blockRetries: How many times a block the unit got wrong is sent again
+    SSP_DOWNLOAD_PROGRESS progress: Called after each block, or NULL
+Return:
+    DOWNLOAD_COMPLETE (0x100000), DOWNLOAD_IN_PROGRESS (0x100007) when another download is
+    running, or one of the failures of DownloadFileToTarget
+Notes:
+    Runs in the calling thread, the session must not be used by another meanwhile.
+    The transfer goes at the rate the file asks for; sspC->Port is the reopened port
+    afterwards and the unit restarts with the new file, it has to be synced again.
+*/
+unsigned long DownloadFileToPort(SSP_COMMAND * sspC, const char * file, const char * port, const unsigned char blockRetries, SSP_DOWNLOAD_PROGRESS progress);
+
 /*
 Name:   GetDownloadStatus
 Inputs:
@@ -260,6 +396,19 @@ Notes:
 */
 int NegotiateSSPEncryption(SSP_PORT port, const char ssp_address, SSP_FULL_KEY * key);
 
+/*
+Name: NegotiateSSPPortEncryption
+Inputs:
+    SSP_COMMAND * cmd: The connection to negotiate on, see SSPSendPortCommand
+    SSP_FULL_KEY * key: The ssp encryption key to be used
+Return:
+    1 on success
+    0 on failure
+Notes:
+    As NegotiateSSPEncryption, using and resetting the state kept in cmd
+*/
+int NegotiateSSPPortEncryption(SSP_COMMAND * cmd, SSP_FULL_KEY * key);
+
 //SSP functions
 /*
 The following functions all have an argument of type SSP_COMMAND_SETUP. This contains the information needed to send the command.
@@ -44,6 +44,7 @@
 #define SSP_CMD_ENABLE_PAYOUT_DEVICE 0x5C
 #define SSP_CMD_DISABLE_PAYOUT_DEVICE 0x5B
 #define SSP_CMD_CONFIGURE_BEZEL 0x54
+#define SSP_CMD_SET_BAUD_RATE 0x4D
 
 //generic SSP Responses
 typedef enum
@@ -132,6 +133,7 @@ SSP_RESPONSE_TIMEOUT = 0xFF,
 #define PORT_OPEN_FAIL					0x100004
 #define SYNC_CONNECTION_FAIL			0x100005
 #define	SECURITY_PROTECTED_FILE			0x100006
+#define DOWNLOAD_IN_PROGRESS			0x100007
 
 #define DATA_TRANSFER_FAIL				0x100010
 #define PROG_COMMAND_FAIL				0x100011
@@ -6,7 +6,7 @@
 
 SSP_COMMAND *ssp_init(char *port_c, char *addr_c, int debug)
 {
-    SSP_COMMAND* sspC = malloc(sizeof(SSP_COMMAND));
+    SSP_COMMAND* sspC = calloc(1, sizeof(SSP_COMMAND));
     
     sspC->SSPAddress = (int)(strtod(addr_c, NULL));
     // Linux does not need to do any initialisation for the SSP library
@@ -15,6 +15,7 @@ SSP_COMMAND *ssp_init(char *port_c, char *addr_c, int debug)
     sspC->RetryLevel = 3;
     sspC->BaudRate = 9600;
     sspC->Key.EncryptKey = 1;   // Just to make sure 
+    sspC->Metrics = calloc(1, sizeof(SSP_METRICS));
     //Open the COM port
     if ( debug == 1 ){ 
 	    printf("PORT: %s\n", port_c); // Printing the connection informations
@@ -22,21 +23,97 @@ SSP_COMMAND *ssp_init(char *port_c, char *addr_c, int debug)
 	    printf ("##%s##\n", port_c);
     }
 
-    if (open_ssp_port(port_c) == 0)
+    if (open_ssp_port(sspC, port_c) == 0)
     {
 	printf("Port Error\n");
+	free(sspC->Metrics);
+	free(sspC);
 	return NULL;
     }
      
 
     //run_validator(&sspC);
     // close the com port
-    //close_ssp_port();
+    //close_ssp_port(sspC);
     
     return sspC;
 }
 
+/* Another address on the port of `bus`, sharing its file descriptor and rate; closing it is the owner's business  */
+SSP_COMMAND *ssp_init_shared(SSP_COMMAND *bus, char *addr_c)
+{
+    SSP_COMMAND* sspC = calloc(1, sizeof(SSP_COMMAND));
+
+    sspC->SSPAddress = (int)(strtod(addr_c, NULL));
+    sspC->Timeout = bus->Timeout;
+    sspC->EncryptionStatus = NO_ENCRYPTION;
+    sspC->RetryLevel = bus->RetryLevel;
+    sspC->Key.EncryptKey = 1;
+    sspC->Metrics = calloc(1, sizeof(SSP_METRICS));
+    sspC->Port = bus->Port;
+    reset_ssp_session(sspC);
+    sspC->BaudRate = bus->BaudRate;
+    return sspC;
+}
+
 unsigned char* ssp_get_response_data(SSP_COMMAND* sspc)
 {
     return sspc->ResponseData;
 }
+
+/* Start recording the last size frames of the connection, once; 0 if there is no memory for them  */
+int ssp_capture_start(SSP_COMMAND* sspc, unsigned long size)
+{
+    SSP_CAPTURE* capture;
+
+    if (sspc->Capture)
+        return 1;
+    capture = calloc(1, sizeof(SSP_CAPTURE));
+    if (capture == NULL || size == 0)
+    {
+        free(capture);
+        return 0;
+    }
+    capture->Records = calloc(size, sizeof(SSP_CAPTURE_RECORD));
+    if (capture->Records == NULL)
+    {
+        free(capture);
+        return 0;
+    }
+    capture->Size = size;
+    sspc->Capture = capture;
+    return 1;
+}
+
+SSP_CAPTURE* ssp_get_capture(SSP_COMMAND* sspc)
+{
+    return sspc->Capture;
+}
+
+SSP_METRICS* ssp_get_metrics(SSP_COMMAND* sspc)
+{
+    return sspc->Metrics;
+}
+
+void ssp_get_tx_stats(SSP_COMMAND* sspc, unsigned long* frames, unsigned long* last, unsigned long long* total)
+{
+    *frames = sspc->TxFrames;
+    *last = sspc->TxTime;
+    *total = sspc->TxTimeTotal;
+}
+
+/* Ordered access to the counters of the worker's shared memory, see eSSP/worker.py  */
+unsigned long long ssp_load_acquire(unsigned long long* counter)
+{
+    return __atomic_load_n(counter, __ATOMIC_ACQUIRE);
+}
+
+void ssp_store_release(unsigned long long* counter, unsigned long long value)
+{
+    __atomic_store_n(counter, value, __ATOMIC_RELEASE);
+}
+
+void ssp_fence(void)
+{
+    __atomic_thread_fence(__ATOMIC_SEQ_CST);
+}
@@ -16,8 +16,11 @@ extern unsigned char download_in_progress;
 #define VER_REV	 0	// not > 255
 
 
+/* sequence bits and packet counters of the SSPSendCommand API, by ssp address  */
 unsigned int encPktCount[MAX_SSP_PORT];
 unsigned char sspSeq[MAX_SSP_PORT];
+
+static int _negotiate_encryption(SSP_PORT port, const char ssp_address, SSP_FULL_KEY * key, unsigned char* seq, unsigned int* encCount, SSP_COMMAND* owner);
 /*
 extern int PortStatus,PortStatus2,PortStatusUSB,PortStatusCCT;
 extern HANDLE hDevice,hDevice2,hDeviceUSB,hDeviceCCT;
@@ -52,7 +55,7 @@ int GetProcDLLVersion(unsigned char* ver)
 
 
 /*    DLL function call to generate host intermediate numbers to send to slave  */
-int InitiateSSPHostKeys(SSP_KEYS *  keyArray, const unsigned char ssp_address)
+int InitiateSSPHostKeys(SSP_KEYS *  keyArray, unsigned int* encCount)
 {
 
 
@@ -75,7 +78,7 @@ int InitiateSSPHostKeys(SSP_KEYS *  keyArray, const unsigned char ssp_address)
 
 
 	/* reset the apcket counter here for a successful key neg  */
-	encPktCount[ssp_address] = 0;
+	*encCount = 0;
 
 	return 1;
 }
@@ -93,7 +96,7 @@ int CreateSSPHostEncryptionKey(SSP_KEYS* keyArray)
 }
 
 
- int EncryptSSPPacket(unsigned char ptNum,unsigned char* dataIn, unsigned char* dataOut, unsigned char* lengthIn,unsigned char* lengthOut, unsigned long long* key)
+ int EncryptSSPPacket(unsigned int* encCount,unsigned char* dataIn, unsigned char* dataOut, unsigned char* lengthIn,unsigned char* lengthOut, unsigned long long* key)
 {
 	#define FIXED_PACKET_LENGTH   7
 	unsigned char pkLength,i,packLength = 0;
@@ -113,7 +116,7 @@ int CreateSSPHostEncryptionKey(SSP_KEYS* keyArray)
 
 	/* add in the encrypted packet count   */
 	for(i = 0; i < 4; i++)
-		tmpData[1 + i] = (unsigned char)((encPktCount[ptNum] >> (8*i) & 0xFF));
+		tmpData[1 + i] = (unsigned char)((*encCount >> (8*i) & 0xFF));
 
 
 	for(i = 0; i < *lengthIn; i++)
@@ -137,7 +140,7 @@ int CreateSSPHostEncryptionKey(SSP_KEYS* keyArray)
 	*lengthOut = pkLength;
 	dataOut[0] = SSP_STEX;
 
-	encPktCount[ptNum]++;  /* incremnet the counter after a successful encrypted packet   */
+	(*encCount)++;  /* incremnet the counter after a successful encrypted packet   */
 
 	return 1;
 }
@@ -208,22 +211,35 @@ Notes:
     Only the EncryptKey iin SSP_FULL_KEY will be set. The FixedKey needs to be set by the user
 */
 int NegotiateSSPEncryption(SSP_PORT port, const char ssp_address, SSP_FULL_KEY * key)
+{
+    return _negotiate_encryption(port,ssp_address,key,&sspSeq[(unsigned char)ssp_address],&encPktCount[(unsigned char)ssp_address],NULL);
+}
+
+int NegotiateSSPPortEncryption(SSP_COMMAND * cmd, SSP_FULL_KEY * key)
+{
+    return _negotiate_encryption(cmd->Port,cmd->SSPAddress,key,&cmd->Sequence,&cmd->EncPktCount,cmd);
+}
+
+static int _negotiate_encryption(SSP_PORT port, const char ssp_address, SSP_FULL_KEY * key, unsigned char* seq, unsigned int* encCount, SSP_COMMAND* owner)
 {
     SSP_KEYS temp_keys;
     SSP_COMMAND sspc;
     unsigned char i;
     //setup the intial host keys
-    if (InitiateSSPHostKeys(&temp_keys,ssp_address) == 0)
+    if (InitiateSSPHostKeys(&temp_keys,encCount) == 0)
         return 0;
     sspc.EncryptionStatus = 0;
     sspc.RetryLevel = 2;
     sspc.Timeout = 1000;
     sspc.SSPAddress = ssp_address;
+    /* counted and captured with the commands of the connection it is for  */
+    sspc.Metrics = owner ? owner->Metrics : NULL;
+    sspc.Capture = owner ? owner->Capture : NULL;
 
     //make sure we can talk to the unit
     sspc.CommandDataLength = 1;
     sspc.CommandData[0] = SSP_CMD_SYNC;
-    SSPSendCommand(port,&sspc);
+    SSPSendCommandState(port,&sspc,seq,encCount);
     if (sspc.ResponseData[0] != SSP_RESPONSE_OK)
         return 0;
 
@@ -233,7 +249,7 @@ int NegotiateSSPEncryption(SSP_PORT port, const char ssp_address, SSP_FULL_KEY *
     for (i = 0; i < 8 ; ++i)
         sspc.CommandData[1+i] = (unsigned char)(temp_keys.Generator >> (i*8));
     //send the command
-    SSPSendCommand(port,&sspc);
+    SSPSendCommandState(port,&sspc,seq,encCount);
     if (sspc.ResponseData[0] != SSP_RESPONSE_OK)
         return 0;
 
@@ -243,7 +259,7 @@ int NegotiateSSPEncryption(SSP_PORT port, const char ssp_address, SSP_FULL_KEY *
     for (i = 0; i < 8 ; ++i)
         sspc.CommandData[1+i] = (unsigned char)(temp_keys.Modulus >> (i*8));
     //send the command
-    SSPSendCommand(port,&sspc);
+    SSPSendCommandState(port,&sspc,seq,encCount);
     if (sspc.ResponseData[0] != SSP_RESPONSE_OK)
         return 0;
 
@@ -253,7 +269,7 @@ int NegotiateSSPEncryption(SSP_PORT port, const char ssp_address, SSP_FULL_KEY *
     for (i = 0; i < 8 ; ++i)
         sspc.CommandData[1+i] = (unsigned char)(temp_keys.HostInter >> (i*8));
     //send the command
-    SSPSendCommand(port,&sspc);
+    SSPSendCommandState(port,&sspc,seq,encCount);
     if (sspc.ResponseData[0] != SSP_RESPONSE_OK)
         return 0;
 
@@ -64,6 +64,11 @@ typedef struct{
 	SSP_FULL_KEY Key;
     char  portname[255];
 	unsigned long baud;
+	unsigned long length;
+	unsigned char session;
+	unsigned char blockRetries;
+	unsigned long retries;
+	SSP_DOWNLOAD_PROGRESS progress;
 }ITL_FILE_DOWNLOAD;
 void  DownloadITLTarget(void * itl_file_pointer);
 int TestSplit(PAY* py,UINT32 valueToFind);
@@ -73,9 +78,11 @@ void __attribute__ ((destructor)) my_fini(void);
 
 //private
 clock_t GetClockMs();
+unsigned long long GetClockUs();
 void SSPDataIn(unsigned char RxChar, SSP_TX_RX_PACKET* ss);
-int EncryptSSPPacket(unsigned char ptNum,unsigned char* dataIn, unsigned char* dataOut, unsigned char* lengthIn,unsigned char* lengthOut, unsigned long long* key);
+int SSPSendCommandState(const SSP_PORT port, SSP_COMMAND* cmd, unsigned char* seq, unsigned int* encCount);
+int EncryptSSPPacket(unsigned int* encCount,unsigned char* dataIn, unsigned char* dataOut, unsigned char* lengthIn,unsigned char* lengthOut, unsigned long long* key);
 int DecryptSSPPacket(unsigned char* dataIn, unsigned char* dataOut, unsigned char* lengthIn,unsigned char* lengthOut, unsigned long long* key);
-int InitiateSSPHostKeys(SSP_KEYS*  keyArray,const unsigned char ssp_address);
+int InitiateSSPHostKeys(SSP_KEYS*  keyArray,unsigned int* encCount);
 int CreateHostInterKey(SSP_KEYS* keyArray);
 int CreateSSPHostEncryptionKey(SSP_KEYS* keyArray);
@@ -1,6 +1,7 @@
 
 #include <sys/time.h>
 #include <time.h>
+#include <string.h>
 #include "../inc/SSPComs.h"
 #include "../inc/ssp_defines.h"
 #include "Encryption.h"
@@ -10,7 +11,26 @@
 extern unsigned int encPktCount[MAX_SSP_PORT];
 extern unsigned char sspSeq[MAX_SSP_PORT];
 
-int CompileSSPCommand(SSP_COMMAND* cmd,SSP_TX_RX_PACKET* ss)
+const unsigned long SSPRttBounds[SSP_RTT_BUCKETS - 1] = {1000, 2000, 5000, 10000, 20000, 50000, 100000, 200000, 500000, 1000000, 2000000};
+
+static void CaptureFrame(SSP_CAPTURE* capture, const unsigned char direction, const unsigned char address, const unsigned char status, const unsigned char* data, const unsigned char length)
+{
+	SSP_CAPTURE_RECORD* record;
+
+	if(!capture)
+		return;
+	record = &capture->Records[capture->Written % capture->Size];
+	record->Time = GetClockUs();
+	record->Direction = direction;
+	record->Address = address;
+	record->Status = status;
+	record->Length = length;
+	memcpy(record->Data,data,length);
+	/* readers trust a record once Written has gone past it  */
+	__atomic_store_n(&capture->Written,capture->Written + 1,__ATOMIC_RELEASE);
+}
+
+int CompileSSPCommand(SSP_COMMAND* cmd,SSP_TX_RX_PACKET* ss,unsigned char* seq,unsigned int* encCount)
 {
 	int i,j;
 	unsigned short crc;
@@ -22,23 +42,24 @@ int CompileSSPCommand(SSP_COMMAND* cmd,SSP_TX_RX_PACKET* ss)
 
 	/* for sync commands reset the deq bit   */
 	if(cmd->CommandData[0] == SSP_CMD_SYNC)
-		sspSeq[cmd->SSPAddress] = 0x80;
+		*seq = 0x80;
 
 	/* is this a encrypted packet  */
 	if(cmd->EncryptionStatus){
-		if(!EncryptSSPPacket(cmd->SSPAddress ,cmd->CommandData,cmd->CommandData,&cmd->CommandDataLength,&cmd->CommandDataLength,(unsigned long long*)&cmd->Key))
+		if(!EncryptSSPPacket(encCount,cmd->CommandData,cmd->CommandData,&cmd->CommandDataLength,&cmd->CommandDataLength,(unsigned long long*)&cmd->Key))
 			return 0;
 	}
 
 	/* create the packet from this data   */
 	ss->CheckStuff = 0;
+	ss->CrcErrors = 0;
 	ss->SSPAddress = cmd->SSPAddress;
 	ss->rxPtr = 0;
 	ss->txPtr = 0;
 	ss->rxBufferLength = 3;
 	ss->txBufferLength = cmd->CommandDataLength + 5;  /* the full ssp packet length   */
 	ss->txData[0] = SSP_STX;					/* ssp packet start   */
-	ss->txData[1] = cmd->SSPAddress | sspSeq[cmd->SSPAddress];  /* the address/seq bit */
+	ss->txData[1] = cmd->SSPAddress | *seq;  /* the address/seq bit */
 	ss->txData[2] = cmd->CommandDataLength;    /* the data length only (always > 0)  */
 	for(i = 0; i < cmd->CommandDataLength; i++)  /* add the command data  */
 		ss->txData[3 + i] = cmd->CommandData[i];
@@ -78,18 +99,41 @@ Notes:
     ResponseStatus,ResponseData,ResponseDataLength will be altered by this function call.
 */
 int  SSPSendCommand(const SSP_PORT port, SSP_COMMAND* cmd)
+{
+    return SSPSendCommandState(port,cmd,&sspSeq[cmd->SSPAddress],&encPktCount[cmd->SSPAddress]);
+}
+
+int  SSPSendPortCommand(SSP_COMMAND* cmd)
+{
+    return SSPSendCommandState(cmd->Port,cmd,&cmd->Sequence,&cmd->EncPktCount);
+}
+
+/* SSPSendCommand with the sequence bit and encryption counter to use   */
+int  SSPSendCommandState(const SSP_PORT port, SSP_COMMAND* cmd, unsigned char* seq, unsigned int* encCount)
 {
     SSP_TX_RX_PACKET ssp;
 	clock_t txTime,currentTime,rxTime;
 	int i;
 	unsigned char encryptLength;
 	unsigned short crcR;
-	unsigned char buffer;
+	unsigned char rxBuffer[256];
+	int ready,n;
 	unsigned char tData[255];
 	unsigned char retry;
 	unsigned int slaveCount;
+	unsigned long long txStart;
+	unsigned long rtt;
+	SSP_COMMAND_METRICS* m = NULL;
+
+    /* the code is encrypted away by CompileSSPCommand   */
+    if(cmd->Metrics){
+        m = &cmd->Metrics->Command[cmd->CommandData[0]];
+        m->Commands++;
+    }
+    /* plain, before CompileSSPCommand encrypts it; a sync resets the seq bit   */
+    CaptureFrame(cmd->Capture,SSP_CAPTURE_TX,cmd->SSPAddress | (cmd->CommandData[0] == SSP_CMD_SYNC ? 0x80 : *seq),SSP_REPLY_OK,cmd->CommandData,cmd->CommandDataLength);
     /* complie the SSP packet and check for errors  */
-    if(!CompileSSPCommand(cmd,&ssp )){
+    if(!CompileSSPCommand(cmd,&ssp,seq,encCount)){
         cmd->ResponseStatus = SSP_PACKET_ERROR;
         return 0;
     }
@@ -98,32 +142,74 @@ int  SSPSendCommand(const SSP_PORT port, SSP_COMMAND* cmd)
     /* transmit the packet    */
     do{
         ssp.NewResponse = 0;  /* set flag to wait for a new reply from slave   */
+        if(m && retry != cmd->RetryLevel)
+            m->Retries++;
+        txStart = GetClockUs();
         if (WriteData(ssp.txData,ssp.txBufferLength,port) == 0)
         {
         //if(WritePort(&ssp) != TRUE){
             cmd->ResponseStatus = PORT_ERROR;
+            if(m)
+                m->PortErrors++;
+            CaptureFrame(cmd->Capture,SSP_CAPTURE_RX,cmd->SSPAddress,PORT_ERROR,0,0);
             return 0;
         }
+        if(m)
+            m->BytesOut += ssp.txBufferLength;
+        cmd->TxTime = (unsigned long)(GetClockUs() - txStart);
+        cmd->TxTimeTotal += cmd->TxTime;
+        cmd->TxFrames++;
 
-        /* wait for out reply   */
+        /* wait for out reply, sleeping in poll() until bytes arrive   */
         cmd->ResponseStatus = SSP_REPLY_OK;
         txTime = GetClockMs();
         while(!ssp.NewResponse){
             /* check for reply timeout   */
             currentTime = GetClockMs();
-            if(currentTime - txTime > cmd->Timeout){
+            if(currentTime - txTime >= cmd->Timeout){
                 cmd->ResponseStatus = SSP_CMD_TIMEOUT;
                 break;
             }
-            while (BytesInBuffer(port) > 0)
-            {
-                ReadData(port,&buffer,1);
-                SSPDataIn(buffer,&ssp);
+            ready = WaitForData(port,cmd->Timeout - (currentTime - txTime));
+            if (ready < 0){
+                cmd->ResponseStatus = PORT_ERROR;
+                if(m)
+                    m->PortErrors++;
+                CaptureFrame(cmd->Capture,SSP_CAPTURE_RX,cmd->SSPAddress,PORT_ERROR,0,0);
+                return 0;
+            }
+            if (ready == 0)
+                continue;
+            /* the reply went with the old connection, send again at once   */
+            if (ready == PORT_RECONNECTED){
+                cmd->ResponseStatus = SSP_CMD_TIMEOUT;
+                break;
             }
+            /* take whatever has arrived in one read and frame it   */
+            n = ReadData(port,rxBuffer,sizeof(rxBuffer));
+            for(i = 0; i < n && !ssp.NewResponse; i++)
+                SSPDataIn(rxBuffer[i],&ssp);
+            if(m && n > 0)
+                m->BytesIn += n;
+        }
+        if(m){
+            m->CrcErrors += ssp.CrcErrors;
+            ssp.CrcErrors = 0;
         }
 
-        if(cmd->ResponseStatus == SSP_REPLY_OK)
+        if(cmd->ResponseStatus == SSP_REPLY_OK){
+            if(m){
+                rtt = (unsigned long)(GetClockUs() - txStart);
+                m->Replies++;
+                m->RttTotal += rtt;
+                if(rtt > m->RttMax)
+                    m->RttMax = rtt;
+                for(i = 0; i < SSP_RTT_BUCKETS - 1 && rtt > SSPRttBounds[i]; i++)
+                    ;
+                m->RttBuckets[i]++;
+            }
             break;
+        }
 
         retry--;
     }while(retry > 0);
@@ -131,6 +217,9 @@ int  SSPSendCommand(const SSP_PORT port, SSP_COMMAND* cmd)
     rxTime = GetClockMs();
 
     if(cmd->ResponseStatus == SSP_CMD_TIMEOUT){
+            if(m)
+                m->Timeouts++;
+            CaptureFrame(cmd->Capture,SSP_CAPTURE_RX,cmd->SSPAddress,SSP_CMD_TIMEOUT,0,0);
             cmd->ResponseData[0] = SSP_RESPONSE_TIMEOUT;
             return 0;
     }
@@ -143,6 +232,9 @@ int  SSPSendCommand(const SSP_PORT port, SSP_COMMAND* cmd)
         crcR = cal_crc_loop_CCITT_A(encryptLength - 2,&ssp.rxData[4] ,CRC_SSP_SEED,CRC_SSP_POLY);
         if((unsigned char)(crcR & 0xFF) != ssp.rxData[ssp.rxData[2] + 1] || (unsigned char)((crcR >> 8) & 0xFF) != ssp.rxData[ssp.rxData[2] + 2]){
             cmd->ResponseStatus = SSP_PACKET_ERROR;
+            if(m)
+                m->CrcErrors++;
+            CaptureFrame(cmd->Capture,SSP_CAPTURE_RX,ssp.rxData[1],SSP_PACKET_ERROR,&ssp.rxData[4],encryptLength);
             return 0;
         }
         /* check the slave count against the host count  */
@@ -150,8 +242,11 @@ int  SSPSendCommand(const SSP_PORT port, SSP_COMMAND* cmd)
         for(i = 0; i < 4; i++)
             slaveCount += (unsigned int)(ssp.rxData[5 + i]) << (i*8);
         /* no match then we discard this packet and do not act on it's info  */
-        if(slaveCount != encPktCount[cmd->SSPAddress] ){
+        if(slaveCount != *encCount ){
             cmd->ResponseStatus = SSP_PACKET_ERROR;
+            if(m)
+                m->CounterErrors++;
+            CaptureFrame(cmd->Capture,SSP_CAPTURE_RX,ssp.rxData[1],SSP_PACKET_ERROR,&ssp.rxData[4],encryptLength);
             return 0;
         }
 
@@ -170,7 +265,7 @@ int  SSPSendCommand(const SSP_PORT port, SSP_COMMAND* cmd)
 
         /* for decrypted resonse with encrypted command, increment the counter here  */
     //	if(!cmd->EncryptionStatus)
-          //encPktCount[cmd->SSPAddress]++;
+          //(*encCount)++;
     }
 
     /*for(i = 0; i < ssp.rxBufferLength; i++)
@@ -181,28 +276,37 @@ int  SSPSendCommand(const SSP_PORT port, SSP_COMMAND* cmd)
         cmd->ResponseData[i] = ssp.rxData[i + 3];
 
     /* alternate the seq bit   */
-    if(sspSeq[cmd->SSPAddress] == 0x80)
-        sspSeq[cmd->SSPAddress] = 0;
+    if(*seq == 0x80)
+        *seq = 0;
     else
-        sspSeq[cmd->SSPAddress] = 0x80;
+        *seq = 0x80;
 
 
 	/* terminate the thread function   */
 	cmd->ResponseStatus = SSP_REPLY_OK;
+	CaptureFrame(cmd->Capture,SSP_CAPTURE_RX,ssp.rxData[1],SSP_REPLY_OK,cmd->ResponseData,cmd->ResponseDataLength);
 
 	return 1;
 }
 
 clock_t GetClockMs()
 {
+    /* monotonic, so a wall clock step can't fire or stretch a timeout   */
     clock_t test;
-    struct timeval tv;
-    gettimeofday(&tv, 0);
-    test = tv.tv_sec * 1000;
-    test += (tv.tv_usec)/1000;
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    test = ts.tv_sec * 1000;
+    test += ts.tv_nsec / 1000000;
     return test;
 }
 
+unsigned long long GetClockUs()
+{
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return (unsigned long long)ts.tv_sec * 1000000 + ts.tv_nsec / 1000;
+}
+
 void SSPDataIn(unsigned char RxChar, SSP_TX_RX_PACKET* ss)
 {
 	unsigned short crc;
@@ -243,6 +347,8 @@ void SSPDataIn(unsigned char RxChar, SSP_TX_RX_PACKET* ss)
 				crc = cal_crc_loop_CCITT_A(ss->rxBufferLength - 3,&ss->rxData[1] ,CRC_SSP_SEED,CRC_SSP_POLY);
 				if ((unsigned char)(crc & 0xFF) == ss->rxData[ss->rxBufferLength - 2] && (unsigned char)((crc >> 8) & 0xFF) == ss->rxData[ss->rxBufferLength - 1])
 					ss->NewResponse = 1;  /* we have a new response so set flag  */
+				else
+					ss->CrcErrors++;
 			}
 			// reset packet
 			ss->rxPtr  = 0;
@@ -4,6 +4,9 @@
 #include <stdio.h>
 #include <string.h>
 #include <unistd.h>
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
 
 
 #include "Random.h"
@@ -14,6 +17,37 @@
 #include <pthread.h>
 unsigned char download_in_progress;
 unsigned long download_block;
+
+/* Block count from the header of an ITL file, 0 if it is not one */
+static unsigned long _read_itl_header(ITL_FILE_DOWNLOAD * itlFile)
+{
+    int i;
+    unsigned long numCurBytes;
+    unsigned short dBlockSize;
+
+    if (itlFile->length < 128 || itlFile->fData[0] != 'I' || itlFile->fData[1] != 'T' || itlFile->fData[2] != 'L')
+        return 0;
+    numCurBytes = 0;
+    for(i = 0; i <4; i++){
+        numCurBytes += (unsigned long)itlFile->fData[17 + i] << (8*(3-i));
+    }
+    //get the block size from header
+    dBlockSize = (256*(unsigned short)itlFile->fData[0x3e]) + (unsigned short)itlFile->fData[0x3f];
+    // correct for NV9 type
+    if(dBlockSize == 0) dBlockSize = 4096;
+
+    itlFile->NumberOfBlocks = numCurBytes / dBlockSize;
+    if(numCurBytes % dBlockSize != 0) itlFile->NumberOfBlocks += 1;
+    return itlFile->NumberOfBlocks;
+}
+
+/* SSP commands go through the session of DownloadFileToPort, or the per address state otherwise */
+static int _send_ssp(ITL_FILE_DOWNLOAD * itlFile, SSP_COMMAND * sspC)
+{
+    if (itlFile->session)
+        return SSPSendPortCommand(sspC);
+    return SSPSendCommand(itlFile->port,sspC);
+}
 /*
 Name:   DownloadDataToTarget
 Inputs:
@@ -45,16 +79,14 @@ Notes:
 int  DownloadDataToTarget(const unsigned char* data, const unsigned long dlength, const char * cPort, const unsigned char sspAddress, const unsigned long long key)
 {
 
-	int i;
-	unsigned long numCurBytes;
-	unsigned short dBlockSize;
     ITL_FILE_DOWNLOAD * itlFile;
     SSP_COMMAND sspC;
     SSP_PORT port;
     if (download_in_progress == 1)
         return PORT_OPEN_FAIL;
-    itlFile = malloc(sizeof(ITL_FILE_DOWNLOAD));
+    itlFile = calloc(1, sizeof(ITL_FILE_DOWNLOAD));
     itlFile->fData = malloc(dlength);
+    itlFile->length = dlength;
     memcpy(itlFile->fData,data,dlength);
 
 	/*ramStatus.currentRamBlocks = 0;
@@ -64,21 +96,7 @@ int  DownloadDataToTarget(const unsigned char* data, const unsigned long dlength
 
     download_block = 0;
 	// check for ITL BV/SH type file
-    if (itlFile->fData[0] == 'I' && itlFile->fData[1] == 'T' && itlFile->fData[2] == 'L') {
-
-		 numCurBytes = 0;
-		 for(i = 0; i <4; i++){
-			numCurBytes += (unsigned long)itlFile->fData[17 + i] << (8*(3-i));
-		 }
-		  //get the block size from header
-		 dBlockSize = (256*(unsigned short)itlFile->fData[0x3e]) + (unsigned short)itlFile->fData[0x3f];
-		// correct for NV9 type
-		 if(dBlockSize == 0) dBlockSize = 4096;
-
-		  itlFile->NumberOfBlocks = numCurBytes / dBlockSize;
-		  if(numCurBytes % dBlockSize != 0) itlFile->NumberOfBlocks += 1;
-	}
-	else{
+    if (_read_itl_header(itlFile) == 0) {
 		free(itlFile->fData);
 		free(itlFile);
 		return NOT_ITL_FILE;
@@ -88,6 +106,8 @@ int  DownloadDataToTarget(const unsigned char* data, const unsigned long dlength
 	sspC.Timeout = 1000;
 	sspC.BaudRate = 9600;
 	sspC.RetryLevel = 2;
+	sspC.Metrics = NULL;
+	sspC.Capture = NULL;
 	sspC.SSPAddress = sspAddress;
 	itlFile->SSPAddress = sspAddress;
 	port = OpenSSPPort(cPort);
@@ -189,14 +209,9 @@ int DownloadFileToTarget(const char * file, const char * port, const unsigned ch
 unsigned short _read_single_byte_reply(ITL_FILE_DOWNLOAD * itlFile, const unsigned long timeout)
 {
     unsigned char buffer;
-    clock_t start = GetClockMs();
 
-    while(BytesInBuffer(itlFile->port) == 0)
-    {
-        usleep(1000);
-        if (GetClockMs()-start > timeout)
-            return -1;
-    }
+    if (WaitForData(itlFile->port,timeout) <= 0)
+        return -1;
     ReadData(itlFile->port,&buffer,1);
     return buffer;
 }
@@ -229,20 +244,22 @@ unsigned long _download_ram_file(ITL_FILE_DOWNLOAD * itlFile, SSP_COMMAND * sspC
 	sspC->CommandData[0] = SSP_CMD_PROGRAM;
 	sspC->CommandData[1] = SSP_PROGRAM_RAM;
 
-	if (SSPSendCommand(itlFile->port,sspC) == 0)
+	if (_send_ssp(itlFile,sspC) == 0)
         return PROG_COMMAND_FAIL;
     if (sspC->ResponseData[0] != SSP_RESPONSE_OK)
         return PROG_COMMAND_FAIL;
 
     //calculate block size
     itlFile->dwnlBlockSize = ((unsigned short)sspC->ResponseData[1]) + (((unsigned short)sspC->ResponseData[2])<<8);
+    if (itlFile->dwnlBlockSize == 0 || 128 + itlFile->NumberOfRamBytes > itlFile->length)
+        return DATA_TRANSFER_FAIL;
 
     sspC->EncryptionStatus = 0;
     sspC->CommandDataLength = 128;
     for (i = 0; i < 128; ++i)
         sspC->CommandData[i] = itlFile->fData[i];
 
-    SSPSendCommand(itlFile->port,sspC);
+    _send_ssp(itlFile,sspC);
     if (sspC->ResponseData[ 0] == SSP_RESPONSE_HEADER_FAILURE)
         return HEADER_FAIL;
     else if (sspC->ResponseData[0] != SSP_RESPONSE_OK)
@@ -265,8 +282,7 @@ unsigned long _download_ram_file(ITL_FILE_DOWNLOAD * itlFile, SSP_COMMAND * sspC
 
     for (i = 0; i < numRamBlocks; i++){
 		WriteData(&itlFile->fData[128+(i*RAM_DWNL_BLOCK_SIZE)],RAM_DWNL_BLOCK_SIZE,itlFile->port);
-		while (TransmitComplete(itlFile->port) == 0)
-                    usleep(1000);
+		DrainData(itlFile->port);
 
 		//ramStatus.currentRamBlocks = i;
 	}
@@ -286,12 +302,20 @@ unsigned long _download_ram_file(ITL_FILE_DOWNLOAD * itlFile, SSP_COMMAND * sspC
 unsigned long _download_main_file(ITL_FILE_DOWNLOAD * itlFile)
 {
     unsigned char chk;
+    unsigned char stale;
+    unsigned short reply;
     unsigned long cur_block;
     unsigned long i;
     unsigned long block_offset;
+    unsigned long sent;
+    unsigned long result = DOWNLOAD_COMPLETE;
+    const unsigned char * block;
+    unsigned char * pad = NULL;
     CloseSSPPort(itlFile->port);
     sleep(2);
-    OpenSSPPort(itlFile->portname);
+    itlFile->port = OpenSSPPort(itlFile->portname);
+    if (itlFile->port == -1)
+        return PORT_OPEN_FAIL;
     SetBaud(itlFile->port,itlFile->baud);
     //ensure buffer clear after restart
     if (_send_download_command(&itlFile->fData[6],1,ram_OK_ACK,itlFile) == 0)
@@ -303,27 +327,56 @@ unsigned long _download_main_file(ITL_FILE_DOWNLOAD * itlFile)
     for (cur_block = 1; cur_block <= itlFile->NumberOfBlocks; ++cur_block)
     {
         block_offset = 128 + ((cur_block-1)*itlFile->dwnlBlockSize) + itlFile->NumberOfRamBytes;
+        block = &itlFile->fData[block_offset];
+        if (block_offset + itlFile->dwnlBlockSize > itlFile->length)
+        {
+            // The last block is short, it goes out padded with zeros
+            if (block_offset >= itlFile->length)
+            {
+                result = READ_FILE_ERROR;
+                break;
+            }
+            if (pad == NULL)
+                pad = calloc(1,itlFile->dwnlBlockSize);
+            memcpy(pad,block,itlFile->length - block_offset);
+            block = pad;
+        }
         chk = 0;
         for(i = 0; i < itlFile->dwnlBlockSize; ++i)
-            chk ^= itlFile->fData[block_offset + i];
-        /*
-        for(i = 0; i < itlFile->dwnlBlockSize/128; ++i)
+            chk ^= block[i];
+        // The loader answers with the checksum of what it got: another one means the block
+        // was not taken and can be sent again, no answer means the link is gone
+        for (i = 0; ; ++i)
         {
-            WriteData(&itlFile->fData[block_offset + (i*128)],128,itlFile->port);
-            while (TransmitComplete(itlFile->port) == 0)
-                    //usleep(1000);
-                    sleep(0);
-
-        }*/
-        WriteData(&itlFile->fData[block_offset ],itlFile->dwnlBlockSize,itlFile->port);
-        while (TransmitComplete(itlFile->port) == 0)
-            usleep(1000);
-        if (_send_download_command(&chk,1,chk,itlFile) ==0)
-            return DATA_TRANSFER_FAIL;
+            WriteData(block,itlFile->dwnlBlockSize,itlFile->port);
+            DrainData(itlFile->port);
+            while(BytesInBuffer(itlFile->port) > 0)
+                ReadData(itlFile->port,&stale,1);
+            WriteData(&chk,1,itlFile->port);
+            reply = _read_single_byte_reply(itlFile,500);
+            if (reply == chk)
+                break;
+            if (reply > 0xFF || i >= itlFile->blockRetries)
+            {
+                result = DATA_TRANSFER_FAIL;
+                break;
+            }
+            itlFile->retries++;
+        }
+        if (result != DOWNLOAD_COMPLETE)
+            break;
 
         download_block = cur_block;
+        if (itlFile->progress != NULL)
+        {
+            sent = cur_block * itlFile->dwnlBlockSize;
+            if (sent > itlFile->length - 128 - itlFile->NumberOfRamBytes)
+                sent = itlFile->length - 128 - itlFile->NumberOfRamBytes;
+            itlFile->progress(cur_block,itlFile->NumberOfBlocks,sent,itlFile->retries);
+        }
     }
-    return DOWNLOAD_COMPLETE;
+    free(pad);
+    return result;
 
 }
 
@@ -341,6 +394,8 @@ void  DownloadITLTarget(void * itl_file_pointer)
     sspC.Timeout = 1000;
 	sspC.BaudRate = 9600;
 	sspC.RetryLevel = 2;
+	sspC.Metrics = NULL;
+	sspC.Capture = NULL;
 	sspC.SSPAddress = itlFile->SSPAddress;
 	sspC.EncryptionStatus = 0;
 
@@ -372,3 +427,62 @@ unsigned long GetDownloadStatus()
 {
     return download_block;
 }
+
+unsigned long DownloadFileToPort(SSP_COMMAND * sspC, const char * file, const char * port, const unsigned char blockRetries, SSP_DOWNLOAD_PROGRESS progress)
+{
+    ITL_FILE_DOWNLOAD itlFile;
+    struct stat st;
+    unsigned char * data;
+    unsigned long return_value;
+    unsigned int i;
+    int f;
+
+    f = open(file,O_RDONLY);
+    if (f < 0)
+        return OPEN_FILE_ERROR;
+    if (fstat(f,&st) < 0 || st.st_size == 0)
+    {
+        close(f);
+        return READ_FILE_ERROR;
+    }
+    // Pages come in as the blocks go out, the file is never read whole
+    data = mmap(NULL,st.st_size,PROT_READ,MAP_PRIVATE,f,0);
+    close(f);
+    if (data == MAP_FAILED)
+        return READ_FILE_ERROR;
+    madvise(data,st.st_size,MADV_SEQUENTIAL);
+
+    memset(&itlFile,0,sizeof(itlFile));
+    itlFile.fData = data;
+    itlFile.length = st.st_size;
+    if (_read_itl_header(&itlFile) == 0)
+    {
+        munmap(data,st.st_size);
+        return NOT_ITL_FILE;
+    }
+    itlFile.port = sspC->Port;
+    strncpy(itlFile.portname,port,sizeof(itlFile.portname) - 1);
+    itlFile.SSPAddress = sspC->SSPAddress;
+    itlFile.session = 1;
+    itlFile.blockRetries = blockRetries;
+    itlFile.progress = progress;
+    for(i = 0; i < 4; i++)
+        itlFile.NumberOfRamBytes += (unsigned long)itlFile.fData[7 + i] << (8 * (3-i));
+
+    // One download at a time, whichever entry point started it
+    if (__sync_lock_test_and_set(&download_in_progress,1))
+    {
+        munmap(data,st.st_size);
+        return DOWNLOAD_IN_PROGRESS;
+    }
+    download_block = 0;
+    return_value = _download_ram_file(&itlFile,sspC);
+    if (return_value == DOWNLOAD_COMPLETE)
+        return_value = _download_main_file(&itlFile);
+    // The main file goes through a port opened again
+    sspC->Port = itlFile.port;
+    munmap(data,st.st_size);
+    download_in_progress = 0;
+    download_block = return_value;
+    return return_value;
+}
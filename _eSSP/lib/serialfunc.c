@@ -1,4 +1,7 @@
 #define BSD_COMP
+#define _GNU_SOURCE
+#include <stdlib.h>
+#include <stdarg.h>
 #include <stdio.h>   /* Standard input/output definitions */
 #include <string.h>  /* String function definitions */
 #include <unistd.h>  /* UNIX standard function definitions */
@@ -6,26 +9,135 @@
 #include <errno.h>   /* Error number definitions */
 #include <termios.h> /* POSIX terminal control definitions */
 #include <sys/ioctl.h>
+#include <poll.h>
 #include "../inc/itl_types.h"
 #include "serialfunc.h"
 //#include <asm/termios.h>
 #define FIONREAD 0x541B
-//port is the device name ( eg /dev/ttyUSB0 )
-//returns -1 on error
+/* longest wait for room in the output queue, in ms   */
+#define WRITE_TIMEOUT 1000
+/* handles up to this are looked up in a table, the rest are ttys   */
+#define MAX_PORT_HANDLE 1024
+
+/* the transport, address and reconnection count of every port that isn't a local tty   */
+static struct {
+	const SSP_TRANSPORT * transport;
+	char * address;
+	unsigned long reconnects;
+} ports[MAX_PORT_HANDLE];
+
+/* why the last OpenSSPPort of this thread failed   */
+static __thread char port_error[256];
+
+void SetPortError(const char * format, ...)
+{
+	va_list args;
+	va_start(args, format);
+	vsnprintf(port_error, sizeof(port_error), format, args);
+	va_end(args);
+}
+
+static const SSP_TRANSPORT * const transports[] = {&SSPTcpTransport};
+
+static const SSP_TRANSPORT * _transport(const SSP_PORT port)
+{
+	if (port >= 0 && port < MAX_PORT_HANDLE && ports[port].transport)
+		return ports[port].transport;
+	return &SSPTtyTransport;
+}
+
+/* connect a port that can again, on the same handle; 1 if it is usable   */
+static int _reconnect(const SSP_PORT port)
+{
+	const SSP_TRANSPORT * transport = _transport(port);
+	if (!transport->reconnect || !transport->reconnect(port, ports[port].address))
+		return 0;
+	ports[port].reconnects++;
+	return 1;
+}
+
+/* the other end of a connection has gone, seen without reading   */
+static int _hung_up(const SSP_PORT port)
+{
+	struct pollfd pfd;
+	pfd.fd = port;
+	pfd.events = POLLRDHUP;
+	pfd.revents = 0;
+	return poll(&pfd, 1, 0) > 0 && (pfd.revents & (POLLRDHUP | POLLHUP | POLLERR));
+}
+
 /*
 Name: OpenSSPPort
 Inputs:
-    char * port: The name of the port to use (eg /dev/ttyUSB0 for usb serial, /dev/ttyS0 for com port 1)
+    char * port: The name of the port to use (eg /dev/ttyUSB0 for usb serial, /dev/ttyS0 for com port 1),
+                 or tcp://host:port for a serial to Ethernet converter in raw TCP mode
 Return:
     -1 on error
 Notes:
+    The name picks the transport, by its scheme
 */
 SSP_PORT OpenSSPPort(const char * port)
+{
+	const SSP_TRANSPORT * transport = &SSPTtyTransport;
+	const char * address = port;
+	SSP_PORT port_handle;
+	unsigned int i;
+	port_error[0] = 0;
+	for (i = 0; i < sizeof(transports) / sizeof(transports[0]); i++)
+	{
+		if (strncmp(port, transports[i]->scheme, strlen(transports[i]->scheme)) == 0)
+		{
+			transport = transports[i];
+			address = port + strlen(transport->scheme);
+			break;
+		}
+	}
+	port_handle = transport->open(address);
+	if (port_handle < 0 || transport == &SSPTtyTransport)
+		return port_handle;
+	if (port_handle >= MAX_PORT_HANDLE)
+	{
+		SetPortError("Too many ports open for %s", port);
+		close(port_handle);
+		return -1;
+	}
+	ports[port_handle].transport = transport;
+	ports[port_handle].address = strdup(address);
+	ports[port_handle].reconnects = 0;
+	return port_handle;
+}
+
+/*
+Name: GetPortError
+Return:
+    Why the last OpenSSPPort of the calling thread failed, empty if it didn't
+*/
+const char * GetPortError(void)
+{
+	return port_error;
+}
+
+/*
+Name: GetPortReconnects
+Inputs:
+    SSP_PORT port: An open port
+Return:
+    How many times the connection dropped and was made again, 0 for a local tty
+*/
+unsigned long GetPortReconnects(const SSP_PORT port)
+{
+	if (port >= 0 && port < MAX_PORT_HANDLE)
+		return ports[port].reconnects;
+	return 0;
+}
+
+static SSP_PORT tty_open(const char * port)
 {
 	int port_handle;
 	port_handle = open(port,O_RDWR| O_NOCTTY | O_NDELAY);
 	if (port_handle == -1)
 	{
+		SetPortError("Unable to open port %s: %s", port, strerror(errno));
 		perror("Unable to open port");
 	}
 	else
@@ -36,6 +148,11 @@ SSP_PORT OpenSSPPort(const char * port)
 	return port_handle;
 }
 
+static long tty_write(const SSP_PORT port, const unsigned char * data, unsigned long length)
+{
+	return write(port,data,length);
+}
+
 /*
 Name: CloseSSPPort
 Inputs:
@@ -48,37 +165,107 @@ void CloseSSPPort(const SSP_PORT port)
 {
 	if (port >= 0)
 	{
+		if (port < MAX_PORT_HANDLE && ports[port].transport)
+		{
+			free(ports[port].address);
+			ports[port].address = NULL;
+			ports[port].transport = NULL;
+		}
 		close(port);
 	}
 }
 
+/*
+Name: WriteData
+Inputs:
+    const unsigned char * data: The bytes to send
+    unsigned long length: How many bytes
+    SSP_PORT port: The port to send on
+Return:
+    1 on success
+    0 on failure
+Notes:
+    Hands the whole frame to the driver in one write() where it fits, without
+    waiting for the line to go idle first. A full output queue (EAGAIN) is
+    waited out in poll() rather than spun on
+*/
 int WriteData(const unsigned char * data, unsigned long length, const SSP_PORT port)
 {
+	const SSP_TRANSPORT * transport = _transport(port);
 	long n;
-	/*printf("OUT: ");
-	for (n = 0; n < length; ++n)
-        printf("%x ",(unsigned char)data[n]);
-    printf("\n");*/
-	long offset;
-	long bytes_left = length;
-	offset = 0;
-	while (bytes_left > 0)
+	unsigned long offset = 0;
+	int reconnected = 0;
+	struct pollfd pfd;
+	/* a connection dropped while the line was quiet is made again first   */
+	if (transport->reconnect && _hung_up(port))
+	{
+		if (!_reconnect(port))
+			return 0;
+		reconnected = 1;
+	}
+	while (offset < length)
 	{
-		while (TransmitComplete(port) == 0)
-			usleep(100);
-		n = write(port,&data[offset],bytes_left);
-		usleep(500);
+		n = transport->write(port,&data[offset],length - offset);
 		if (n < 0)
 		{
+			if (errno == EINTR)
+				continue;
+			if (errno == EAGAIN || errno == EWOULDBLOCK)
+			{
+				pfd.fd = port;
+				pfd.events = POLLOUT;
+				pfd.revents = 0;
+				n = poll(&pfd, 1, WRITE_TIMEOUT);
+				if (n < 0 && errno == EINTR)
+					continue;
+				if (n > 0 && !(pfd.revents & (POLLERR | POLLHUP | POLLNVAL)))
+					continue;
+				if (n == 0)
+					errno = ETIMEDOUT;
+			}
+			/* once per frame, and the frame goes whole over the new connection   */
+			else if (transport->reconnect && !reconnected && (errno == EPIPE || errno == ECONNRESET || errno == ENOTCONN))
+			{
+				reconnected = 1;
+				if (_reconnect(port))
+				{
+					offset = 0;
+					continue;
+				}
+			}
 			perror("Write Port Failed");
 			return 0;
 		}
 		offset += n;
-		bytes_left -= n;
 	}
 	return 1;
 }
 
+/*
+Name: DrainData
+Inputs:
+    SSP_PORT port: The port to wait on
+Return:
+    1 on success
+    0 on failure
+Notes:
+    Blocks until everything written has left the UART, for the few places
+    where the protocol needs the line idle (baud changes, raw download blocks)
+*/
+int DrainData(const SSP_PORT port)
+{
+	return _transport(port)->drain(port);
+}
+
+static int tty_drain(const SSP_PORT port)
+{
+	int n;
+	do {
+		n = tcdrain(port);
+	} while (n < 0 && errno == EINTR);
+	return n == 0;
+}
+
 
 void SetupSSPPort(const SSP_PORT port)
 {
@@ -127,34 +314,109 @@ int TransmitComplete(SSP_PORT port)
     return (bytes == 0);
 }
 
+/*
+Name: WaitForData
+Inputs:
+    SSP_PORT port: The port to wait on
+    long timeout: The longest time to wait in ms
+Return:
+    1 when there is data to read, 0 on timeout, -1 on error,
+    PORT_RECONNECTED when the connection dropped and was made again
+Notes:
+    Sleeps in the kernel until a byte arrives instead of polling BytesInBuffer
+*/
+int WaitForData(const SSP_PORT port, const long timeout)
+{
+	struct pollfd pfd;
+	int n;
+	pfd.fd = port;
+	pfd.events = POLLIN | POLLRDHUP;
+	pfd.revents = 0;
+	do {
+		n = poll(&pfd, 1, timeout);
+	} while (n < 0 && errno == EINTR);
+	/* a hung up line reads nothing but polls ready, don't spin on it;
+	   a closed connection polls readable for ever once drained   */
+	if (n > 0 && ((pfd.revents & (POLLERR | POLLNVAL)) || (pfd.revents & (POLLHUP | POLLIN)) == POLLHUP
+	              || ((pfd.revents & POLLRDHUP) && BytesInBuffer(port) == 0)))
+		return _reconnect(port) ? PORT_RECONNECTED : -1;
+	return n;
+}
+
 int ReadData(const SSP_PORT port, unsigned char * buffer, unsigned long bytes_to_read)
 {
 	return read(port,buffer,bytes_to_read);
 }
 
-void SetBaud(const SSP_PORT port, const unsigned long baud)
+/*
+Name: SetBaud
+Inputs:
+    SSP_PORT port: The port to change
+    unsigned long baud: 9600, 19200, 38400, 57600 or 115200
+Return:
+    1 on success
+    0 if the rate is not supported or can't be set
+Notes:
+    Both directions are switched, after anything queued has gone out
+*/
+int SetBaud(const SSP_PORT port, const unsigned long baud)
+{
+	return _transport(port)->set_baud(port, baud);
+}
+
+/* 1 if SetBaud would take the rate on this port, nothing is changed   */
+int CanSetBaud(const SSP_PORT port, const unsigned long baud)
+{
+	return _transport(port)->can_set_baud(port, baud);
+}
+
+/* the termios speed of a rate, 0 if there is none   */
+static speed_t _tty_speed(const unsigned long baud)
 {
-	struct termios options;
-	tcgetattr(port,&options);
-	//9600 baud
 	switch(baud)
 	{
     case 9600:
-        cfsetispeed(&options,B9600);
-        break;
+        return B9600;
     case 19200:
-        cfsetispeed(&options,B19200);
-        break;
+        return B19200;
     case 38400:
-        cfsetispeed(&options,B38400);
-        break;
+        return B38400;
     case 57600:
-        cfsetispeed(&options,B57600);
-        break;
+        return B57600;
     case 115200:
-        cfsetispeed(&options,B115200);
-        break;
+        return B115200;
+    default:
+        return 0;
 	}
-	tcsetattr( port,TCSANOW,&options);
-	tcgetattr(port,&options);
 }
+
+static int tty_can_set_baud(const SSP_PORT port, const unsigned long baud)
+{
+	return _tty_speed(baud) != 0;
+}
+
+static int tty_set_baud(const SSP_PORT port, const unsigned long baud)
+{
+	struct termios options;
+	speed_t speed = _tty_speed(baud);
+	if (speed == 0)
+		return 0;
+	if (tcgetattr(port,&options) < 0)
+		return 0;
+	cfsetispeed(&options,speed);
+	cfsetospeed(&options,speed);
+	/* let queued bytes go out at the old speed first   */
+	if (tcsetattr(port,TCSADRAIN,&options) < 0)
+		return 0;
+	return 1;
+}
+
+const SSP_TRANSPORT SSPTtyTransport = {
+	NULL,
+	tty_open,
+	tty_write,
+	tty_set_baud,
+	tty_can_set_baud,
+	tty_drain,
+	NULL,
+};
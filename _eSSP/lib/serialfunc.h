@@ -1,13 +1,42 @@
+/* What a kind of port does its own way; reading, writing and waiting are
+   plain file descriptor I/O on all of them, so the handle stays an int */
+typedef struct {
+	const char * scheme;        /* "tcp://", NULL for a local tty   */
+	SSP_PORT (*open)(const char * address);
+	long (*write)(const SSP_PORT port, const unsigned char * data, unsigned long length);
+	int (*set_baud)(const SSP_PORT port, const unsigned long baud);
+	/* whether set_baud would take the rate, without changing anything   */
+	int (*can_set_baud)(const SSP_PORT port, const unsigned long baud);
+	int (*drain)(const SSP_PORT port);
+	/* connect again on the same handle, NULL if the port can't   */
+	int (*reconnect)(const SSP_PORT port, const char * address);
+} SSP_TRANSPORT;
+
+extern const SSP_TRANSPORT SSPTtyTransport;
+extern const SSP_TRANSPORT SSPTcpTransport;
+
+/* WaitForData: the connection was made again, what was sent is lost   */
+#define PORT_RECONNECTED 2
+
+/* the reason GetPortError gives for an OpenSSPPort that fails, printf style   */
+void SetPortError(const char * format, ...);
+
 
 
 int WriteData(const unsigned char * data, unsigned long length, const SSP_PORT port);
 
+int DrainData(const SSP_PORT port);
+
 void SetupSSPPort(const SSP_PORT port);
 
 int BytesInBuffer(SSP_PORT port);
 
+int WaitForData(const SSP_PORT port, const long timeout);
+
 int ReadData(const SSP_PORT port, unsigned char * buffer, unsigned long bytes_to_read);
 
-void SetBaud(const SSP_PORT port, const unsigned long baud);
+int SetBaud(const SSP_PORT port, const unsigned long baud);
+
+int CanSetBaud(const SSP_PORT port, const unsigned long baud);
 
 int TransmitComplete(SSP_PORT port);
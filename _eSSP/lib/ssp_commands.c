@@ -28,6 +28,8 @@ void _ssp_setup_command_structure(SSP_COMMAND_SETUP * setup, SSP_COMMAND * sspC)
     sspC->SSPAddress = setup->SSPAddress;
     sspC->RetryLevel = setup->RetryLevel;
     sspC->Key = setup->Key;
+    sspC->Metrics = NULL;
+    sspC->Capture = NULL;
 }
 
 SSP_RESPONSE_ENUM ssp_setup_encryption(SSP_COMMAND_SETUP * setup,const unsigned long long fixedkey)
@@ -0,0 +1,169 @@
+#define _GNU_SOURCE
+#include <stdlib.h>
+#include <string.h>
+#include <unistd.h>
+#include <fcntl.h>
+#include <errno.h>
+#include <poll.h>
+#include <netdb.h>
+#include <sys/socket.h>
+#include <netinet/in.h>
+#include <netinet/tcp.h>
+#include "../inc/itl_types.h"
+#include "serialfunc.h"
+
+/* Serial to Ethernet converters in raw TCP mode: every byte on the
+   connection goes to the unit as it is, at the rate set on the converter */
+
+/* longest wait for the converter to take the connection, in ms   */
+#define CONNECT_TIMEOUT 2000
+/* a converter gone quiet is given up after IDLE + COUNT * INTERVAL s   */
+#define KEEPALIVE_IDLE 5
+#define KEEPALIVE_INTERVAL 2
+#define KEEPALIVE_COUNT 3
+
+/* host:port or [host]:port into its parts, 0 if it isn't one   */
+static int _split_address(const char * address, char * host, size_t size, const char ** service)
+{
+	const char * colon = strrchr(address, ':');
+	size_t length;
+	if (!colon || !colon[1])
+		return 0;
+	length = colon - address;
+	if (length >= 2 && address[0] == '[' && address[length - 1] == ']')
+	{
+		address++;
+		length -= 2;
+	}
+	if (length == 0 || length >= size)
+		return 0;
+	memcpy(host, address, length);
+	host[length] = 0;
+	*service = colon + 1;
+	return 1;
+}
+
+static int _connect(int fd, const struct sockaddr * addr, socklen_t addrlen)
+{
+	struct pollfd pfd;
+	int n, error = 0;
+	socklen_t size = sizeof(error);
+	if (connect(fd, addr, addrlen) == 0)
+		return 1;
+	if (errno != EINPROGRESS)
+		return 0;
+	pfd.fd = fd;
+	pfd.events = POLLOUT;
+	pfd.revents = 0;
+	do {
+		n = poll(&pfd, 1, CONNECT_TIMEOUT);
+	} while (n < 0 && errno == EINTR);
+	if (n == 0)
+		errno = ETIMEDOUT;
+	if (n <= 0 || getsockopt(fd, SOL_SOCKET, SO_ERROR, &error, &size) < 0)
+		return 0;
+	errno = error;
+	return error == 0;
+}
+
+/* a connected, non blocking socket to address, -1 on error   */
+static SSP_PORT _tcp_socket(const char * address)
+{
+	char host[256];
+	const char * service;
+	struct addrinfo hints, *found, *ai;
+	int fd = -1, n, value;
+
+	if (!_split_address(address, host, sizeof(host), &service))
+	{
+		SetPortError("Not a host:port address: %s", address);
+		return -1;
+	}
+	memset(&hints, 0, sizeof(hints));
+	hints.ai_family = AF_UNSPEC;
+	hints.ai_socktype = SOCK_STREAM;
+	n = getaddrinfo(host, service, &hints, &found);
+	if (n != 0)
+	{
+		SetPortError("Unable to resolve %s: %s", host, gai_strerror(n));
+		return -1;
+	}
+	for (ai = found; ai; ai = ai->ai_next)
+	{
+		fd = socket(ai->ai_family, ai->ai_socktype | SOCK_NONBLOCK | SOCK_CLOEXEC, ai->ai_protocol);
+		if (fd < 0)
+			continue;
+		if (_connect(fd, ai->ai_addr, ai->ai_addrlen))
+			break;
+		close(fd);
+		fd = -1;
+	}
+	freeaddrinfo(found);
+	if (fd < 0)
+	{
+		SetPortError("Unable to connect to %s: %s", address, strerror(errno));
+		return -1;
+	}
+	/* frames are small and each one is waited on, send them at once   */
+	value = 1;
+	setsockopt(fd, IPPROTO_TCP, TCP_NODELAY, &value, sizeof(value));
+	/* notice a converter gone while the line is quiet, and while it is busy   */
+	setsockopt(fd, SOL_SOCKET, SO_KEEPALIVE, &value, sizeof(value));
+	value = KEEPALIVE_IDLE;
+	setsockopt(fd, IPPROTO_TCP, TCP_KEEPIDLE, &value, sizeof(value));
+	value = KEEPALIVE_INTERVAL;
+	setsockopt(fd, IPPROTO_TCP, TCP_KEEPINTVL, &value, sizeof(value));
+	value = KEEPALIVE_COUNT;
+	setsockopt(fd, IPPROTO_TCP, TCP_KEEPCNT, &value, sizeof(value));
+	value = (KEEPALIVE_IDLE + KEEPALIVE_COUNT * KEEPALIVE_INTERVAL) * 1000;
+	setsockopt(fd, IPPROTO_TCP, TCP_USER_TIMEOUT, &value, sizeof(value));
+	return fd;
+}
+
+static long tcp_write(const SSP_PORT port, const unsigned char * data, unsigned long length)
+{
+	/* a closed connection is an error to handle, not a signal   */
+	return send(port, data, length, MSG_NOSIGNAL);
+}
+
+/* the new connection takes the old one's handle, whoever holds it carries on   */
+static int tcp_reconnect(const SSP_PORT port, const char * address)
+{
+	SSP_PORT fd = _tcp_socket(address);
+	if (fd < 0)
+		return 0;
+	if (dup3(fd, port, O_CLOEXEC) < 0)
+	{
+		close(fd);
+		return 0;
+	}
+	close(fd);
+	return 1;
+}
+
+/* the converter's serial side keeps the rate it is set to, 9600 like a unit that has just started   */
+static int tcp_can_set_baud(const SSP_PORT port, const unsigned long baud)
+{
+	return baud == 9600;
+}
+
+static int tcp_set_baud(const SSP_PORT port, const unsigned long baud)
+{
+	return tcp_can_set_baud(port, baud);
+}
+
+/* nothing to wait for here, the converter's UART can't be seen from this end   */
+static int tcp_drain(const SSP_PORT port)
+{
+	return 1;
+}
+
+const SSP_TRANSPORT SSPTcpTransport = {
+	"tcp://",
+	_tcp_socket,
+	tcp_write,
+	tcp_set_baud,
+	tcp_can_set_baud,
+	tcp_drain,
+	tcp_reconnect,
+};
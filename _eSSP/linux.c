@@ -5,8 +5,6 @@
 #include <sys/types.h>
 #include <sys/time.h>
 
-static int open_port = 0;
-
 /* Some helper funtions for detecting keyboard input */
 void changemode(int dir)
 {
@@ -44,25 +42,64 @@ int kbhit (void)
   return FD_ISSET(STDIN_FILENO, &rdfs);
 }
 
-int open_ssp_port (const char *port) 
+/* The port and protocol state live in the SSP_COMMAND, one per unit,
+   so any number of units can be open and polled from separate threads */
+int open_ssp_port (SSP_COMMAND *sspC, const char *port) 
+{
+	sspC->Port = OpenSSPPort(port);
+	reset_ssp_session(sspC);
+	return (sspC->Port != -1);
+}
+
+// A port opened again starts a plain session at 9600, as the first one
+void reset_ssp_session (SSP_COMMAND *sspC)
+{
+	sspC->BaudRate = 9600;
+	sspC->EncryptionStatus = NO_ENCRYPTION;
+	sspC->Sequence = 0x80;
+	sspC->EncPktCount = 0;
+}
+
+// Forget a port shared with others, without closing it
+void detach_ssp_port (SSP_COMMAND *sspC)
+{
+	sspC->Port = -1;
+}
+
+void close_ssp_port (SSP_COMMAND *sspC) 
+{
+	CloseSSPPort(sspC->Port);
+	sspC->Port = -1;
+}
+
+// Times the transport made the connection again by itself since the port was opened
+unsigned long ssp_port_reconnects(SSP_COMMAND *sspC)
+{
+	return GetPortReconnects(sspC->Port);
+}
+
+// Whether the port can be set to baud, asked before the unit is
+int can_set_ssp_port_baud(SSP_COMMAND *sspC, const unsigned long baud)
 {
-	open_port = OpenSSPPort(port);
-	return (open_port != -1);
+	return CanSetBaud(sspC->Port, baud);
 }
 
-void close_ssp_port () 
+int set_ssp_port_baud(SSP_COMMAND *sspC, const unsigned long baud)
 {
-	CloseSSPPort(open_port);
+	if (!SetBaud(sspC->Port, baud))
+		return 0;
+	sspC->BaudRate = baud;
+	return 1;
 }
 
 int send_ssp_command(SSP_COMMAND *sspC) 
 {
-	return SSPSendCommand(open_port, sspC);
+	return SSPSendPortCommand(sspC);
 }
 
 int negotiate_ssp_encryption(SSP_COMMAND *sspC, SSP_FULL_KEY * hostKey)
 {
-	return NegotiateSSPEncryption(open_port, sspC->SSPAddress, hostKey);
+	return NegotiateSSPPortEncryption(sspC, hostKey);
 }
 
 
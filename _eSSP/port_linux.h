@@ -14,8 +14,13 @@
 void changemode(int dir);
 int kbhit (void);
 
-int open_ssp_port (const char *port);
-void close_ssp_port ();
+int open_ssp_port (SSP_COMMAND *sspC, const char *port);
+void close_ssp_port (SSP_COMMAND *sspC);
+void reset_ssp_session (SSP_COMMAND *sspC);
+void detach_ssp_port (SSP_COMMAND *sspC);
+unsigned long ssp_port_reconnects(SSP_COMMAND *sspC);
+int can_set_ssp_port_baud(SSP_COMMAND *sspC, const unsigned long baud);
+int set_ssp_port_baud(SSP_COMMAND *sspC, const unsigned long baud);
 int send_ssp_command(SSP_COMMAND *sspC);
 int negotiate_ssp_encryption(SSP_COMMAND *sspC, SSP_FULL_KEY * hostKey);
 
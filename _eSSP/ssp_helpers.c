@@ -97,6 +97,41 @@ SSP_RESPONSE_ENUM ssp6_get_routing(SSP_COMMAND *sspC, const unsigned int value,
 		sspC->CommandData[i+5] = cc[i];
         
     resp = _ssp_return_values(sspC);
+    return resp;
+}
+
+// Send an SSP get all levels (0x22), and parse the level of every denomination in one round trip
+SSP_RESPONSE_ENUM ssp6_get_all_levels(SSP_COMMAND *sspC, SSP6_LEVELS *levels)
+{
+    SSP_RESPONSE_ENUM resp;
+    unsigned int i, j;
+    int offset;
+
+    sspC->CommandDataLength = 1;
+    sspC->CommandData[0] = SSP_CMD_GET_ALL_LEVELS;
+    resp = _ssp_return_values(sspC);
+    if (resp == SSP_RESPONSE_OK)
+    {
+        offset = 1;
+        levels->NumberOfDenominations = sspC->ResponseData[offset++];
+        // 9 bytes each, don't read past what fits in the reply or the table
+        if (levels->NumberOfDenominations > MAX_SSP6_LEVELS)
+            levels->NumberOfDenominations = MAX_SSP6_LEVELS;
+        if (levels->NumberOfDenominations * 9 + 2 > sspC->ResponseDataLength)
+            levels->NumberOfDenominations = (sspC->ResponseDataLength - 2) / 9;
+        for (i = 0; i < levels->NumberOfDenominations; i++)
+        {
+            levels->Levels[i].Level = sspC->ResponseData[offset] + (sspC->ResponseData[offset + 1] << 8);
+            offset += 2;
+            levels->Levels[i].Value = 0;
+            for (j = 0; j < 4; j++)
+                levels->Levels[i].Value += (unsigned long)sspC->ResponseData[offset++] << (j*8);
+            for (j = 0; j < 3; j++)
+                levels->Levels[i].cc[j] = sspC->ResponseData[offset++];
+            levels->Levels[i].cc[j] = '\0'; // NULL TERMINATOR
+        }
+    }
+    return resp;
 }
 
 // Send an SSP sync (0x11)
@@ -110,6 +145,65 @@ SSP_RESPONSE_ENUM ssp6_sync(SSP_COMMAND *sspC)
     return resp;
 }
 
+// Send an SSP set baud rate (0x4D), switch the port and check the link with a sync (0x11)
+// The unit answers at the old rate and only then changes, a failed check puts both back at 9600
+SSP_RESPONSE_ENUM ssp6_set_baud_rate(SSP_COMMAND *sspC, const unsigned long baud, const unsigned char persist)
+{
+    SSP_RESPONSE_ENUM resp;
+    unsigned char index;
+    int switched;
+
+    switch (baud)
+    {
+    case 9600:
+        index = 0;
+        break;
+    case 38400:
+        index = 1;
+        break;
+    case 115200:
+        index = 2;
+        break;
+    default:
+        return SSP_RESPONSE_INVALID_PARAMETER;
+    }
+    // A rate this end can't follow (a converter's fixed line) is never asked of the unit
+    if (!can_set_ssp_port_baud(sspC, baud))
+        return SSP_RESPONSE_FAILURE;
+
+    sspC->CommandDataLength = 3;
+    sspC->CommandData[0] = SSP_CMD_SET_BAUD_RATE;
+    sspC->CommandData[1] = index;
+    sspC->CommandData[2] = persist;
+    resp = _ssp_return_values(sspC);
+    if (resp != SSP_RESPONSE_OK)
+        return resp;
+
+    switched = set_ssp_port_baud(sspC, baud);
+    if (switched)
+    {
+        resp = ssp6_sync(sspC);
+        if (resp == SSP_RESPONSE_OK)
+            return resp;
+    }
+    else
+        resp = SSP_RESPONSE_FAILURE;
+
+    // The unit has switched while we could not, or the line does not carry
+    // the new rate: ask for 9600 at whatever rate we are at, then talk at 9600
+    if (sspC->BaudRate != 9600 || !switched)
+    {
+        sspC->CommandDataLength = 3;
+        sspC->CommandData[0] = SSP_CMD_SET_BAUD_RATE;
+        sspC->CommandData[1] = 0;
+        sspC->CommandData[2] = persist;
+        _ssp_return_values(sspC);
+        set_ssp_port_baud(sspC, 9600);
+    }
+    ssp6_sync(sspC);
+    return resp;
+}
+
 // Setup SSP encryption, sends SSP commands set generator (0x4A), set modulus (0x4B) and exchange keys (0x4C)
 SSP_RESPONSE_ENUM ssp6_setup_encryption(SSP_COMMAND *sspC,const unsigned long long fixedkey)
 {
@@ -235,6 +329,52 @@ SSP_RESPONSE_ENUM ssp6_setup_request(SSP_COMMAND *sspC, SSP6_SETUP_REQUEST_DATA
     return resp;
 }
 
+// Send an SSP get serial number (0x0C), the serial is sent most significant byte first
+SSP_RESPONSE_ENUM ssp6_get_serial(SSP_COMMAND *sspC, unsigned long *serial)
+{
+    SSP_RESPONSE_ENUM resp;
+    int i;
+
+    sspC->CommandDataLength = 1;
+    sspC->CommandData[0] = SSP_CMD_SERIAL_NUMBER;
+    resp = _ssp_return_values(sspC);
+    if (resp == SSP_RESPONSE_OK)
+    {
+        *serial = 0;
+        for (i = 0; i < 4; i++)
+            *serial = (*serial << 8) | sspC->ResponseData[1 + i];
+    }
+    return resp;
+}
+
+// Send an SSP unit data (0x0D), and parse the response into an SSP6_UNIT_DATA
+SSP_RESPONSE_ENUM ssp6_unit_data(SSP_COMMAND *sspC, SSP6_UNIT_DATA *unit_data)
+{
+    SSP_RESPONSE_ENUM resp;
+    int i;
+    int offset;
+
+    sspC->CommandDataLength = 1;
+    sspC->CommandData[0] = SSP_CMD_UNIT_DATA;
+    resp = _ssp_return_values(sspC);
+    if (resp == SSP_RESPONSE_OK)
+    {
+        offset = 1;
+        unit_data->UnitType = sspC->ResponseData[offset++];
+        for (i = 0; i < 4; ++i)
+            unit_data->FirmwareVersion[i] = sspC->ResponseData[offset++];
+        unit_data->FirmwareVersion[i] = '\0'; //NULL TERMINATOR
+        for (i = 0; i < 3; ++i)
+            unit_data->CountryCode[i] = sspC->ResponseData[offset++];
+        unit_data->CountryCode[i] = '\0'; //NULL TERMINATOR
+        unit_data->ValueMultiplier = 0;
+        for (i = 0; i < 3; ++i)
+            unit_data->ValueMultiplier += ((unsigned long)sspC->ResponseData[offset++] << ((2-i)*8));
+        unit_data->ProtocolVersion = sspC->ResponseData[offset++];
+    }
+    return resp;
+}
+
 // send an enable command
 SSP_RESPONSE_ENUM ssp6_enable(SSP_COMMAND *sspC)
 {
@@ -308,7 +448,6 @@ SSP_RESPONSE_ENUM ssp6_set_inhibits(SSP_COMMAND *sspC,const unsigned char lowcha
 SSP_RESPONSE_ENUM ssp6_poll(SSP_COMMAND *sspC, SSP_POLL_DATA6 *poll_response)
 {
     SSP_RESPONSE_ENUM resp;
-    unsigned char i,j;
 
 	// send the poll command
     sspC->CommandDataLength = 1;
@@ -316,122 +455,141 @@ SSP_RESPONSE_ENUM ssp6_poll(SSP_COMMAND *sspC, SSP_POLL_DATA6 *poll_response)
     resp = _ssp_return_values(sspC);
 
     if (resp == SSP_RESPONSE_OK)
+        ssp6_decode_poll(sspC->ResponseData, sspC->ResponseDataLength, poll_response);
+    return resp;
+}
+
+// Decode the events of a poll reply (ResponseData, starting with the OK byte) without any port
+void ssp6_decode_poll(const unsigned char *data, const unsigned char length, SSP_POLL_DATA6 *poll_response)
+{
+    unsigned char i,j;
+
+    poll_response->event_count = 0;
+    for (i = 1; i < length && poll_response->event_count < 20; ++i)
     {
-    	// if the poll was successful, iterate over all of the response
-        poll_response->event_count = 0;
-        for (i = 1; i < sspC->ResponseDataLength; ++i)
+        // initialise the event structure
+        poll_response->events[poll_response->event_count].event = data[i];
+        poll_response->events[poll_response->event_count].data1 = 0;
+        poll_response->events[poll_response->event_count].data2 = 0;
+        poll_response->events[poll_response->event_count].cc[0] = 0;
+        poll_response->events[poll_response->event_count].cc[3] = 0;
+        
+        switch (data[i])
         {
-        	// initialise the event structure
-            poll_response->events[poll_response->event_count].event = sspC->ResponseData[i];
-            poll_response->events[poll_response->event_count].data1 = 0;
-            poll_response->events[poll_response->event_count].data2 = 0;
-            poll_response->events[poll_response->event_count].cc[0] = 0;
-            poll_response->events[poll_response->event_count].cc[3] = 0;
+        //all these commands have one data byte
+        case SSP_POLL_CREDIT:
+        case SSP_POLL_READ:
+        case SSP_POLL_CLEARED_FROM_FRONT:
+        case SSP_POLL_CLEARED_INTO_CASHBOX:
+        case SSP_POLL_CALIBRATION_FAIL:
+            if (i + 1 >= length) // truncated, dropped
+                continue;
+            i++; //move onto the data
+            poll_response->events[poll_response->event_count].data1 = data[i];
+            break;
             
-            switch (sspC->ResponseData[i])
+        //all these commands have 7 data bytes per country;
+        case SSP_POLL_DISPENSING:
+        case SSP_POLL_DISPENSED:
+        case SSP_POLL_JAMMED:
+        case SSP_POLL_HALTED:
+        case SSP_POLL_FLOATING:
+        case SSP_POLL_FLOATED:
+        case SSP_POLL_TIMEOUT:
+        case SSP_POLL_CASHBOX_PAID:
+        case SSP_POLL_COIN_CREDIT:
+        case SSP_POLL_SMART_EMPTYING:
+        case SSP_POLL_SMART_EMPTIED:
+        case SSP_POLL_FRAUD_ATTEMPT:
             {
-            //all these commands have one data byte
-            case SSP_POLL_CREDIT:
-            case SSP_POLL_READ:
-            case SSP_POLL_CLEARED_FROM_FRONT:
-            case SSP_POLL_CLEARED_INTO_CASHBOX:
-            case SSP_POLL_CALIBRATION_FAIL:
-                i++; //move onto the data
-                poll_response->events[poll_response->event_count].data1 = sspC->ResponseData[i];
-                break;
-                
-            //all these commands have 7 data bytes per country;
-            case SSP_POLL_DISPENSING:
-            case SSP_POLL_DISPENSED:
-            case SSP_POLL_JAMMED:
-            case SSP_POLL_HALTED:
-            case SSP_POLL_FLOATING:
-            case SSP_POLL_FLOATED:
-            case SSP_POLL_TIMEOUT:
-            case SSP_POLL_CASHBOX_PAID:
-            case SSP_POLL_COIN_CREDIT:
-            case SSP_POLL_SMART_EMPTYING:
-            case SSP_POLL_SMART_EMPTIED:
-            case SSP_POLL_FRAUD_ATTEMPT:
-                {
-                    unsigned char event = sspC->ResponseData[i];
-					unsigned int countries;
-                    i++; // move onto the country count;
-                    countries = (unsigned int)sspC->ResponseData[i];
-                    // for every country in the response, make a new event structure and store into it
-                    for (j = 0; j < countries; ++j) {
-                        int k;
-                        poll_response->events[poll_response->event_count].event = event;
-                        poll_response->events[poll_response->event_count].data1 = 0;
-                        poll_response->events[poll_response->event_count].data2 = 0;
-						poll_response->events[poll_response->event_count].cc[3] = '\0';
-
-                        for (k = 0; k < 4; ++k)
-                        {
-                            i++; //move through the 4 bytes of data
-                            poll_response->events[poll_response->event_count].data1 += (((unsigned long)sspC->ResponseData[i]) << (8*k));
-                        }
-                        for (k = 0; k < 3; ++k)
-                        {
-                            i++; //move through the 3 bytes of country code
-                            poll_response->events[poll_response->event_count].cc[k] = sspC->ResponseData[i];
-                        }
-                        
-                        if (j != countries-1) // the last time through event_count will be updated elsewhere.
-                            poll_response->event_count++;
+                unsigned char event = data[i];
+                unsigned int countries;
+                if (i + 1 >= length) // truncated, dropped
+                    continue;
+                i++; // move onto the country count;
+                countries = (unsigned int)data[i];
+                // for every country in the response, make a new event structure and store into it,
+                // as long as there is room for it and the reply holds all of its 7 bytes
+                for (j = 0; j < countries && poll_response->event_count < 20; ++j) {
+                    int k;
+                    if (i + 7 >= length) {
+                        // a truncated country is dropped, and what follows it with it
+                        i = length - 1;
+                        break;
+                    }
+                    poll_response->events[poll_response->event_count].event = event;
+                    poll_response->events[poll_response->event_count].data1 = 0;
+                    poll_response->events[poll_response->event_count].data2 = 0;
+                    poll_response->events[poll_response->event_count].cc[3] = '\0';
+
+                    for (k = 0; k < 4; ++k)
+                    {
+                        i++; //move through the 4 bytes of data
+                        poll_response->events[poll_response->event_count].data1 += (((unsigned long)data[i]) << (8*k));
                     }
-                
+                    for (k = 0; k < 3; ++k)
+                    {
+                        i++; //move through the 3 bytes of country code
+                        poll_response->events[poll_response->event_count].cc[k] = data[i];
+                    }
+                    
+                    poll_response->event_count++;
                 }
-                break;
-                
-            //all these commands have 11 data bytes per country;
-            case SSP_POLL_INCOMPLETE_PAYOUT:
-            case SSP_POLL_INCOMPLETE_FLOAT:
-                {
-					unsigned int countries;
-                    unsigned char event = sspC->ResponseData[i];
-                    i++; // move onto the country count;
-                    countries = (unsigned int)sspC->ResponseData[i];
-                    // for every country in the response, make a new event structure and store into it
-                    for (j = 0; j < countries; ++j) {
-                        int k;
-                        poll_response->events[poll_response->event_count].event = event;
-                        poll_response->events[poll_response->event_count].data1 = 0;
-                        poll_response->events[poll_response->event_count].data2 = 0;
-						poll_response->events[poll_response->event_count].cc[3] = '\0';
-
-						for (k = 0; k < 4; ++k)
-                        {
-                            i++; //move through the 4 bytes of data
-                            poll_response->events[poll_response->event_count].data1 += (((unsigned long)sspC->ResponseData[i]) << (8*i));
-                        }
-                        for (k = 0; k < 4; ++k)
-                        {
-                            i++; //move through the 4 bytes of data
-                            poll_response->events[poll_response->event_count].data2 += (((unsigned long)sspC->ResponseData[i]) << (8*i));
-                        }
-                        for (k = 0; k < 3; ++k)
-                        {
-                            i++; //move through the 3 bytes of country code
-                            poll_response->events[poll_response->event_count].cc[k] += sspC->ResponseData[i];
-                        }
-                        
-                        if (j != countries-1) // the last time through event_count will be updated elsewhere.
-                            poll_response->event_count++;
+                continue; // every country was counted as it was decoded
+            }
+            
+        //all these commands have 11 data bytes per country;
+        case SSP_POLL_INCOMPLETE_PAYOUT:
+        case SSP_POLL_INCOMPLETE_FLOAT:
+            {
+                unsigned int countries;
+                unsigned char event = data[i];
+                if (i + 1 >= length) // truncated, dropped
+                    continue;
+                i++; // move onto the country count;
+                countries = (unsigned int)data[i];
+                // for every country in the response, make a new event structure and store into it,
+                // as long as there is room for it and the reply holds all of its 11 bytes
+                for (j = 0; j < countries && poll_response->event_count < 20; ++j) {
+                    int k;
+                    if (i + 11 >= length) {
+                        // a truncated country is dropped, and what follows it with it
+                        i = length - 1;
+                        break;
+                    }
+                    poll_response->events[poll_response->event_count].event = event;
+                    poll_response->events[poll_response->event_count].data1 = 0;
+                    poll_response->events[poll_response->event_count].data2 = 0;
+                    poll_response->events[poll_response->event_count].cc[3] = '\0';
+
+                    for (k = 0; k < 4; ++k)
+                    {
+                        i++; //move through the 4 bytes of data
+                        poll_response->events[poll_response->event_count].data1 += (((unsigned long)data[i]) << (8*k));
                     }
-                
+                    for (k = 0; k < 4; ++k)
+                    {
+                        i++; //move through the 4 bytes of data
+                        poll_response->events[poll_response->event_count].data2 += (((unsigned long)data[i]) << (8*k));
+                    }
+                    for (k = 0; k < 3; ++k)
+                    {
+                        i++; //move through the 3 bytes of country code
+                        poll_response->events[poll_response->event_count].cc[k] = data[i];
+                    }
+                    
+                    poll_response->event_count++;
                 }
-                break;
-            default: //every other command has no data bytes
-                poll_response->events[poll_response->event_count].data1 = 0;
-                poll_response->events[poll_response->event_count].data2 = 0;
-                poll_response->events[poll_response->event_count].cc[0] = '\0';
-                break;
+                continue; // every country was counted as it was decoded
             }
-            poll_response->event_count++;
+        default: //every other command has no data bytes
+            poll_response->events[poll_response->event_count].data1 = 0;
+            poll_response->events[poll_response->event_count].data2 = 0;
+            poll_response->events[poll_response->event_count].cc[0] = '\0';
+            break;
         }
+        poll_response->event_count++;
     }
-    return resp;
 }
 
 // reset the validator
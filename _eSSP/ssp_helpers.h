@@ -15,6 +15,7 @@
 #define SSP_CMD_PAYOUT_NOTE 0x42
 #define SSP_CMD_STACK_NOTE 0x43
 #define SSP_CMD_PAYOUT_VALUE 0x33
+#define SSP_CMD_GET_ALL_LEVELS 0x22
 
 #define SSP_POLL_CALIBRATION_FAIL 0x83
 #define SSP_POLL_SMART_EMPTYING 0xB3
@@ -78,6 +79,27 @@ typedef struct {
     unsigned char ProtocolVersion;
  } SSP6_SETUP_REQUEST_DATA;
 
+#define MAX_SSP6_LEVELS 20
+
+typedef struct {
+    unsigned short Level;
+    unsigned long Value;
+    char cc[4];
+} SSP6_LEVEL;
+
+typedef struct {
+    unsigned char NumberOfDenominations;
+    SSP6_LEVEL Levels[MAX_SSP6_LEVELS];
+} SSP6_LEVELS;
+
+typedef struct {
+    unsigned char UnitType;
+    char FirmwareVersion[5];
+    char CountryCode[4];
+    unsigned long ValueMultiplier;
+    unsigned char ProtocolVersion;
+} SSP6_UNIT_DATA;
+
 enum calibration_failures {
     NO_FAILUE=0x00,
     SENSOR_FLAP=0x01,
@@ -97,14 +119,19 @@ enum channel_state {
 SSP_RESPONSE_ENUM ssp6_payout(SSP_COMMAND *sspC, const int value, const char *cc, const char option);
 SSP_RESPONSE_ENUM ssp6_set_route(SSP_COMMAND *sspC, const int value, const char *cc, const char route);
 SSP_RESPONSE_ENUM ssp6_get_routing(SSP_COMMAND *sspC, const unsigned int value, const char *cc);
+SSP_RESPONSE_ENUM ssp6_get_all_levels(SSP_COMMAND *sspC, SSP6_LEVELS *levels);
 SSP_RESPONSE_ENUM ssp6_sync(SSP_COMMAND *sspC);
+SSP_RESPONSE_ENUM ssp6_set_baud_rate(SSP_COMMAND *sspC, const unsigned long baud, const unsigned char persist);
 SSP_RESPONSE_ENUM ssp6_setup_encryption(SSP_COMMAND *sspC,const unsigned long long fixedkey);
 SSP_RESPONSE_ENUM ssp6_host_protocol(SSP_COMMAND *sspC,const unsigned char host_protocol);
 SSP_RESPONSE_ENUM ssp6_setup_request(SSP_COMMAND *sspC, SSP6_SETUP_REQUEST_DATA *setup_request_data);
+SSP_RESPONSE_ENUM ssp6_get_serial(SSP_COMMAND *sspC, unsigned long *serial);
+SSP_RESPONSE_ENUM ssp6_unit_data(SSP_COMMAND *sspC, SSP6_UNIT_DATA *unit_data);
 SSP_RESPONSE_ENUM ssp6_enable(SSP_COMMAND *sspC);
 SSP_RESPONSE_ENUM ssp6_enable_payout(SSP_COMMAND *sspC, const char type);
 SSP_RESPONSE_ENUM ssp6_set_inhibits(SSP_COMMAND *sspC,const unsigned char lowchannels, const unsigned char highchannels);
 SSP_RESPONSE_ENUM ssp6_poll(SSP_COMMAND *sspC, SSP_POLL_DATA6 * poll_response);
+void ssp6_decode_poll(const unsigned char *data, const unsigned char length, SSP_POLL_DATA6 *poll_response);
 SSP_RESPONSE_ENUM ssp6_reset(SSP_COMMAND *sspC);
 SSP_RESPONSE_ENUM ssp6_disable_payout(SSP_COMMAND *sspC);
 SSP_RESPONSE_ENUM ssp6_disable(SSP_COMMAND *sspC);
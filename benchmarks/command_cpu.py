@@ -0,0 +1,55 @@
+# !/usr/bin/env python3
+"""CPU time the host spends per SSP command, measured against the simulator
+
+    PYTHONPATH=. python3 benchmarks/command_cpu.py --count 200 --baud-rate 9600
+
+Only the CPU time of the thread issuing the commands is counted, the
+simulator runs in its own thread and sends its replies at the pace of the
+negotiated baud rate unless --no-pace is given. With --timeouts N the first
+N replies are dropped, so the cost of waiting out a reply timeout shows up too.
+"""
+import argparse
+import os
+import sys
+from time import monotonic, thread_time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from eSSP import eSSP  # noqa: E402
+from eSSP.constants import Status  # noqa: E402
+from eSSP.simulator import Simulator  # noqa: E402
+
+
+def measure(validator, count):
+    cpu, wall = thread_time(), monotonic()
+    for _ in range(count):
+        if validator.poll_once() == Status.SSP_RESPONSE_TIMEOUT:
+            raise RuntimeError("Poll timed out")
+    return (thread_time() - cpu) / count, (monotonic() - wall) / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=200, help="polls to time")
+    parser.add_argument("--baud-rate", type=int, default=9600, help="rate to negotiate with the unit")
+    parser.add_argument("--no-pace", action="store_true", help="reply as fast as the pty goes")
+    parser.add_argument("--timeouts", type=int, default=0, help="replies to drop")
+    args = parser.parse_args()
+
+    with Simulator(pace=not args.no_pace) as sim:
+        validator = eSSP(com_port=sim.port, threaded=False, baud_rate=args.baud_rate)
+        try:
+            sim.inject_fault('timeout', count=args.timeouts)
+            cpu, wall = measure(validator, args.count)
+            tx = validator.tx_stats()
+        finally:
+            validator.close()
+    print("%d polls at %s baud, %d dropped replies" % (args.count, "pty" if args.no_pace else args.baud_rate, args.timeouts))
+    print("cpu per command  %8.3f ms" % (cpu * 1000))
+    print("wall per command %8.3f ms" % (wall * 1000))
+    print("cpu / wall       %8.1f %%" % (100.0 * cpu / wall))
+    print("transmit / frame %8.3f ms" % (tx["mean"] * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+# !/usr/bin/env python3
+"""Round trips and wall time of one inventory refresh
+
+    PYTHONPATH=. python3 benchmarks/inventory.py --count 20 --baud-rate 9600
+
+A unit that knows GET ALL LEVELS is compared with one that answers it with
+unknown command, so the refresh falls back to reading every channel on its
+own. Replies are paced at the negotiated baud rate unless --no-pace is given.
+"""
+import argparse
+import os
+import sys
+from time import monotonic
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from eSSP import eSSP  # noqa: E402
+from eSSP.constants import Command  # noqa: E402
+from eSSP.simulator import Simulator, SimulatedDevice  # noqa: E402
+
+
+class PerChannelDevice(SimulatedDevice):
+    """A unit from before GET ALL LEVELS"""
+    HANDLERS = {command: handler for command, handler in SimulatedDevice.HANDLERS.items()
+                if command != Command.GET_ALL_LEVELS.value}
+
+
+def measure(device, count, baud_rate, pace):
+    with Simulator(devices=[device], pace=pace) as sim:
+        validator = eSSP(com_port=sim.port, threaded=False, baud_rate=baud_rate)
+        try:
+            # The first refresh also reads the routes, time the ones after it
+            validator.poll_once()
+            validator.do_actions()
+            commands, wall = device.commands, monotonic()
+            for _ in range(count):
+                validator.refresh_inventory(now=True)
+            return (device.commands - commands) / count, (monotonic() - wall) / count
+        finally:
+            validator.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=20, help="refreshes to time")
+    parser.add_argument("--baud-rate", type=int, default=9600, help="rate to negotiate with the unit")
+    parser.add_argument("--no-pace", action="store_true", help="reply as fast as the pty goes")
+    args = parser.parse_args()
+
+    print("%d refreshes of %d channels at %s baud" % (args.count, len(SimulatedDevice().channels),
+                                                       "pty" if args.no_pace else args.baud_rate))
+    for name, device in (("per channel", PerChannelDevice()), ("all levels", SimulatedDevice())):
+        round_trips, wall = measure(device, args.count, args.baud_rate, not args.no_pace)
+        print("%-12s %5.1f round trips %8.2f ms" % (name, round_trips, wall * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+# !/usr/bin/env python3
+"""Python time spent decoding one poll reply
+
+    PYTHONPATH=. python3 benchmarks/parse_poll.py --rounds 2000
+
+Poll buffers are recorded from the simulator while it takes in notes, stores
+them and pays them out, then fed through parse_poll() again and again. Only
+the decoding is timed, no SSP traffic happens while measuring.
+"""
+import argparse
+import os
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from eSSP import eSSP  # noqa: E402
+from eSSP.eSSP import SspPollData6  # noqa: E402
+from eSSP.simulator import Simulator  # noqa: E402
+
+
+def record(validator, sim):
+    """Non-empty poll buffers of a few notes going in and out"""
+    recorded = []
+
+    def poll_until_quiet():
+        quiet = 0
+        while quiet < 3:
+            validator.poll_once()
+            if validator.poll.event_count:
+                recorded.append(SspPollData6.from_buffer_copy(validator.poll))
+                quiet = 0
+            else:
+                quiet += 1
+
+    for channel in (1, 2, 3, 2, 1):
+        sim.device.insert_note(channel)
+        poll_until_quiet()
+    validator.payout(150)
+    validator.do_actions()
+    poll_until_quiet()
+    return recorded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rounds", type=int, default=2000, help="passes over the recorded buffers")
+    args = parser.parse_args()
+
+    with Simulator() as sim:
+        validator = eSSP(com_port=sim.port, threaded=False, route_to_storage=200)
+        try:
+            recorded = record(validator, sim)
+        finally:
+            validator.close()
+
+    events = sum(poll.event_count for poll in recorded)
+    start = perf_counter()
+    for _ in range(args.rounds):
+        for poll in recorded:
+            validator.parse_poll(poll)
+        validator.events.clear()
+    elapsed = perf_counter() - start
+    polls = args.rounds * len(recorded)
+    print("%d recorded polls, %d events" % (len(recorded), events))
+    print("per poll  %8.2f us" % (elapsed / polls * 1e6))
+    print("per event %8.2f us" % (elapsed / (args.rounds * events) * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,317 @@
+# !/usr/bin/env python3
+"""Benchmarks of the whole SSP stack, as JSON, checked against a stored baseline
+
+    PYTHONPATH=. python3 benchmarks/suite.py
+    PYTHONPATH=. python3 benchmarks/suite.py --output results.json
+    PYTHONPATH=. python3 benchmarks/suite.py --compare benchmarks/baseline.json --threshold 0.25
+    PYTHONPATH=. python3 benchmarks/suite.py --save-baseline benchmarks/baseline.json
+
+Everything runs against the simulator on a pty, replying as fast as the pty
+goes unless --pace is given, so the numbers are the host's and the
+simulator's, not the wire's. Measured are:
+
+    rtt.<COMMAND>     round trip of each command type, as the library counts it
+    poll.throughput   polls per second, one after the other
+    poll.cpu          CPU time of the polling thread per idle poll
+    startup.cold      eSSP() on a unit it has not seen, setup request included
+    startup.cached    eSSP() again, with the unit descriptor cached
+    parse.<mix>       parse_poll() of one poll reply with the given events
+    native.*          CRC, framing and AES of the library, called through ctypes,
+                      native.call is the cost of the ctypes call alone
+
+Every benchmark runs --repeat times; the median, best and worst are kept.
+With --compare a result whose best run is worse than the baseline's median
+by more than --threshold (a fraction) is a regression, listed and turned
+into exit status 1.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from ctypes import Structure, byref, c_ubyte, c_uint, c_ulong, c_ulonglong, c_short, c_ushort, c_char_p, \
+    c_void_p, POINTER, create_string_buffer
+from statistics import median
+from time import perf_counter, strftime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from eSSP import eSSP  # noqa: E402
+from eSSP.eSSP import Ssp6SetupRequestData, Ssp6UnitData  # noqa: E402
+from eSSP.replay import ReplayESSP  # noqa: E402
+from eSSP.simulator import Simulator, CRC_SSP_SEED, CRC_SSP_POLY, C_AES_MODE_ECB, DEFAULT_FIXED_KEY  # noqa: E402
+from command_cpu import measure as measure_polls  # noqa: E402
+
+FORMAT = 1
+LOWER, HIGHER = "lower", "higher"
+
+# Poll replies (status byte first) with the events of a typical moment
+POLL_MIXES = {
+    "idle": bytes((0xF0,)),
+    "disabled": bytes((0xF0, 0xE8)),
+    "credit": bytes((0xF0, 0xEF, 0x01, 0xEE, 0x01, 0xCC, 0xEB)),
+    "payout": bytes((0xF0, 0xDA, 0x01)) + (10000).to_bytes(4, "little") + b"RUB" +
+              bytes((0xD2, 0x01)) + (10000).to_bytes(4, "little") + b"RUB",
+    "faults": bytes((0xF0, 0xE3, 0xE4, 0xEA, 0xEC, 0xF1)),
+}
+
+
+class _CommandHead(Structure):
+    # The leading fields of SSP_COMMAND, the only ones CompileSSPCommand touches
+    _fields_ = [("FixedKey", c_ulonglong),
+                ("EncryptKey", c_ulonglong),
+                ("BaudRate", c_ulong),
+                ("Timeout", c_ulong),
+                ("PortNumber", c_ubyte),
+                ("SSPAddress", c_ubyte),
+                ("RetryLevel", c_ubyte),
+                ("EncryptionStatus", c_ubyte),
+                ("CommandDataLength", c_ubyte),
+                ("CommandData", c_ubyte * 255)]
+
+
+class _Packet(Structure):
+    # SSP_TX_RX_PACKET
+    _fields_ = [("txData", c_ubyte * 255),
+                ("txPtr", c_ubyte),
+                ("rxData", c_ubyte * 255),
+                ("rxPtr", c_ubyte),
+                ("txBufferLength", c_ubyte),
+                ("rxBufferLength", c_ubyte),
+                ("SSPAddress", c_ubyte),
+                ("NewResponse", c_ubyte),
+                ("CheckStuff", c_ubyte),
+                ("CrcErrors", c_ubyte)]
+
+
+def _per_call(call, count):
+    for _ in range(count // 10):
+        call()
+    start = perf_counter()
+    for _ in range(count):
+        call()
+    return (perf_counter() - start) / count
+
+
+def bench_round_trips(validator, count):
+    """Mean round trip per command type, from the library's own counters"""
+    essp, sspC = validator.essp, validator.sspC
+    serial, unit_data, setup = c_ulong(), Ssp6UnitData(), Ssp6SetupRequestData()
+    channel = validator.storage[min(validator.storage)].note
+    calls = (
+        lambda: essp.ssp6_poll(sspC, byref(validator.poll)),
+        lambda: essp.ssp6_get_all_levels(sspC, byref(validator.levels)),
+        lambda: essp.ssp6_get_note_amount(sspC, channel.value * 100, channel.currency.encode()),
+        lambda: essp.ssp6_get_serial(sspC, byref(serial)),
+        lambda: essp.ssp6_unit_data(sspC, byref(unit_data)),
+        lambda: essp.ssp6_setup_request(sspC, byref(setup)),
+    )
+    before = validator.metrics()
+    for call in calls:
+        for _ in range(count):
+            call()
+    results = []
+    for name, metrics in validator.metrics().items():
+        old = before.get(name, {"replies": 0, "rtt_sum": 0.0})
+        replies = metrics["replies"] - old["replies"]
+        if replies:
+            results.append(("rtt.%s" % name, (metrics["rtt_sum"] - old["rtt_sum"]) / replies * 1e6, "us", LOWER))
+    return results
+
+
+def bench_polls(validator, count):
+    cpu, wall = measure_polls(validator, count)
+    return [("poll.throughput", 1 / wall, "polls/s", HIGHER),
+            ("poll.cpu", cpu * 1e6, "us", LOWER)]
+
+
+def bench_startup(sim, baud_rate):
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        cache = os.path.join(directory, "descriptors.json")
+        for name in ("startup.cold", "startup.cached"):
+            start = perf_counter()
+            validator = eSSP(com_port=sim.port, threaded=False, baud_rate=baud_rate, descriptor_cache=cache)
+            results.append((name, (perf_counter() - start) * 1e3, "ms", LOWER))
+            validator.close()
+    return results
+
+
+def bench_parse_poll(descriptor, count, batches=10):
+    results = []
+    for name, data in POLL_MIXES.items():
+        elapsed = 0.0
+        for _ in range(batches):
+            # A fresh validator every batch keeps the queued actions and levels from piling up
+            validator = ReplayESSP(descriptor)
+            poll = validator.decode(data)
+            elapsed += _per_call(lambda: validator.parse_poll(poll), count) * count
+        results.append(("parse.%s" % name, elapsed / (batches * count) * 1e6, "us", LOWER))
+    return results
+
+
+def bench_native(count):
+    lib = eSSP.essp
+    lib.cal_crc_loop_CCITT_A.argtypes = [c_short, c_char_p, c_ushort, c_ushort]
+    lib.CompileSSPCommand.argtypes = [POINTER(_CommandHead), POINTER(_Packet), POINTER(c_ubyte), POINTER(c_uint)]
+    lib.EncryptSSPPacket.argtypes = [POINTER(c_uint), c_char_p, c_char_p, POINTER(c_ubyte), POINTER(c_ubyte), c_void_p]
+    lib.DecryptSSPPacket.argtypes = [c_char_p, c_char_p, POINTER(c_ubyte), POINTER(c_ubyte), c_void_p]
+
+    key = (c_ulonglong * 2)(DEFAULT_FIXED_KEY, 0x1122334455667788)
+    results = [("native.call", _per_call(lib.GetClockUs, count) * 1e6, "us", LOWER)]
+
+    for size in (6, 255):
+        data = create_string_buffer(bytes(range(size)), size)
+        results.append(("native.crc.%d" % size,
+                        _per_call(lambda: lib.cal_crc_loop_CCITT_A(size, data, CRC_SSP_SEED, CRC_SSP_POLY), count) * 1e6,
+                        "us", LOWER))
+
+    for size in (1, 64):
+        command, packet, seq, enc_count = _CommandHead(), _Packet(), c_ubyte(0x80), c_uint()
+        command.CommandDataLength = size
+        # Every 0x7F is stuffed, half the payload of the larger frame is
+        command.CommandData[:size] = [0x7F if i % 2 else 0x07 for i in range(size)]
+        results.append(("native.frame.%d" % size,
+                        _per_call(lambda: lib.CompileSSPCommand(byref(command), byref(packet), byref(seq), byref(enc_count)), count) * 1e6,
+                        "us", LOWER))
+
+    for size in (1, 64):
+        plain, cipher, out = create_string_buffer(bytes(range(size)), 255), create_string_buffer(255), create_string_buffer(255)
+        enc_count, length, cipher_length = c_uint(), c_ubyte(size), c_ubyte()
+        results.append(("native.encrypt.%d" % size,
+                        _per_call(lambda: lib.EncryptSSPPacket(byref(enc_count), plain, cipher, byref(length), byref(cipher_length), key), count) * 1e6,
+                        "us", LOWER))
+        # Decrypted as the library does it, without the STEX byte
+        body, body_length, plain_length = create_string_buffer(cipher.raw[1:], 255), c_ubyte(cipher_length.value - 1), c_ubyte()
+        results.append(("native.decrypt.%d" % size,
+                        _per_call(lambda: lib.DecryptSSPPacket(body, out, byref(body_length), byref(plain_length), key), count) * 1e6,
+                        "us", LOWER))
+
+    block = (c_ubyte * 240)(*range(240))
+    results.append(("native.aes.240",
+                    _per_call(lambda: lib.aes_encrypt(C_AES_MODE_ECB, bytes(key), 16, None, 0, block, block, 240), count) * 1e6,
+                    "us", LOWER))
+    return results
+
+
+def run(args):
+    """name -> list of (value, unit, better), one value per repeat"""
+    samples = {}
+
+    def keep(results):
+        for name, value, unit, better in results:
+            samples.setdefault(name, []).append((value, unit, better))
+
+    with Simulator(pace=args.pace) as sim:
+        # A few milliseconds each, more runs make up for the noise
+        for _ in range(args.repeat * 4):
+            keep(bench_startup(sim, args.baud_rate))
+        validator = eSSP(com_port=sim.port, threaded=False, baud_rate=args.baud_rate)
+        try:
+            descriptor = validator.descriptor
+            for _ in range(args.repeat):
+                keep(bench_round_trips(validator, args.count))
+                keep(bench_polls(validator, args.count))
+        finally:
+            validator.close()
+    for _ in range(args.repeat):
+        keep(bench_parse_poll(descriptor, args.count * 10))
+        keep(bench_native(args.count * 100))
+    return samples
+
+
+def summarize(samples):
+    results = {}
+    for name, values in sorted(samples.items()):
+        numbers = [value for value, _, _ in values]
+        _, unit, better = values[0]
+        results[name] = {"value": median(numbers), "min": min(numbers), "max": max(numbers), "unit": unit, "better": better}
+    return results
+
+
+def _best(result):
+    return result["max"] if result["better"] == HIGHER else result["min"]
+
+
+def compare(results, baseline, threshold):
+    """(name, baseline, result, change) of every result worse than its baseline by more than threshold
+
+    The best of the new runs is held against the baseline's median: a busy
+    machine only ever makes a run slower, so when even the best run is worse
+    than a typical one was, the code is.
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None or not base["value"]:
+            continue
+        old, new = base["value"], _best(result)
+        if result["better"] == HIGHER:
+            worse = new < old / (1 + threshold)
+        else:
+            worse = new > old * (1 + threshold)
+        if worse:
+            regressions.append((name, old, new, new / old - 1))
+    return regressions
+
+
+def _revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--count", type=int, default=200, help="commands per round trip and poll benchmark")
+    parser.add_argument("--repeat", type=int, default=5, help="runs of every benchmark")
+    parser.add_argument("--baud-rate", type=int, default=9600, help="rate to negotiate with the unit")
+    parser.add_argument("--pace", action="store_true", help="have the simulator reply at the baud rate")
+    parser.add_argument("--output", help="write the results to this file instead of printing them")
+    parser.add_argument("--compare", metavar="BASELINE", help="results file to check against")
+    parser.add_argument("--threshold", type=float, default=0.25, help="worse by this fraction is a regression")
+    parser.add_argument("--save-baseline", metavar="BASELINE", help="write the results as the new baseline")
+    args = parser.parse_args()
+
+    document = {
+        "format": FORMAT,
+        "meta": {
+            "time": strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "revision": _revision(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "count": args.count,
+            "repeat": args.repeat,
+            "baud_rate": args.baud_rate,
+            "pace": args.pace,
+        },
+        "results": summarize(run(args)),
+    }
+    text = json.dumps(document, indent=2, sort_keys=True) + "\n"
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w") as f:
+                f.write(text)
+    if not args.output:
+        sys.stdout.write(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get("format") != FORMAT:
+            parser.error("%s is not a results file of this suite" % args.compare)
+        regressions = compare(document["results"], baseline["results"], args.threshold)
+        for name, old, new, change in regressions:
+            unit = document["results"][name]["unit"]
+            print("REGRESSION %-24s %10.2f -> %10.2f %s (%+.0f %%)" % (name, old, new, unit, change * 100), file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print("no regressions beyond %.0f %% of %s" % (args.threshold * 100, args.compare), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
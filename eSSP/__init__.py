@@ -1,5 +1,42 @@
 import os
-from ctypes import cdll
-from .eSSP import eSSP
+from ctypes import cdll, POINTER, c_ubyte, c_char_p, c_ulong, c_ulonglong, c_void_p
+from .eSSP import eSSP, SspCommand, SspMetrics, SspCapture, SspPollData6, RTT_BUCKETS, DownloadCallback, DownloadProgress
+from .errors import SSPError, PayoutError, DownloadError, ActionExpired
 
 eSSP.essp = cdll.LoadLibrary(os.path.join(os.path.dirname(__file__), "libessp.so"))
+# Pointers and longs must not go through the default int conversions
+eSSP.essp.ssp_init.restype = POINTER(SspCommand)
+eSSP.essp.ssp_get_response_data.restype = POINTER(c_ubyte)
+eSSP.essp.ssp_get_metrics.restype = POINTER(SspMetrics)
+eSSP.essp.ssp_get_capture.restype = POINTER(SspCapture)
+eSSP.essp.ssp_capture_start.argtypes = [POINTER(SspCommand), c_ulong]
+eSSP.essp.ssp6_decode_poll.argtypes = [c_char_p, c_ubyte, POINTER(SspPollData6)]
+eSSP.essp.ssp6_decode_poll.restype = None
+# Upper bounds of the round trip buckets, in seconds, as the library counts them
+eSSP.RTT_BOUNDS = tuple(bound / 1e6 for bound in (c_ulong * (RTT_BUCKETS - 1)).in_dll(eSSP.essp, "SSPRttBounds"))
+eSSP.essp.ssp6_set_baud_rate.argtypes = [POINTER(SspCommand), c_ulong, c_ubyte]
+eSSP.essp.set_ssp_port_baud.argtypes = [POINTER(SspCommand), c_ulong]
+eSSP.essp.open_ssp_port.argtypes = [POINTER(SspCommand), c_char_p]
+eSSP.essp.GetPortError.restype = c_char_p
+eSSP.essp.ssp_port_reconnects.argtypes = [POINTER(SspCommand)]
+eSSP.essp.ssp_port_reconnects.restype = c_ulong
+eSSP.essp.close_ssp_port.restype = None
+eSSP.essp.reset_ssp_session.restype = None
+eSSP.essp.detach_ssp_port.restype = None
+eSSP.essp.ssp_init_shared.argtypes = [POINTER(SspCommand), c_char_p]
+eSSP.essp.ssp_init_shared.restype = POINTER(SspCommand)
+eSSP.essp.DownloadFileToPort.argtypes = [POINTER(SspCommand), c_char_p, c_char_p, c_ubyte, DownloadCallback]
+eSSP.essp.DownloadFileToPort.restype = c_ulong
+for _aes in (eSSP.essp.aes_encrypt, eSSP.essp.aes_decrypt):
+    _aes.argtypes = [c_ubyte, c_char_p, c_ulong, c_void_p, c_ulong, POINTER(c_ubyte), POINTER(c_ubyte), c_ulong]
+# Counters shared with the worker process
+eSSP.essp.ssp_load_acquire.argtypes = [c_void_p]
+eSSP.essp.ssp_load_acquire.restype = c_ulonglong
+eSSP.essp.ssp_store_release.argtypes = [c_void_p, c_ulonglong]
+eSSP.essp.ssp_store_release.restype = None
+eSSP.essp.ssp_fence.restype = None
+from .aio import AsyncESSP
+from .worker import WorkerESSP
+from .bus import SSPBus
+from .daemon import ESSPDaemon, ESSPClient
+from .trace import TraceRing, TraceSampler
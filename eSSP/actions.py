@@ -0,0 +1,202 @@
+import threading
+from collections import deque
+from time import monotonic
+from .constants import Actions
+from .errors import ActionExpired
+
+# Priority classes, the lower the sooner
+MONEY = 0       # notes moving out of the unit
+CONTROL = 1     # what the unit accepts and where the notes go
+INVENTORY = 2   # levels and counts
+COSMETIC = 3    # bezel colour
+
+CLASS_NAMES = ("money", "control", "inventory", "cosmetic")
+
+PRIORITY = {
+    Actions.PAYOUT: MONEY,
+    Actions.EMPTY_STORAGE: MONEY,
+    Actions.ENABLE_VALIDATOR: CONTROL,
+    Actions.DISABLE_VALIDATOR: CONTROL,
+    Actions.DISABLE_PAYOUT: CONTROL,
+    Actions.ROUTE_TO_CASHBOX: CONTROL,
+    Actions.ROUTE_TO_STORAGE: CONTROL,
+    Actions.DOWNLOAD: CONTROL,
+    Actions.UPDATE_PAYOUT: INVENTORY,
+    Actions.GET_NOTE_AMOUNT: INVENTORY,
+    Actions.CONFIGURE_BEZEL: COSMETIC,
+}
+
+
+def coalesce_key(action):
+    """Queued actions with the same key repeat or undo each other, only the latest needs sending; None never coalesces"""
+    kind = action["action"]
+    if kind in (Actions.ENABLE_VALIDATOR, Actions.DISABLE_VALIDATOR):
+        return "validator"
+    if kind in (Actions.ROUTE_TO_CASHBOX, Actions.ROUTE_TO_STORAGE):
+        return ("route", action["amount"], action["currency"])
+    if kind == Actions.GET_NOTE_AMOUNT:
+        return ("level", action["amount"], action["currency"])
+    if kind in (Actions.UPDATE_PAYOUT, Actions.CONFIGURE_BEZEL, Actions.DISABLE_PAYOUT):
+        return kind
+    return None
+
+
+def _follow(future, winner):
+    """Settle the future of a coalesced action like the one that replaced it"""
+    if winner.cancelled():
+        future.cancel()
+        return
+    if not future.set_running_or_notify_cancel():
+        return
+    if winner.exception() is not None:
+        future.set_exception(winner.exception())
+    else:
+        future.set_result(winner.result())
+
+
+class _Entry(object):
+    __slots__ = ("action", "priority", "key", "queued", "deadline")
+
+    def __init__(self, action, priority, key, queued, deadline):
+        self.action = action
+        self.priority = priority
+        self.key = key
+        self.queued = queued
+        self.deadline = deadline
+
+
+class ActionQueue(object):
+    """Actions waiting for the poll loop, most urgent first
+
+    Payouts go before route and enable changes, those before inventory
+    reads, bezel colours last; first in, first out within a class. An action
+    queued while one with the same coalesce_key() waits takes its place in
+    the line: the same action again shares the waiting one's result, an
+    opposite one (disable after enable, another route) cancels it. Actions
+    can carry a deadline, they fail with ActionExpired when it passes before
+    they are sent. A class head that has waited `starve_after` seconds goes
+    first whatever its class, so a stream of payouts can't hold the rest
+    back for ever. take() is called at most `per_poll` times between polls.
+    """
+
+    def __init__(self, per_poll=4, starve_after=2.0):
+        if per_poll < 1:
+            raise ValueError("per_poll must be at least 1")
+        self.per_poll = per_poll
+        self.starve_after = starve_after
+        self._queues = tuple(deque() for _ in CLASS_NAMES)
+        self._keyed = {}
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.cancelled = 0
+        self.expired = 0
+        self.starved = 0
+        self.wait_max = [0.0] * len(CLASS_NAMES)
+
+    def put(self, action, deadline=None):
+        """Queue a dict action (its "future" settled by whoever runs it), deadline in seconds from now"""
+        now = monotonic()
+        priority = PRIORITY.get(action["action"], CONTROL)
+        key = coalesce_key(action)
+        replaced = None
+        with self._lock:
+            self.queued += 1
+            entry = self._keyed.get(key) if key is not None else None
+            if entry is not None:
+                # Keeps its place in the line, with the latest arguments
+                replaced, entry.action = entry.action, action
+                entry.deadline = now + deadline if deadline is not None else None
+                self.coalesced += 1
+            else:
+                entry = _Entry(action, priority, key, now, now + deadline if deadline is not None else None)
+                self._queues[priority].append(entry)
+                if key is not None:
+                    self._keyed[key] = entry
+        if replaced is not None:
+            old, new = replaced.get("future"), action.get("future")
+            if old is not None:
+                if new is not None and replaced["action"] == action["action"]:
+                    new.add_done_callback(lambda winner: _follow(old, winner))
+                else:
+                    old.cancel()
+
+    def take(self):
+        """The next action to send, None when there is none"""
+        now = monotonic()
+        expired = []
+        try:
+            with self._lock:
+                while True:
+                    entry = self._head(now)
+                    if entry is None:
+                        return None
+                    self._queues[entry.priority].popleft()
+                    if self._keyed.get(entry.key) is entry:
+                        del self._keyed[entry.key]
+                    future = entry.action.get("future")
+                    if future is not None and future.cancelled():
+                        self.cancelled += 1
+                        continue
+                    if entry.deadline is not None and now > entry.deadline:
+                        self.expired += 1
+                        expired.append(future)
+                        continue
+                    self.sent += 1
+                    waited = now - entry.queued
+                    self.wait_max[entry.priority] = max(self.wait_max[entry.priority], waited)
+                    return entry.action
+        finally:
+            # Outside the lock, done callbacks may queue actions again
+            for future in expired:
+                if future is not None and future.set_running_or_notify_cancel():
+                    future.set_exception(ActionExpired("Not sent before its deadline"))
+
+    def _head(self, now):
+        heads = [queue[0] for queue in self._queues if queue]
+        if not heads:
+            return None
+        oldest = min(heads, key=lambda entry: entry.queued)
+        if oldest is not heads[0] and now - oldest.queued >= self.starve_after:
+            self.starved += 1
+            return oldest
+        return heads[0]
+
+    def empty(self):
+        with self._lock:
+            return not any(self._queues)
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(queue) for queue in self._queues)
+
+    def cancel_all(self):
+        """Cancel everything still waiting, return how many were"""
+        with self._lock:
+            entries = [entry for queue in self._queues for entry in queue]
+            for queue in self._queues:
+                queue.clear()
+            self._keyed.clear()
+        cancelled = 0
+        for entry in entries:
+            future = entry.action.get("future")
+            if future is not None and future.cancel():
+                cancelled += 1
+        with self._lock:
+            self.cancelled += cancelled
+        return cancelled
+
+    def stats(self):
+        with self._lock:
+            return {
+                "waiting": {name: len(queue) for name, queue in zip(CLASS_NAMES, self._queues)},
+                "queued": self.queued,
+                "sent": self.sent,
+                "coalesced": self.coalesced,
+                "cancelled": self.cancelled,
+                "expired": self.expired,
+                "starved": self.starved,
+                "wait_max": dict(zip(CLASS_NAMES, self.wait_max)),
+                "per_poll": self.per_poll,
+            }
@@ -0,0 +1,185 @@
+import asyncio
+from functools import partial
+from time import monotonic
+from .eSSP import eSSP, DEFAULT_CURRENCY
+from .constants import Actions, LinkState
+from .events import DROP_NEWEST, DROP_OLDEST
+from .trace import link_log
+
+
+class AsyncESSP(object):
+    """asyncio front end for eSSP
+
+    The unit is polled from a task on the running loop; every blocking ctypes
+    call runs in the loop's default executor, serialised by a per-unit lock, so
+    one loop can drive many units. Create it with `await AsyncESSP.create(...)`.
+    Actions go through the unit's ActionQueue like eSSP's, sent by the poll
+    task between polls: most urgent first, with deadlines, and cancelling the
+    awaiting task takes an action out of the queue.
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.loop = asyncio.get_running_loop()
+        self.scheduler = device.scheduler
+        self._lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._subscribers = set()
+        # Events lost to subscribers that fell behind, by the bus's overflow policy
+        self.dropped = 0
+        device.subscribe(self._on_event)
+        self._task = None
+        self.error = None
+
+    @classmethod
+    async def create(cls, com_port, **kwargs):
+        """Open and set up the unit off the loop, then start polling it"""
+        loop = asyncio.get_running_loop()
+        device = await loop.run_in_executor(None, partial(eSSP, com_port, threaded=False, **kwargs))
+        validator = cls(device)
+        validator._task = loop.create_task(validator._poll_loop())
+        return validator
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def _call(self, func, *args):
+        async with self._lock:
+            return await self.loop.run_in_executor(None, func, *args)
+
+    async def _poll_loop(self):
+        try:
+            deadline = monotonic()
+            while True:
+                self.scheduler.polled(deadline)
+                try:
+                    await self._call(self.device.poll_once)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    # Whatever the unit answered, starting the session again is the way back
+                    link_log.warning("Poll of %s failed: %s", self.device.com_port, e)
+                    self.device._set_link(LinkState.DOWN)
+                if self.device.link_state != LinkState.UP:
+                    # Reconnecting with backoff, close() stops it
+                    if not await self._call(self.device.recover):
+                        return
+                waiting = len(self.device.actions)
+                if waiting:
+                    # Queued by the action methods, or by the poll parsing itself, e.g. re-enable
+                    await self._call(self.device.do_actions)
+                    if 0 < len(self.device.actions) < waiting:
+                        # The rest after the next poll, which comes at once
+                        self._wakeup.set()
+                deadline = self.scheduler.due(self.device.busy)
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), max(deadline - monotonic(), 0))
+                    # Counted as woken early, like the threaded poll
+                    self.scheduler.wake()
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.error = e
+            for subscriber in self._subscribers:
+                # The end has to get through, whatever the policy
+                self._put(subscriber, None, DROP_OLDEST)
+
+    def _on_event(self, event):
+        # Runs in the executor thread doing the poll
+        self.loop.call_soon_threadsafe(self._dispatch_event, event)
+
+    def _dispatch_event(self, event):
+        overflow = self.device.events.overflow
+        for subscriber in self._subscribers:
+            self._put(subscriber, event, overflow)
+
+    def _put(self, subscriber, item, overflow):
+        if subscriber.full():
+            self.dropped += 1
+            if overflow == DROP_NEWEST:
+                return
+            subscriber.get_nowait()
+        subscriber.put_nowait(item)
+
+    async def events(self):
+        """Async iterator over (note, event) tuples as the unit reports them
+
+        Each iterator queues as many events as the unit's EventBus holds, and
+        drops and counts the same way when it falls behind.
+        """
+        subscriber = asyncio.Queue(self.device.events.maxlen)
+        self._subscribers.add(subscriber)
+        try:
+            while True:
+                event = await subscriber.get()
+                if event is None:
+                    raise self.error
+                yield event
+        finally:
+            self._subscribers.discard(subscriber)
+
+    async def _action(self, deadline=None, **queued_action):
+        future = self.device.queue_action(queued_action, deadline)
+        self._wakeup.set()
+        result = await asyncio.wrap_future(future)
+        # Poll soon, the unit is likely to report on what it has just been asked
+        self._wakeup.set()
+        return result
+
+    async def payout(self, amount, currency=DEFAULT_CURRENCY, test=False, deadline=None):
+        # Raises PayoutError without a round trip when the stored notes can't make the amount
+        return await self._action(deadline, **self.device.payout_action(amount, currency, test))
+
+    async def set_route_cashbox(self, amount, currency=DEFAULT_CURRENCY, deadline=None):
+        return await self._action(deadline, action=Actions.ROUTE_TO_CASHBOX, amount=amount*100, currency=currency)
+
+    async def set_route_storage(self, amount, currency=DEFAULT_CURRENCY, deadline=None):
+        return await self._action(deadline, action=Actions.ROUTE_TO_STORAGE, amount=amount*100, currency=currency)
+
+    async def get_note_amount(self, amount, currency=DEFAULT_CURRENCY, deadline=None):
+        return await self._action(deadline, action=Actions.GET_NOTE_AMOUNT, amount=amount*100, currency=currency)
+
+    async def empty_storage(self, deadline=None):
+        return await self._action(deadline, action=Actions.EMPTY_STORAGE)
+
+    async def enable_validator(self, deadline=None):
+        return await self._action(deadline, action=Actions.ENABLE_VALIDATOR)
+
+    async def disable_validator(self, deadline=None):
+        return await self._action(deadline, action=Actions.DISABLE_VALIDATOR)
+
+    async def disable_payout(self, deadline=None):
+        return await self._action(deadline, action=Actions.DISABLE_PAYOUT)
+
+    async def update_payout(self, deadline=None):
+        return await self._action(deadline, action=Actions.UPDATE_PAYOUT)
+
+    async def refresh_inventory(self, deadline=None):
+        return await self._action(deadline, action=Actions.UPDATE_PAYOUT)
+
+    async def configure_bezel(self, red, green, blue, volatile=0, deadline=None):
+        return await self._action(deadline, action=Actions.CONFIGURE_BEZEL, red=red, green=green, blue=blue, volatile=volatile)
+
+    async def download_file(self, path, progress=None, block_retries=3, deadline=None):
+        """See eSSP.download_file, progress is called from the executor thread"""
+        return await self._action(deadline, action=Actions.DOWNLOAD, path=path, progress=progress, block_retries=block_retries)
+
+    async def close(self):
+        """Stop polling and close the connection"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self._call(self.device.close)
+
+    def __str__(self):
+        return str(self.device)
@@ -0,0 +1,222 @@
+import threading
+from time import monotonic
+from .eSSP import eSSP
+from .constants import LinkState
+from .trace import link_log
+
+
+class BusDevice(eSSP):
+    """eSSP for one address of an SSPBus, talked to by the bus thread only"""
+
+    def __init__(self, bus, ssp_address, **kwargs):
+        self.bus = bus
+        self.ssp_address = ssp_address
+        # Kept by the bus: next turn due, last turn, time on the line, worst poll gap and lateness
+        self.due_at = monotonic()
+        self.served_at = 0.0
+        self.line_time = 0.0
+        self.last_poll = None
+        self.max_poll_gap = 0.0
+        self.max_late = 0.0
+        self._retry_delay = None
+        super().__init__(bus.com_port, ssp_address=ssp_address, threaded=False, **kwargs)
+
+    def _open_port(self, ssp_address):
+        return self.essp.ssp_init_shared(self.bus.sspC, ssp_address.encode())
+
+    def _reopen_port(self):
+        # The line stays open for the others, only this address starts afresh
+        self.essp.reset_ssp_session(self.sspC)
+        return True
+
+    def _release_port(self):
+        self.essp.detach_ssp_port(self.sspC)
+
+    def queue_action(self, queued_action, deadline=None):
+        future = super().queue_action(queued_action, deadline)
+        self.bus.wake()
+        return future
+
+    def download_file(self, path, progress=None, block_retries=3, deadline=None):
+        """Not on a bus: the transfer closes and opens again the port the other addresses share"""
+        raise NotImplementedError("Download to a unit on a port of its own, not on a bus")
+
+    def reject(self):
+        with self.bus.lock:
+            super().reject()
+
+    def reset(self):
+        with self.bus.lock:
+            super().reset()
+
+    def close(self):
+        """Leave the bus and close the session, the port stays open for the others"""
+        self.bus._detach(self)
+        with self.bus.lock:
+            super().close()
+
+
+class SSPBus(object):
+    """One serial port shared by several SSP addresses on a multi-drop line
+
+        bus = SSPBus("/dev/ttyUSB0")
+        validator = bus.add("0", route_to_storage=2000)
+        hopper = bus.add("16")
+
+    Every device is an eSSP of its own (events, actions, inventory), but one
+    bus thread does all the talking. A turn polls one device and sends up to
+    its actions_per_poll queued actions; the next turn goes to the device
+    whose poll is due first, the one served longest ago on a tie, and a
+    device with actions waiting is due at once. A device that stops
+    answering is reconnected one attempt per turn, with backoff, and the
+    others are polled in between. A turn on such a device costs the command
+    timeout times the retries, about 3 s, which bounds how late anyone else's
+    poll can be: below the poll watchdog. The line has one rate, 9600 baud.
+    """
+
+    def __init__(self, com_port, debug=False):
+        self.com_port = com_port
+        self.debug = debug
+        # Only holds the port, the devices each talk through a command of their own
+        self.sspC = eSSP.essp.ssp_init(com_port.encode(), b"0", debug)
+        if not self.sspC:
+            link_log.error("Can't open port %s: %s", com_port, eSSP.essp.GetPortError().decode(errors="replace"))
+            raise Exception("Can't open port %s" % com_port)
+        # Held for every exchange on the line
+        self.lock = threading.RLock()
+        # Copied on change, the bus thread goes through it without the lock
+        self.devices = ()
+        self.turns = 0
+        self.line_time = 0.0
+        self.started = monotonic()
+        self._wakeup = threading.Event()
+        self._closing = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def add(self, ssp_address="0", **kwargs):
+        """Set up the unit at ssp_address and start polling it, return its eSSP; takes eSSP's arguments"""
+        for name in ("baud_rate", "threaded"):
+            if name in kwargs:
+                raise ValueError("%s is the bus's, not a device's" % name)
+        with self.lock:
+            # Under the lock, two threads adding the same address can't both get through
+            if any(device.ssp_address == ssp_address for device in self.devices):
+                raise ValueError("Address %s is on the bus already" % ssp_address)
+            start = monotonic()
+            try:
+                device = BusDevice(self, ssp_address, debug=kwargs.pop("debug", self.debug), **kwargs)
+            finally:
+                self.line_time += monotonic() - start
+            self.devices += (device,)
+        self.wake()
+        return device
+
+    def _detach(self, device):
+        with self.lock:
+            self.devices = tuple(d for d in self.devices if d is not device)
+
+    def wake(self):
+        self._wakeup.set()
+
+    def _next(self, now):
+        """The device to serve next and when it is due"""
+        best = None
+        for device in self.devices:
+            due = device.due_at
+            if device.link_state == LinkState.UP and device.scheduler.woken():
+                due = min(due, now)
+            if best is None or (due, device.served_at) < (best[1], best[0].served_at):
+                best = (device, due)
+        return best
+
+    def _run(self):
+        while not self._closing.is_set():
+            now = monotonic()
+            best = self._next(now)
+            if best is None or best[1] > now:
+                self._wakeup.wait(best[1] - now if best is not None else None)
+                self._wakeup.clear()
+                continue
+            self._turn(*best)
+
+    def _turn(self, device, due):
+        start = monotonic()
+        with self.lock:
+            if device not in self.devices:
+                return
+            device.max_late = max(device.max_late, start - due)
+            if device.link_state == LinkState.UP:
+                self._poll(device, start)
+            else:
+                self._reconnect(device)
+        end = monotonic()
+        self.turns += 1
+        self.line_time += end - start
+        device.line_time += end - start
+        device.served_at = end
+        if device.link_state == LinkState.UP:
+            device.due_at = device.scheduler.due(device.busy)
+        elif device.link_state == LinkState.DOWN:
+            device.due_at = end
+
+    def _poll(self, device, start):
+        if device.last_poll is not None:
+            device.max_poll_gap = max(device.max_poll_gap, start - device.last_poll)
+        device.last_poll = start
+        device.scheduler.polled(device.due_at)
+        try:
+            device.poll_once()
+        except Exception as e:
+            link_log.warning("Poll of %s at %s failed: %s", device.com_port, device.ssp_address, e)
+            device._set_link(LinkState.DOWN)
+        if device.link_state == LinkState.UP:
+            device.do_actions()
+        else:
+            device.last_poll = None
+
+    def _reconnect(self, device):
+        device._set_link(LinkState.RECONNECTING)
+        device.reconnects += 1
+        if device.reconnect():
+            device._set_link(LinkState.UP)
+            device._retry_delay = None
+            return
+        delay = device._retry_delay or device.reconnect_delay
+        device.due_at = monotonic() + delay
+        device._retry_delay = min(delay * 2, device.reconnect_max_delay)
+
+    def stats(self):
+        """Share of the time the line was in use, and per address its share, polls and worst delays"""
+        elapsed = monotonic() - self.started
+        return {
+            "utilisation": self.line_time / elapsed if elapsed else 0.0,
+            "turns": self.turns,
+            "devices": {
+                device.ssp_address: {
+                    "link": str(device.link_state),
+                    "polls": device.scheduler.polls,
+                    "utilisation": device.line_time / elapsed if elapsed else 0.0,
+                    "max_poll_gap": device.max_poll_gap,
+                    "max_late": device.max_late,
+                    "reconnects": device.reconnects,
+                }
+                for device in self.devices
+            },
+        }
+
+    def close(self):
+        """Stop the bus thread, close every device, then the port"""
+        self._closing.set()
+        self.wake()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        for device in self.devices:
+            device.close()
+        eSSP.essp.close_ssp_port(self.sspC)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
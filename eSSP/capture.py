@@ -0,0 +1,63 @@
+import json
+import struct
+from typing import NamedTuple
+
+MAGIC = b"ESSPCAP1"
+
+TX = 0
+RX = 1
+
+# PORT_STATUS of SSPComs.h, the outcome of a reply
+PORT_ERROR = 2
+REPLY_OK = 3
+PACKET_ERROR = 4
+TIMEOUT = 5
+
+STATUS_NAMES = {PORT_ERROR: "port error", REPLY_OK: "ok", PACKET_ERROR: "packet error", TIMEOUT: "timeout"}
+
+# time in us, direction, address and seq bit, status, data length
+RECORD = struct.Struct("<QBBBB")
+
+
+class Frame(NamedTuple):
+    """One plain frame of a capture, command data before encryption or reply data after it"""
+    time: float  # seconds, monotonic
+    direction: int
+    address: int
+    status: int
+    data: bytes
+
+    def __str__(self):
+        return "%12.6f %s %02X %-12s %s" % (self.time, "TX" if self.direction == TX else "RX", self.address,
+                                            STATUS_NAMES.get(self.status, self.status), self.data.hex(" "))
+
+
+def write_capture(path, frames, header=None):
+    """Frames to a compact binary file: magic, JSON header, then one short record per frame"""
+    header = json.dumps(header or {}).encode()
+    with open(path, "wb") as f:
+        f.write(MAGIC + struct.pack("<I", len(header)) + header)
+        for frame in frames:
+            f.write(RECORD.pack(int(frame.time * 1e6), frame.direction, frame.address, frame.status, len(frame.data)))
+            f.write(frame.data)
+    return len(frames)
+
+
+def read_capture(path):
+    """(header, frames) of a file written by write_capture"""
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError("%s is not a capture" % path)
+    offset = len(MAGIC)
+    size, = struct.unpack_from("<I", data, offset)
+    offset += 4
+    header = json.loads(data[offset:offset + size])
+    offset += size
+    frames = []
+    while offset + RECORD.size <= len(data):
+        time, direction, address, status, length = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        frames.append(Frame(time / 1e6, direction, address, status, data[offset:offset + length]))
+        offset += length
+    return header, frames
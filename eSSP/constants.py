@@ -49,6 +49,7 @@ class Status(Enum):
     SSP_POLL_RESET = 0xF1, "Reset"                      # The device has undergone a power reset.
     SSP_POLL_KEY_NOT_SET = 0xFA, "Key not set"          # The slave is in encrypted communication mode but the encryption keys have not been negotiated.
     SSP6_OPTION_BYTE_DO = 0x58, "Option Byte DO"
+    SSP6_OPTION_BYTE_TEST = 0x19, "Option Byte TEST"
     NO_EVENT = 0xF9, "No event"
 
     def __int__(self):
@@ -63,6 +64,36 @@ class Status(Enum):
     def __ne__(self, other):
         return self.value != other
 
+class Response(Enum):
+    _init_ = 'value', 'debug_message'
+
+    OK = 0xF0, "Ok"
+    UNKNOWN_COMMAND = 0xF2, "Command not known"
+    INCORRECT_PARAMETERS = 0xF3, "Wrong number of parameters"
+    INVALID_PARAMETER = 0xF4, "Parameter out of range"
+    COMMAND_NOT_PROCESSED = 0xF5, "Command cannot be processed"
+    SOFTWARE_ERROR = 0xF6, "Software error"
+    CHECKSUM_ERROR = 0xF7, "Checksum error"
+    FAILURE = 0xF8, "Failure"
+    HEADER_FAILURE = 0xF9, "Header failure"
+    KEY_NOT_SET = 0xFA, "Key not set"
+    TIMEOUT = 0xFF, "Timeout"
+
+    def __int__(self):
+        return self.value
+
+    def __str__(self):
+        return self.debug_message
+
+    def __eq__(self, other):
+        return self.value == other
+
+    def __ne__(self, other):
+        return self.value != other
+
+    def __hash__(self):
+        return self.value
+
 class PayoutResponse(Enum):
     _init_ = 'value', 'debug_message'
 
@@ -122,6 +153,7 @@ class Actions(Enum):
     EMPTY_STORAGE = 9, "Empty storage & cleaning indexes"
     CONFIGURE_BEZEL = 10, "Configure bezel color"
     UPDATE_PAYOUT = 11, "Update payout status"
+    DOWNLOAD = 12, "Download file"
 
     def __int__(self):
         return self.value
@@ -135,6 +167,9 @@ class Actions(Enum):
     def __ne__(self, other):
         return self.value != other
 
+    def __hash__(self):
+        return self.value
+
 class UnitType(Enum):
     _init_ = 'value', 'debug_message'
 
@@ -163,6 +198,51 @@ class UnitType(Enum):
     def __hash__(self):
         return self.value
 
+class Command(Enum):
+    _init_ = 'value', 'debug_message'
+
+    RESET = 0x01, "Reset"
+    SET_INHIBITS = 0x02, "Set inhibits"
+    SETUP_REQUEST = 0x05, "Setup request"
+    HOST_PROTOCOL = 0x06, "Host protocol version"
+    PROGRAM = 0x0B, "Program"
+    POLL = 0x07, "Poll"
+    REJECT_NOTE = 0x08, "Reject note"
+    DISABLE = 0x09, "Disable"
+    ENABLE = 0x0A, "Enable"
+    SERIAL_NUMBER = 0x0C, "Get serial number"
+    UNIT_DATA = 0x0D, "Unit data"
+    SYNC = 0x11, "Sync"
+    GET_ALL_LEVELS = 0x22, "Get all levels"
+    PAYOUT_AMOUNT = 0x33, "Payout amount"
+    GET_NOTE_AMOUNT = 0x35, "Get note amount"
+    SET_ROUTING = 0x3B, "Set denomination route"
+    GET_ROUTING = 0x3C, "Get denomination route"
+    EMPTY = 0x3F, "Empty all"
+    SET_GENERATOR = 0x4A, "Set generator"
+    SET_MODULUS = 0x4B, "Set modulus"
+    REQUEST_KEY_EXCHANGE = 0x4C, "Request key exchange"
+    SET_BAUD_RATE = 0x4D, "Set baud rate"
+    SMART_EMPTY = 0x52, "Smart empty"
+    CONFIGURE_BEZEL = 0x54, "Configure bezel"
+    DISABLE_PAYOUT = 0x5B, "Disable payout device"
+    ENABLE_PAYOUT = 0x5C, "Enable payout device"
+
+    def __int__(self):
+        return self.value
+
+    def __str__(self):
+        return self.debug_message
+
+    def __eq__(self, other):
+        return self.value == other
+
+    def __ne__(self, other):
+        return self.value != other
+
+    def __hash__(self):
+        return self.value
+
 class Route(Enum):
     _init_ = 'value', 'debug_message'
 
@@ -175,6 +255,64 @@ class Route(Enum):
     def __str__(self):
         return self.debug_message
 
+class DownloadStatus(Enum):
+    _init_ = 'value', 'debug_message'
+
+    # What DownloadFileToPort returns
+    COMPLETE = 0x100000, "Download complete"
+    OPEN_FILE_ERROR = 0x100001, "Can't open the file"
+    READ_FILE_ERROR = 0x100002, "Can't read the file"
+    NOT_ITL_FILE = 0x100003, "Not an ITL file"
+    PORT_OPEN_FAIL = 0x100004, "Can't open the port again"
+    SYNC_CONNECTION_FAIL = 0x100005, "Sync failed"
+    SECURITY_PROTECTED_FILE = 0x100006, "Security protected file"
+    IN_PROGRESS = 0x100007, "Another download is in progress"
+    DATA_TRANSFER_FAIL = 0x100010, "Data transfer failed"
+    PROG_COMMAND_FAIL = 0x100011, "Program command refused"
+    HEADER_FAIL = 0x100012, "Header refused"
+    PROG_STATUS_FAIL = 0x100013, "Program status failed"
+    PROG_RESET_FAIL = 0x100014, "Program reset failed"
+    DOWNLOAD_NOT_ALLOWED = 0x100015, "Download not allowed"
+    HI_TRANSFER_SPEED_FAIL = 0x100016, "High transfer speed failed"
+
+    def __int__(self):
+        return self.value
+
+    def __str__(self):
+        return self.debug_message
+
+    def __eq__(self, other):
+        return self.value == other
+
+    def __ne__(self, other):
+        return self.value != other
+
+    def __hash__(self):
+        return self.value
+
+class LinkState(Enum):
+    _init_ = 'value', 'debug_message'
+
+    # Published as events like the poll events, above their byte range
+    UP = 0x100, 'Link up'
+    DOWN = 0x101, 'Link down'
+    RECONNECTING = 0x102, 'Reconnecting'
+
+    def __int__(self):
+        return self.value
+
+    def __str__(self):
+        return self.debug_message
+
+    def __eq__(self, other):
+        return self.value == other
+
+    def __ne__(self, other):
+        return self.value != other
+
+    def __hash__(self):
+        return self.value
+
 if __name__ == "__main__":
     print(FailureStatus.SENSOR_FLAP == 1)
     print(FailureStatus(1))
@@ -0,0 +1,576 @@
+# !/usr/bin/env python3
+"""Own cash units in one long-lived process and serve them to local clients
+
+    PYTHONPATH=. python3 -m eSSP.daemon --socket /run/essp.sock --unit validator=/dev/ttyACM0
+    PYTHONPATH=. python3 -m eSSP.daemon --socket /run/essp.sock --config units.json --worker
+
+The units are set up once and stay open; applications connect to the Unix
+socket with ESSPClient, or anything that writes JSON lines:
+
+    {"id": 1, "unit": "validator", "call": "payout", "args": [100]}
+    {"id": 1, "ok": true, "result": true}
+
+Every request is one object on a line, answered by one with the same id once
+its result is in, so answers can come out of order. Queued actions answer
+when the unit has run them; "status", "can_pay", "plan_payout" and the
+schedule and queue stats are answered from memory without touching the
+line, though a --worker unit's stats are a round trip to its process.
+After {"call": "subscribe"} the unit's events are pushed as they come:
+
+    {"unit": "validator", "event": "Credit note", "code": 238, "note": {"value": 100, "currency": "RUB"}}
+
+A client that reads slower than events come loses the oldest of them, and
+hears how many it lost from a {"dropped": n} line; answers are never dropped.
+Closing a client never closes or rejects anything on the unit.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import signal
+import socket
+import stat
+import threading
+from collections import deque
+from concurrent.futures import Future, InvalidStateError
+from dataclasses import fields, is_dataclass
+from functools import partial
+
+from . import errors
+from .constants import LinkState, Route, Response, PayoutResponse, DownloadStatus
+from .eSSP import eSSP, Channel, Event, Note, POLL_STATUS, DEFAULT_CURRENCY
+from .events import EventBus, DROP_OLDEST
+from .worker import WorkerESSP
+
+# Forwarded to the unit, answered when the action has run
+QUEUED = WorkerESSP.QUEUED
+# Answered from what the daemon has in memory, at once; a worker unit's stats
+# are in its process, a round trip away, and go the SYNCHRONOUS way
+CACHED = ("status", "can_pay", "plan_payout", "poll_stats", "action_stats")
+# Forwarded and run off the event loop, they may wait on the port
+SYNCHRONOUS = ("metrics", "tx_stats", "reject", "reset")
+
+ERRORS = {cls.__name__: cls for cls in (errors.SSPError, errors.PayoutError, errors.DownloadError, errors.ActionExpired,
+                                        ValueError, TypeError, AttributeError, KeyError, TimeoutError)}
+
+
+def _line(message):
+    return json.dumps(message, separators=(",", ":")).encode() + b"\n"
+
+
+def _plain(value):
+    """value in JSON terms: notes and channels as objects, enums as their numbers"""
+    if value is None or isinstance(value, (bool, str, float)):
+        return value
+    if isinstance(value, Note):
+        return {"value": value.value, "currency": value.currency}
+    if isinstance(value, int):
+        return int(value)
+    if hasattr(value, "_asdict"):
+        return {key: _plain(item) for key, item in value._asdict().items()}
+    if is_dataclass(value):
+        return {field.name: _plain(getattr(value, field.name)) for field in fields(value)}
+    if isinstance(value, dict):
+        if all(isinstance(key, (str, int)) for key in value):
+            return {str(key): _plain(item) for key, item in value.items()}
+        return [[_plain(key), _plain(item)] for key, item in value.items()]
+    if isinstance(value, (list, tuple, set)):
+        return [_plain(item) for item in value]
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return str(value)
+
+
+def unit_status(device):
+    """What is known of a unit without asking it: link, levels, cashbox, busy, polls"""
+    if isinstance(device, WorkerESSP):
+        # One read of the worker's snapshot
+        status = device.status()
+        storage, stacked, busy, polls, link = status.storage, status.stacked, status.busy, status.polls, LinkState.UP
+    else:
+        storage, stacked, busy, polls, link = dict(device.storage), device.stacked, device.busy, device.scheduler.polls, device.link_state
+    return {
+        "link": int(link),
+        "unit": int(device.unit),
+        "stacked": stacked,
+        "busy": busy,
+        "polls": polls,
+        "storage": {str(number): {"value": channel.note.value, "currency": channel.note.currency, "amount": channel.amount,
+                                  "route": None if channel.route is None else int(channel.route)}
+                    for number, channel in storage.items()},
+    }
+
+
+def _error(call_id, error):
+    reply = {"id": call_id, "ok": False, "error": type(error).__name__, "message": str(error)}
+    for attribute in ("response", "reason", "status"):
+        value = getattr(error, attribute, None)
+        if value is not None:
+            reply[attribute] = _plain(value)
+    return reply
+
+
+class _Client(object):
+    """One connection: its subscriptions and what is waiting to be written to it"""
+
+    def __init__(self, writer, maxlen):
+        self.writer = writer
+        self.maxlen = maxlen
+        # unit name -> set of event codes, None for all
+        self.subscriptions = {}
+        self.replies = deque()
+        self.events = deque()
+        self.dropped = 0
+        self._pending = asyncio.Event()
+
+    def wants(self, unit, event):
+        if unit not in self.subscriptions:
+            return False
+        codes = self.subscriptions[unit]
+        return codes is None or int(event) in codes
+
+    def reply(self, message):
+        self.replies.append(_line(message))
+        self._pending.set()
+
+    def push_event(self, line):
+        if len(self.events) >= self.maxlen:
+            self.events.popleft()
+            self.dropped += 1
+        self.events.append(line)
+        self._pending.set()
+
+    async def write_loop(self):
+        # While drain() waits on a slow reader the events pile up here, bounded
+        while True:
+            await self._pending.wait()
+            self._pending.clear()
+            while self.replies or self.events:
+                lines = list(self.replies)
+                self.replies.clear()
+                if self.dropped:
+                    lines.append(_line({"dropped": self.dropped}))
+                    self.dropped = 0
+                lines.extend(self.events)
+                self.events.clear()
+                self.writer.write(b"".join(lines))
+                await self.writer.drain()
+
+
+class ESSPDaemon(object):
+    """Serve open units to the clients of a Unix socket, JSON lines both ways
+
+    `units` maps names to eSSP or WorkerESSP objects, which stay the
+    caller's: close() stops serving and leaves them open. Each client gets
+    up to `client_queue_size` events buffered, then loses the oldest.
+    """
+
+    def __init__(self, units, path, client_queue_size=1024, mode=0o660):
+        if not units:
+            raise ValueError("No units to serve")
+        self.units = dict(units)
+        self.default_unit = next(iter(self.units))
+        self.path = path
+        self.mode = mode
+        self.client_queue_size = client_queue_size
+        self.clients = set()
+        self.requests = 0
+        self.loop = None
+        self._server = None
+        self._thread = None
+        self._listening = threading.Event()
+        self._callbacks = {}
+        for name, device in self.units.items():
+            self._callbacks[name] = partial(self._on_event, name)
+            device.subscribe(self._callbacks[name])
+
+    def _on_event(self, name, item):
+        # From the poll thread, the clients belong to the loop
+        loop = self.loop
+        if loop is not None and self.clients:
+            loop.call_soon_threadsafe(self._publish, name, item)
+
+    def _publish(self, name, item):
+        line = None
+        for client in self.clients:
+            if client.wants(name, item.event):
+                if line is None:
+                    line = _line({"unit": name, "event": str(item.event), "code": int(item.event), "note": _plain(item.note)})
+                client.push_event(line)
+
+    def _unlink_stale(self):
+        try:
+            if not stat.S_ISSOCK(os.stat(self.path).st_mode):
+                raise FileExistsError("%s is not a socket" % self.path)
+        except FileNotFoundError:
+            return
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.path)
+        except ConnectionRefusedError:
+            os.unlink(self.path)
+            return
+        finally:
+            probe.close()
+        raise FileExistsError("A daemon is serving %s already" % self.path)
+
+    async def serve(self):
+        """Listen and serve until close()"""
+        self.loop = asyncio.get_running_loop()
+        self._unlink_stale()
+        # Bound owner-only, then opened up to mode: never wider than mode in between
+        umask = os.umask(0o077)
+        try:
+            self._server = await asyncio.start_unix_server(self._serve_client, path=self.path)
+        finally:
+            os.umask(umask)
+        os.chmod(self.path, self.mode)
+        self._listening.set()
+        try:
+            async with self._server:
+                await self._server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+    def start(self):
+        """Serve from a thread of its own, return once the socket is listening"""
+        self._thread = threading.Thread(target=asyncio.run, args=(self.serve(),), name="essp daemon", daemon=True)
+        self._thread.start()
+        self._listening.wait()
+        return self
+
+    def close(self):
+        """Stop serving, the units stay open"""
+        for name, device in self.units.items():
+            device.unsubscribe(self._callbacks[name])
+        if self.loop is not None and self._server is not None:
+            self.loop.call_soon_threadsafe(self._server.close)
+            for client in list(self.clients):
+                self.loop.call_soon_threadsafe(client.writer.close)
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    async def _serve_client(self, reader, writer):
+        client = _Client(writer, self.client_queue_size)
+        self.clients.add(client)
+        writing = asyncio.create_task(client.write_loop())
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                self.requests += 1
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError("A request is an object")
+                except ValueError as e:
+                    client.reply(_error(None, e))
+                    continue
+                self._handle(client, request)
+        except ConnectionError:
+            pass
+        finally:
+            self.clients.discard(client)
+            writing.cancel()
+            writer.close()
+
+    def _handle(self, client, request):
+        call_id = request.get("id")
+        name = request.get("call")
+        try:
+            unit = request.get("unit") or self.default_unit
+            device = self.units.get(unit)
+            if device is None:
+                raise KeyError("No unit %s" % unit)
+            args, kwargs = request.get("args", ()), request.get("kwargs", {})
+            if name == "units":
+                result = list(self.units)
+            elif name == "subscribe":
+                events = request.get("events")
+                client.subscriptions[unit] = None if events is None else set(events)
+                result = True
+            elif name == "unsubscribe":
+                result = client.subscriptions.pop(unit, None) is not None
+            elif name == "status":
+                result = unit_status(device)
+            elif name in CACHED and not (isinstance(device, WorkerESSP) and name in WorkerESSP.SYNCHRONOUS):
+                result = _plain(getattr(device, name)(*args, **kwargs))
+            elif name in QUEUED:
+                future = getattr(device, name)(*args, **kwargs)
+                future.add_done_callback(lambda done: self.loop.call_soon_threadsafe(self._settle, client, call_id, done))
+                return
+            elif name in SYNCHRONOUS or name in CACHED:
+                future = self.loop.run_in_executor(None, partial(getattr(device, name), *args, **kwargs))
+                future.add_done_callback(partial(self._settle, client, call_id))
+                return
+            else:
+                raise AttributeError("No call %s" % name)
+        except Exception as e:
+            client.reply(_error(call_id, e))
+            return
+        client.reply({"id": call_id, "ok": True, "result": result})
+
+    def _settle(self, client, call_id, future):
+        if client not in self.clients:
+            return
+        if future.cancelled():
+            client.reply({"id": call_id, "ok": False, "cancelled": True})
+        elif future.exception() is not None:
+            client.reply(_error(call_id, future.exception()))
+        else:
+            client.reply({"id": call_id, "ok": True, "result": _plain(future.result())})
+
+
+def _rebuild_error(reply):
+    cls = ERRORS.get(reply.get("error"), errors.SSPError)
+    # The message has the response and reason in it already
+    error = cls.__new__(cls)
+    Exception.__init__(error, reply.get("message"))
+    for attribute, kind in (("response", Response), ("reason", PayoutResponse), ("status", DownloadStatus)):
+        if attribute in reply:
+            try:
+                setattr(error, attribute, kind(reply[attribute]))
+            except ValueError:
+                setattr(error, attribute, reply[attribute])
+    return error
+
+
+def _notes(pairs):
+    """{Note: count} back from the pairs _plain() made of it"""
+    if pairs is None:
+        return None
+    return {Note(note["value"], note["currency"]): count for note, count in pairs}
+
+
+def _event(message):
+    code = message["code"]
+    event = POLL_STATUS[code] if code < len(POLL_STATUS) else LinkState(code)
+    note = message.get("note")
+    return Event(Note(note["value"], note["currency"]) if note else None, event)
+
+
+class ESSPClient(object):
+    """A unit served by ESSPDaemon, with eSSP's methods
+
+    Queued actions return Futures settled when the daemon's unit has run
+    them; storage, stacked, busy and status() are read from the daemon's
+    memory in one round trip over the socket. Events are pushed to this
+    side's event bus unless `events` is False. close() closes this
+    connection only, the unit stays set up for everyone else.
+    """
+
+    QUEUED = QUEUED
+    SYNCHRONOUS = SYNCHRONOUS + ("can_pay", "poll_stats", "action_stats")
+    # Results that went over as JSON pairs, made into what eSSP returns again
+    DECODE = {"payout": _notes, "plan_payout": _notes}
+
+    def __init__(self, path, unit=None, timeout=10.0, events=True, event_queue_size=1024, event_overflow=DROP_OLDEST):
+        self.path = path
+        self.unit = unit
+        self.timeout = timeout
+        self.events = EventBus(maxlen=event_queue_size, overflow=event_overflow)
+        # Events the daemon dropped because this side read too slowly
+        self.dropped = 0
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.connect(path)
+        self._file = self._socket.makefile("rb")
+        self._send_lock = threading.Lock()
+        self._ids = itertools.count()
+        self._calls = {}
+        self._closed = False
+        # Set by the reader once the daemon's end is gone, no answer can come after it
+        self._lost = False
+        self._reader = threading.Thread(target=self._read_loop, daemon=True)
+        self._reader.start()
+        if events:
+            self.call("subscribe").result(timeout)
+
+    def _read_loop(self):
+        try:
+            for line in self._file:
+                message = json.loads(line)
+                if "event" in message:
+                    self.events.publish(_event(message))
+                elif "dropped" in message:
+                    self.dropped += message["dropped"]
+                else:
+                    self._settle(message)
+        except (OSError, ValueError):
+            pass
+        self._lost = True
+        self._fail_all(self._connection_closed())
+
+    def _connection_closed(self):
+        return errors.SSPError("Connection to %s closed" % self.path)
+
+    def _settle(self, reply):
+        future, decode = self._calls.pop(reply.get("id"), (None, None))
+        if future is None:
+            return
+        try:
+            if reply.get("cancelled"):
+                future.cancel()
+            elif reply["ok"]:
+                future.set_result(reply["result"] if decode is None else decode(reply["result"]))
+            else:
+                future.set_exception(_rebuild_error(reply))
+        except InvalidStateError:
+            pass  # cancelled here meanwhile
+
+    def _fail_all(self, error):
+        calls, self._calls = self._calls, {}
+        for future, _ in calls.values():
+            try:
+                future.set_exception(error)
+            except InvalidStateError:
+                pass
+
+    def call(self, name, *args, **kwargs):
+        """Send a call to the daemon's unit, return a Future of its answer"""
+        if self._closed:
+            raise errors.SSPError("Closed")
+        if self._lost:
+            raise self._connection_closed()
+        call_id = next(self._ids)
+        future = Future()
+        self._calls[call_id] = (future, self.DECODE.get(name))
+        if self._lost:
+            # The reader failed the calls before this one was in, nobody would settle it
+            self._calls.pop(call_id, None)
+            raise self._connection_closed()
+        request = {"id": call_id, "unit": self.unit, "call": name}
+        if args:
+            request["args"] = args
+        if kwargs:
+            request["kwargs"] = kwargs
+        with self._send_lock:
+            self._socket.sendall(_line(request))
+        return future
+
+    def __getattr__(self, name):
+        if name in self.QUEUED:
+            return lambda *args, **kwargs: self.call(name, *args, **kwargs)
+        if name in self.SYNCHRONOUS:
+            return lambda *args, **kwargs: self.call(name, *args, **kwargs).result(self.timeout)
+        raise AttributeError(name)
+
+    def status(self):
+        """The daemon's status of the unit, as unit_status() makes it"""
+        return self.call("status").result(self.timeout)
+
+    @property
+    def storage(self):
+        return {int(number): Channel(Note(channel["value"], channel["currency"]), channel["amount"],
+                                     None if channel["route"] is None else Route(channel["route"]))
+                for number, channel in self.status()["storage"].items()}
+
+    @property
+    def stacked(self):
+        return self.status()["stacked"]
+
+    @property
+    def busy(self):
+        return self.status()["busy"]
+
+    @property
+    def link_state(self):
+        return LinkState(self.status()["link"])
+
+    def plan_payout(self, amount, currency=DEFAULT_CURRENCY):
+        """{Note: count} paying exactly amount from the stored notes, largest first, or None"""
+        return self.call("plan_payout", amount, currency).result(self.timeout)
+
+    def get_last_event(self):
+        """Get the last event and delete it from the event list"""
+        return self.events.get_nowait()
+
+    def get_event(self, timeout=None):
+        """Wait up to timeout seconds for the next event, None if there was none"""
+        return self.events.get(timeout)
+
+    def subscribe(self, callback, event=None):
+        """Call callback((note, event)) from the reader thread for each event of a type, or for all"""
+        self.events.subscribe(callback, event)
+
+    def unsubscribe(self, callback, event=None):
+        self.events.unsubscribe(callback, event)
+
+    def close(self):
+        """Close the connection, the unit stays open in the daemon"""
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._reader.join(1.0)
+        self._file.close()
+        self._socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    __str__ = eSSP.__str__
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--socket", required=True, help="path of the Unix socket to serve on")
+    parser.add_argument("--unit", action="append", default=[], metavar="NAME=PORT", help="a unit to open, by name")
+    parser.add_argument("--config", help="JSON file of {name: {eSSP arguments, com_port included}}")
+    parser.add_argument("--worker", action="store_true", help="poll each unit from a worker process")
+    parser.add_argument("--debug", action="store_true")
+    args = parser.parse_args()
+
+    config = {}
+    if args.config:
+        with open(args.config) as f:
+            config.update(json.load(f))
+    for unit in args.unit:
+        name, _, com_port = unit.partition("=")
+        if not com_port:
+            parser.error("--unit takes NAME=PORT, not %s" % unit)
+        config[name] = {"com_port": com_port}
+    if not config:
+        parser.error("no units, give --unit or --config")
+
+    opener = WorkerESSP if args.worker else eSSP
+    units = {}
+    try:
+        for name, kwargs in config.items():
+            kwargs = dict(kwargs)
+            kwargs.setdefault("debug", args.debug)
+            units[name] = opener(kwargs.pop("com_port"), **kwargs)
+        daemon = ESSPDaemon(units, args.socket)
+        stop = threading.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *_: stop.set())
+        daemon.start()
+        print("Serving %s on %s" % (", ".join(units), args.socket), flush=True)
+        stop.wait()
+        daemon.close()
+    finally:
+        for device in units.values():
+            device.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import json
+import os
+import threading
+from dataclasses import dataclass, asdict
+
+
+@dataclass(frozen=True)
+class UnitDescriptor:
+    """What the setup request tells about a unit, fixed for a given serial and firmware"""
+    serial: int
+    firmware: str
+    unit_type: int
+    channels: tuple  # (channel number, value, currency) of every channel in use
+    multiplier: int
+    protocol: int
+
+    @property
+    def key(self):
+        return "%d/%s" % (self.serial, self.firmware)
+
+    @classmethod
+    def from_dict(cls, data):
+        data = dict(data)
+        data["channels"] = tuple(tuple(channel) for channel in data["channels"])
+        return cls(**data)
+
+
+class DescriptorCache(object):
+    """Unit descriptors by serial and firmware
+
+    Kept in memory for the life of the process and, when `path` is given,
+    in a JSON file so that the next start skips the setup request too.
+    A firmware update changes the key, so a stale entry is never used.
+    """
+
+    # Shared by all caches, a reconnecting unit finds its descriptor here
+    _memory = {}
+    _lock = threading.Lock()
+
+    def __init__(self, path=None):
+        self.path = path
+        self._loaded = False
+
+    def _load(self):
+        self._loaded = True
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            # A damaged cache costs a setup request, nothing more
+            return
+        for key, data in stored.items():
+            try:
+                self._memory.setdefault(key, UnitDescriptor.from_dict(data))
+            except (TypeError, KeyError):
+                pass
+
+    def get(self, serial, firmware):
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            return self._memory.get("%d/%s" % (serial, firmware))
+
+    def put(self, descriptor):
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            self._memory[descriptor.key] = descriptor
+            if self.path is not None:
+                self._save()
+
+    def _save(self):
+        stored = {key: asdict(descriptor) for key, descriptor in self._memory.items()}
+        tmp = "%s.%d.tmp" % (self.path, os.getpid())
+        with open(tmp, "w") as f:
+            json.dump(stored, f, indent=1)
+        os.replace(tmp, self.path)
@@ -1,24 +1,42 @@
 # !/usr/bin/env python3
 import threading
+from time import monotonic
+from itertools import accumulate
+from concurrent.futures import Future
 from ctypes import *
-from dataclasses import dataclass
-from time import sleep
-from six.moves import queue
-from .constants import Status, FailureStatus, PayoutResponse, Actions, UnitType, Route
+from dataclasses import dataclass, asdict
+from typing import NamedTuple
+from .constants import Status, Response, Command, FailureStatus, PayoutResponse, Actions, UnitType, Route, LinkState, DownloadStatus
+from .errors import SSPError, PayoutError, DownloadError
+from .events import EventBus, DROP_OLDEST
+from .descriptor import UnitDescriptor, DescriptorCache
+from .planner import PayoutPlanner
+from .ledger import Ledger, CREDIT, STORED, STACKED, DISPENSED, EMPTIED, CASHBOX
+from .scheduler import PollScheduler
+from .actions import ActionQueue
+from .capture import Frame, write_capture
+from .trace import log, link_log, poll_log, action_log, inventory_log, download_log, debug_to_stdout
+from .trace import CommandStart, CommandEnd, PollResult, EventDecoded, ActionDequeued
 
 DEFAULT_CURRENCY = "RUB"
 
-@dataclass
+@dataclass(frozen=True)
 class Note:
-    value: int
+    # Immutable, so one instance per channel can be handed out with every event
+    __slots__ = ('value', 'currency')
+    value: int | float
     currency: str
     def __init__(self, value, currency=DEFAULT_CURRENCY):
-        self.value = int(value)
-        self.currency = currency
+        # Whole units, but for an amount the unit reports with cents, e.g. what it is dispensing
+        object.__setattr__(self, 'value', int(value) if value == int(value) else value)
+        object.__setattr__(self, 'currency', currency)
     def __str__(self):
         return "%s %s" % (str(self.value), self.currency)
     def __int__(self):
-        return self.value
+        return int(self.value)
+    def __reduce__(self):
+        # Frozen and slotted, it can't be unpickled field by field
+        return (Note, (self.value, self.currency))
 
 @dataclass
 class Channel:
@@ -31,6 +49,35 @@ class Last:
     status: Status
     note: Note | None
 
+class Event(NamedTuple):
+    """A poll event as put on the event bus, unpacks as (note, event)"""
+    note: Note | None
+    event: Status
+
+class DownloadProgress(NamedTuple):
+    """Where a download_file() stands, after each block"""
+    block: int
+    blocks: int
+    bytes: int      # of the file, the loader part excluded
+    retries: int    # blocks sent again
+    elapsed: float  # seconds since the download started
+
+    @property
+    def rate(self):
+        """Bytes per second so far"""
+        return self.bytes / self.elapsed if self.elapsed else 0.0
+
+# block, blocks, bytes, retries
+DownloadCallback = CFUNCTYPE(None, c_ulong, c_ulong, c_ulong, c_ulong)
+
+# Poll event byte -> Status member, or the byte itself when it is unknown.
+# Status has two members for 0xFF, this keeps the one Status(0xFF) gives.
+POLL_STATUS = tuple(Status._value2member_map_.get(byte, byte) for byte in range(256))
+
+class SspCommand(Structure):
+    # Opaque SSP_COMMAND, only ever handled through a pointer
+    pass
+
 class Ssp6ChannelData(Structure):
     _fields_ = [("security", c_ubyte),
                 ("value", c_uint),
@@ -44,6 +91,54 @@ class Ssp6SetupRequestData(Structure):
                 ("RealValueMultiplier", c_ulong),
                 ("ProtocolVersion", c_ubyte)]
 
+class Ssp6UnitData(Structure):
+    _fields_ = [("UnitType", c_ubyte),
+                ("FirmwareVersion", c_char * 5),
+                ("CountryCode", c_char * 4),
+                ("ValueMultiplier", c_ulong),
+                ("ProtocolVersion", c_ubyte)]
+
+class Ssp6Level(Structure):
+    _fields_ = [("Level", c_ushort),
+                ("Value", c_ulong),
+                ("cc", c_char * 4)]
+
+class Ssp6Levels(Structure):
+    _fields_ = [("NumberOfDenominations", c_ubyte),
+                ("Levels", Ssp6Level * 20)]
+
+RTT_BUCKETS = 12
+
+class SspCommandMetrics(Structure):
+    _fields_ = [("Commands", c_ulong),
+                ("Replies", c_ulong),
+                ("Retries", c_ulong),
+                ("Timeouts", c_ulong),
+                ("CrcErrors", c_ulong),
+                ("CounterErrors", c_ulong),
+                ("PortErrors", c_ulong),
+                ("BytesOut", c_ulonglong),
+                ("BytesIn", c_ulonglong),
+                ("RttTotal", c_ulonglong),
+                ("RttMax", c_ulong),
+                ("RttBuckets", c_ulong * RTT_BUCKETS)]
+
+class SspMetrics(Structure):
+    _fields_ = [("Command", SspCommandMetrics * 256)]
+
+class SspCaptureRecord(Structure):
+    _fields_ = [("Time", c_ulonglong),
+                ("Direction", c_ubyte),
+                ("Address", c_ubyte),
+                ("Status", c_ubyte),
+                ("Length", c_ubyte),
+                ("Data", c_ubyte * 255)]
+
+class SspCapture(Structure):
+    _fields_ = [("Size", c_ulong),
+                ("Written", c_ulonglong),
+                ("Records", POINTER(SspCaptureRecord))]
+
 class SspPollEvent6(Structure):
     _fields_ = [("event", c_ubyte),
                 ("data1", c_ulong),
@@ -57,114 +152,321 @@ class SspPollData6(Structure):
 class eSSP(object):
     """Encrypted Smiley Secure Protocol Class"""
 
-    def __init__(self, com_port, ssp_address="0", route_to_storage=None, debug=False):
+    def __init__(self, com_port, ssp_address="0", route_to_storage=None, debug=False, poll_interval=0.5, busy_poll_interval=0.05, threaded=True, event_queue_size=1024, event_overflow=DROP_OLDEST, baud_rate=9600, descriptor_cache=None, ledger=None, capture=0, capture_path=None, actions_per_poll=4, reconnect_delay=0.1, reconnect_max_delay=30.0, trace=None):
+        self._init_state(com_port, debug, poll_interval, busy_poll_interval, event_queue_size, event_overflow,
+                         actions_per_poll, reconnect_delay, reconnect_max_delay, trace)
+
+        self.sspC = self._open_port(ssp_address)
+        if not self.sspC:
+            link_log.error("Can't open port %s: %s", com_port, self.essp.GetPortError().decode(errors="replace"))
+            raise Exception("Can't open port %s" % com_port)
+
+        # The last `capture` plain frames, written to capture_path when a poll or an action fails
+        self.capture_path = capture_path
+        if capture and not self.essp.ssp_capture_start(self.sspC, capture):
+            link_log.warning("Capture of %s failed", self.com_port)
+
+        # Counts survive a restart in the ledger, the unit only has to confirm them
+        self.ledger = Ledger(ledger) if ledger is not None else None
+        if self.ledger is not None:
+            self.stacked = self.ledger.state.cashbox
+
+        # Sync, baud rate, encryption and protocol version
+        self.requested_baud_rate = baud_rate
+        try:
+            self._connect()
+        except SSPError:
+            self.close()
+            raise
+
+        # Get some information about the validator, from the cache when this unit was seen before
+        self.descriptor_cache = DescriptorCache(descriptor_cache)
+        self.descriptor = self.describe_unit(self.descriptor_cache)
+        if self.descriptor is None:
+            inventory_log.error("Setup request failed")
+            self.close()
+            raise Exception("Setup request failed")
+
+        # The levels and routes are read after enabling
+        self._load_descriptor(self.descriptor, self.ledger.state.levels if self.ledger is not None else {})
+        inventory_log.info("Unit type: %s", self.unit)
+        inventory_log.info("Firmware: %s", self.descriptor.firmware)
+        self.route_to_storage = route_to_storage
+
+        # Enable the validator
+        try:
+            self._enable_unit()
+        except SSPError:
+            self.close()
+            raise
+
+        # Set bezel color
+        self.configure_bezel(0, 255, 0)
+
+        # Resolves once levels and routes are known (and route_to_storage applied), None without a payout
+        self.inventory_loaded = self.refresh_inventory() or None
+
+        # Without the thread the owner drives poll_once() and do_actions() itself
+        self.link_state = LinkState.UP
+        if threaded:
+            self._thread = threading.Thread(target=self.system_loop)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _init_state(self, com_port, debug=False, poll_interval=0.5, busy_poll_interval=0.05, event_queue_size=1024, event_overflow=DROP_OLDEST, actions_per_poll=4, reconnect_delay=0.1, reconnect_max_delay=30.0, trace=None):
+        """Everything but the port and the unit: schedule, queues, counts and the poll decoding"""
         self.debug = debug
-        self.actions = queue.Queue()
+        if debug:
+            debug_to_stdout()
+        # Called with every trace point, see eSSP.trace
+        self.trace = trace
+        self.com_port = com_port
+        self.scheduler = PollScheduler(idle_interval=poll_interval, busy_interval=busy_poll_interval)
+        # Most urgent first, at most actions_per_poll of them between two polls
+        self.actions = ActionQueue(per_poll=actions_per_poll)
         self.actions_args = {}
         self.response_data = {}
-        self.events = []
+        self.events = EventBus(maxlen=event_queue_size, overflow=event_overflow)
         self.storage = {}
         self.busy = True
         self.stacked = 0
         self.last = Last(None, None)
         # There can't be 9999 notes in the storage
         self.response_data['getnoteamount_response'] = 9999
+        # A lost link is retried after reconnect_delay, doubled per failure up to reconnect_max_delay
+        self.reconnect_delay = reconnect_delay
+        self.reconnect_max_delay = reconnect_max_delay
+        self.reconnects = 0
+        # Connections the transport made again by itself (a converter's TCP link), as last seen
+        self._port_reconnects = 0
+        self.link_state = LinkState.DOWN
+        self._resync = False
+        # Set by a download, the unit comes back with other channels
+        self._describe = False
+        # Set by close(): stops the poll loop and a reconnection in progress
+        self._closing = threading.Event()
+        # close() and a reconnection don't touch the port at the same time
+        self._port_lock = threading.Lock()
+        self._thread = None
+        self.capture_path = None
+        self.ledger = None
+        self.route_to_storage = None
+        self.inventory_loaded = None
 
-        self.sspC = self.essp.ssp_init(com_port.encode(), ssp_address.encode(), debug)
         self.poll = SspPollData6()
-        setup_req = Ssp6SetupRequestData()
-
-        # Check if the validator is present
-        if self.essp.ssp6_sync(self.sspC) != Status.SSP_RESPONSE_OK:
-            self.print_debug("NO VALIDATOR FOUND")
-            self.close()
-            raise Exception("No validator found")
-        else:
-            self.print_debug("Validator found")
+        self.levels = Ssp6Levels()
+        self.planner = PayoutPlanner()
+        # Cleared when the unit answers GET ALL LEVELS with unknown command
+        self.all_levels = True
+        self._notes = {}
+        self._poll_handlers = tuple(getattr(self, self.POLL_HANDLERS.get(byte, '_on_event' if isinstance(status, Status) else '_on_unknown'))
+                                    for byte, status in enumerate(POLL_STATUS))
+
+    def _connect(self, baud_rate=9600):
+        """Sync, baud rate, key exchange and protocol version on a port just opened, SSPError if the unit won't
+
+        The sync is tried at `baud_rate` first, then at 9600 and the requested
+        rate: a unit that was not power cycled still talks at the rate set before.
+        """
+        response = Status.SSP_RESPONSE_TIMEOUT
+        for rate in dict.fromkeys((baud_rate, 9600, self.requested_baud_rate)):
+            if self.essp.set_ssp_port_baud(self.sspC, rate):
+                response = self.essp.ssp6_sync(self.sspC)
+                if response == Status.SSP_RESPONSE_OK:
+                    self.baud_rate = rate
+                    break
+        if response != Status.SSP_RESPONSE_OK:
+            self.essp.set_ssp_port_baud(self.sspC, 9600)
+            link_log.debug("No validator found on %s", self.com_port)
+            raise SSPError("No validator found", response)
+        link_log.info("Validator found on %s at %d baud", self.com_port, self.baud_rate)
+
+        # Everything after this goes faster at a higher rate, the unit falls back to 9600 if it can't
+        if self.baud_rate != self.requested_baud_rate:
+            if self.essp.ssp6_set_baud_rate(self.sspC, self.requested_baud_rate, 0) == Status.SSP_RESPONSE_OK:
+                self.baud_rate = self.requested_baud_rate
+                link_log.info("Baud rate %d", self.baud_rate)
+            else:
+                link_log.warning("Baud rate %d failed, staying at 9600", self.requested_baud_rate)
 
         # Try to setup encryption
         if self.essp.ssp6_setup_encryption(self.sspC, c_ulonglong(0x123456701234567)) == Status.SSP_RESPONSE_OK:
-            self.print_debug("Encryption setup")
+            link_log.debug("Encryption setup")
         else:
-            self.print_debug("Encryption failed")
+            link_log.warning("Encryption failed")
 
         # Checking the version, make sure we are using ssp version 6
-        if self.essp.ssp6_host_protocol(self.sspC, 0x06) != Status.SSP_RESPONSE_OK:
-            self.print_debug(self.essp.ssp6_host_protocol(self.sspC, 0x06))
-            self.print_debug("Host protocol failed")
-            self.close()
-            raise Exception("Host protocol failed")
-
-        # Get some information about the validator
-        if self.essp.ssp6_setup_request(self.sspC, byref(setup_req)) != Status.SSP_RESPONSE_OK:
-            self.print_debug("Setup request failed")
-            self.close()
-            raise Exception("Setup request failed")
+        self._host_protocol()
 
-        try:
-            self.unit = UnitType(setup_req.UnitType)
-        except ValueError:
-            self.unit = setup_req.UnitType
-        self.print_debug("Unit type: %s" % str(self.unit))
-        self.print_debug("Firmware: %s" % (setup_req.FirmwareVersion.decode('utf8')))
-
-        self.print_debug("Storage: ")
-        for i, channel in enumerate(setup_req.ChannelData):
-            if channel.value:
-                note = Note(channel.value, channel.cc.decode())
-                DEFAULT_CURRENCY = note.currency
-                if self.essp.ssp6_get_note_amount(self.sspC, channel.value * 100, channel.cc) == Status.SSP_RESPONSE_OK:
-                    response_data = cast(self.essp.ssp_get_response_data(self.sspC), POINTER(c_ubyte))
-                    amount = response_data[1]
-                else:
-                    amount = 0
-                if self.essp.ssp6_get_routing(self.sspC, channel.value * 100, channel.cc) == Status.SSP_RESPONSE_OK:
-                    response_data = cast(self.essp.ssp_get_response_data(self.sspC), POINTER(c_ubyte))
-                    try:
-                        route = Route(response_data[1])
-                    except ValueError:
-                        route = None
-                else:
-                    route = None
-                self.storage[i + 1] = Channel(note, amount, route)
-                self.print_debug("Channel %s: %s: %s, %s" % (str(i + 1), str(note), str(amount), str(route)))
+    def _host_protocol(self):
+        response = self.essp.ssp6_host_protocol(self.sspC, 0x06)
+        if response != Status.SSP_RESPONSE_OK:
+            link_log.debug("Host protocol failed")
+            raise SSPError("Host protocol failed", response)
 
-        # Enable the validator
-        if self.essp.ssp6_enable(self.sspC) != Status.SSP_RESPONSE_OK:
-            self.print_debug("Enable failed")
-            self.close()
-            raise Exception("Enable failed")
+    def _enable_unit(self):
+        """Enable the unit, its payout and every channel, SSPError if the unit refuses"""
+        response = self.essp.ssp6_enable(self.sspC)
+        if response != Status.SSP_RESPONSE_OK:
+            link_log.debug("Enable failed")
+            raise SSPError("Enable failed", response)
 
         if self.unit == UnitType.SMART_HOPPER:
-            for channel in enumerate(setup_req.ChannelData):
-                self.essp.ssp6_set_coinmech_inhibits(self.sspC, channel.value, channel.cc, Status.ENABLED)
-        else:
-            if setup_req.UnitType in {UnitType.SMART_PAYOUT, UnitType.NOTE_FLOAT}:
-                # Enable the payout unit
-                if self.essp.ssp6_enable_payout(self.sspC, setup_req.UnitType) != Status.SSP_RESPONSE_OK:
-                    self.print_debug("Payout enable failed")
-                else:
-                    self.print_debug("Payout enable")
-                if route_to_storage:
-                    for channel in self.storage.values():
-                        if channel.note.value <= route_to_storage and channel.route != Route.PAYOUT:
-                            if self.essp.ssp6_set_route(self.sspC, channel.note.value * 100, channel.note.currency.encode(), Route.PAYOUT.value) == Status.SSP_RESPONSE_OK:
-                                self.print_debug("Route to storage %s" % (str(channel.note)))
-                            else:
-                                self.print_debug("ERROR: Route to storage failed")
-
-            # Set the inhibits (enable all note acceptance)
-            if self.essp.ssp6_set_inhibits(self.sspC, 0xFF, 0xFF) != Status.SSP_RESPONSE_OK:
-                self.print_debug("Inhibits failed")
-                self.close()
-                raise Exception("Inhibits failed")
-        
-        # Set bezel color
+            self._enable_coin_channels()
+            return
+        if self.unit in {UnitType.SMART_PAYOUT, UnitType.NOTE_FLOAT}:
+            # Enable the payout unit
+            if self.essp.ssp6_enable_payout(self.sspC, int(self.unit)) != Status.SSP_RESPONSE_OK:
+                link_log.warning("Payout enable failed")
+            else:
+                link_log.debug("Payout enable")
+
+        # Set the inhibits (enable all note acceptance)
+        response = self.essp.ssp6_set_inhibits(self.sspC, 0xFF, 0xFF)
+        if response != Status.SSP_RESPONSE_OK:
+            link_log.debug("Inhibits failed")
+            raise SSPError("Inhibits failed", response)
+
+    def _check_unit(self):
+        """Keep the descriptor if the serial number is the same, describe it again if another one answers or a download changed it"""
+        serial = c_ulong()
+        response = self.essp.ssp6_get_serial(self.sspC, byref(serial))
+        if response != Status.SSP_RESPONSE_OK:
+            raise SSPError("Serial number failed", response)
+        if not self._describe and (serial.value == self.descriptor.serial or not self.descriptor.serial):
+            return
+        inventory_log.info("Describing unit %d again", serial.value)
+        descriptor = self.describe_unit(self.descriptor_cache, cached=not self._describe)
+        if descriptor is None:
+            raise SSPError("Setup request failed")
+        # Nothing known of the new channels' levels and routes
+        self._describe = False
+        self.descriptor = descriptor
+        self.storage = {}
+        self.planner = PayoutPlanner()
+        self._load_descriptor(descriptor, {})
+
+    def _resume(self):
+        # Levels may have changed while nobody was looking, the bezel went back to its default
+        self.busy = True
         self.configure_bezel(0, 255, 0)
+        self.refresh_inventory()
+
+    def reconnect(self):
+        """Open the port again and bring the unit back to enabled, return True on success
+
+        The descriptor, levels and routes known from before are kept: unless
+        another unit answers, this is sync, key exchange, protocol version,
+        serial number and the enable commands, with the levels read after.
+        """
+        with self._port_lock:
+            if self._closing.is_set():
+                return False
+            if not self._reopen_port():
+                link_log.warning("Can't open port %s: %s", self.com_port, self.essp.GetPortError().decode(errors="replace"))
+                return False
+            try:
+                # Most likely the unit still runs at the rate of the session lost
+                self._connect(self.baud_rate)
+                self._check_unit()
+                self._enable_unit()
+            except SSPError as e:
+                link_log.info("Reconnect to %s failed: %s", self.com_port, e)
+                return False
+        self._resync = False
+        self._resume()
+        return True
+
+    # The port, the only part an SSPBus device shares with the others
+
+    def _open_port(self, ssp_address):
+        return self.essp.ssp_init(self.com_port.encode(), ssp_address.encode(), self.debug)
 
-        system_loop_thread = threading.Thread(target=self.system_loop)
-        system_loop_thread.daemon = True
-        system_loop_thread.start()
+    def _reopen_port(self):
+        self.essp.close_ssp_port(self.sspC)
+        self._port_reconnects = 0
+        return self.essp.open_ssp_port(self.sspC, self.com_port.encode())
+
+    def _release_port(self):
+        self.essp.close_ssp_port(self.sspC)
+
+    def resync(self):
+        """Bring a unit that has reset back to enabled on the open link, return True on success"""
+        self._resync = False
+        try:
+            self._host_protocol()
+            self._enable_unit()
+        except SSPError as e:
+            link_log.warning("Resync failed: %s", e)
+            return False
+        self._resume()
+        return True
+
+    def recover(self):
+        """Reconnect until it works, waiting longer after each failure; False if close() stopped it"""
+        delay = self.reconnect_delay
+        self._set_link(LinkState.RECONNECTING)
+        while not self._closing.is_set():
+            self.reconnects += 1
+            if self.reconnect():
+                self._set_link(LinkState.UP)
+                return True
+            self._closing.wait(delay)
+            delay = min(delay * 2, self.reconnect_max_delay)
+        return False
+
+    def _set_link(self, state):
+        if state != self.link_state:
+            self.link_state = state
+            link_log.info("%s: %s", self.com_port, state)
+            self.events.publish(Event(None, state))
+
+    def _load_descriptor(self, descriptor, levels):
+        """Unit type and channels from the descriptor, levels by (value, currency) as far as known"""
+        try:
+            self.unit = UnitType(descriptor.unit_type)
+        except ValueError:
+            self.unit = descriptor.unit_type
+        for number, value, currency in descriptor.channels:
+            self.storage[number] = Channel(Note(value, currency), levels.get((value, currency), 0), None)
+            self.planner.set_level(value, currency, self.storage[number].amount)
+        for channel in self.storage.values():
+            if channel.note.currency == DEFAULT_CURRENCY:
+                self._notes.setdefault(channel.note.value * 100, channel.note)
+
+    def describe_unit(self, cache, cached=True):
+        """Serial number and unit data pick the cached descriptor, a setup request fills a missing one (or any if not cached)"""
+        serial = c_ulong()
+        unit_data = Ssp6UnitData()
+        if (self.essp.ssp6_get_serial(self.sspC, byref(serial)) == Status.SSP_RESPONSE_OK and
+                self.essp.ssp6_unit_data(self.sspC, byref(unit_data)) == Status.SSP_RESPONSE_OK):
+            firmware = unit_data.FirmwareVersion.decode(errors='replace')
+            descriptor = cache.get(serial.value, firmware) if cached else None
+            if descriptor is not None:
+                inventory_log.info("Unit %d, firmware %s: cached descriptor", serial.value, firmware)
+                return descriptor
+        else:
+            serial.value, firmware = 0, None
+
+        setup_req = Ssp6SetupRequestData()
+        if self.essp.ssp6_setup_request(self.sspC, byref(setup_req)) != Status.SSP_RESPONSE_OK:
+            return None
+        channels = tuple((i + 1, channel.value, channel.cc.decode())
+                         for i, channel in enumerate(setup_req.ChannelData[:setup_req.NumberOfChannels]) if channel.value)
+        descriptor = UnitDescriptor(serial=serial.value,
+                                    firmware=firmware or setup_req.FirmwareVersion[:4].decode(errors='replace'),
+                                    unit_type=setup_req.UnitType,
+                                    channels=channels,
+                                    multiplier=setup_req.RealValueMultiplier,
+                                    protocol=setup_req.ProtocolVersion)
+        if firmware is not None:
+            # Without a serial number there is nothing to key it on
+            cache.put(descriptor)
+        return descriptor
+
+    def _enable_coin_channels(self):
+        for channel in self.storage.values():
+            self.essp.ssp6_set_coinmech_inhibits(self.sspC, channel.note.value, channel.note.currency.encode(), Status.ENABLED.value)
 
     def get_note(self, channel):
         try:
@@ -176,339 +478,699 @@ class eSSP(object):
         for channel in self.storage.values():
             if channel.note == note:
                 channel.amount += 1
+                self.planner.add(note.value, note.currency)
+                self._record(STORED, note)
                 return
 
+    def _record(self, kind, note=None, count=1):
+        if self.ledger is not None:
+            if isinstance(note, Note):
+                # Kept in whole units, an amount with cents is rounded
+                self.ledger.append(kind, count, round(note.value), note.currency)
+            else:
+                self.ledger.append(kind, count)
+
     def close(self):
-        """Close the connection"""
-        self.reject()
-        self.essp.close_ssp_port()
+        """Stop the poll thread and close the connection, the actions still queued are cancelled"""
+        if self._closing.is_set():
+            return
+        self._closing.set()
+        self.scheduler.wake()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self.actions.cancel_all()
+        with self._port_lock:
+            if self.link_state == LinkState.UP:
+                self.reject()
+            self._release_port()
+        if self.ledger is not None:
+            self.ledger.close()
 
     def reject(self):
         """Reject the bill if there is one"""
         if self.essp.ssp6_reject(self.sspC) != Status.SSP_RESPONSE_OK:
-            self.print_debug("Error to reject bill OR nothing to reject")
-
-    def do_actions(self):
-        while not self.actions.empty() and not self.busy:
-            current_action = self.actions.get()  # get and delete
-            self.print_debug(current_action["action"])
-
-            if current_action["action"] == Actions.ENABLE_VALIDATOR:
-                self.enable_validator(now=True)
+            action_log.info("Reject failed, or nothing to reject")
 
-            elif current_action["action"] == Actions.UPDATE_PAYOUT:
-                self.update_payout(now=True)
+    def queue_action(self, queued_action, deadline=None):
+        """Queue an action for the poll loop and wake it up, return a Future of its result
 
-            elif current_action["action"] == Actions.ROUTE_TO_CASHBOX:
-                if self.essp.ssp6_set_route(self.sspC, current_action["amount"], current_action["currency"]).encode() != Status.SSP_RESPONSE_OK:
-                    self.print_debug("ERROR: Route to cashbox failed")
+        Cancelling the Future takes the action out of the queue; with a deadline
+        (seconds) it fails with ActionExpired if it is not sent in time.
+        """
+        future = Future()
+        queued_action["future"] = future
+        self.actions.put(queued_action, deadline)
+        self.scheduler.wake()
+        return future
 
-            elif current_action["action"] == Actions.ROUTE_TO_STORAGE:
-                if self.essp.ssp6_set_route(self.sspC, current_action["amount"], current_action["currency"].encode(), Route.PAYOUT.value) != Status.SSP_RESPONSE_OK:
-                    self.print_debug("ERROR: Route to storage failed")
+    def do_actions(self):
+        """Send the queued actions, most urgent first, no more than actions_per_poll before the next poll"""
+        for _ in range(self.actions.per_poll):
+            if self.busy:
+                return
+            current_action = self.actions.take()
+            if current_action is None:
+                return
+            if self.trace is not None:
+                self.trace(ActionDequeued(monotonic(), current_action["action"], len(self.actions)))
+            future = current_action.get("future")
+            if future is None:
+                self.run_action(current_action)
+            elif future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(self.run_action(current_action))
+                except Exception as e:
+                    future.set_exception(e)
+        if not self.actions.empty():
+            # The rest after the next poll, which comes at once
+            self.scheduler.wake()
+
+    def _response(self):
+        return cast(self.essp.ssp_get_response_data(self.sspC), POINTER(c_ubyte))
+
+    def run_action(self, current_action):
+        """Send a queued action to the unit now, return the decoded response or raise SSPError"""
+        trace = self.trace
+        if trace is not None:
+            start = monotonic()
+            trace(CommandStart(start, current_action["action"]))
+        ok = False
+        try:
+            result = self._run_action(current_action)
+            ok = True
+            return result
+        except SSPError:
+            self._dump_capture_on_error()
+            raise
+        finally:
+            if trace is not None:
+                end = monotonic()
+                trace(CommandEnd(end, current_action["action"], ok, end - start))
+
+    def _run_action(self, current_action):
+        action_log.debug("%s", current_action["action"])
+
+        if current_action["action"] == Actions.ENABLE_VALIDATOR:
+            if self.enable_validator(now=True) is False:
+                raise SSPError("Enable failed", self._response()[0])
+
+        elif current_action["action"] == Actions.UPDATE_PAYOUT:
+            if self.refresh_inventory(now=True) is False:
+                raise SSPError("No payout device")
+
+        elif current_action["action"] == Actions.ROUTE_TO_CASHBOX:
+            response = self.essp.ssp6_set_route(self.sspC, current_action["amount"], current_action["currency"].encode(), Route.CASHBOX.value)
+            if response != Status.SSP_RESPONSE_OK:
+                action_log.debug("Route to cashbox failed")
+                raise SSPError("Route to cashbox failed", response)
+            self._set_cached_route(current_action["amount"], current_action["currency"], Route.CASHBOX)
+
+        elif current_action["action"] == Actions.ROUTE_TO_STORAGE:
+            response = self.essp.ssp6_set_route(self.sspC, current_action["amount"], current_action["currency"].encode(), Route.PAYOUT.value)
+            if response != Status.SSP_RESPONSE_OK:
+                action_log.debug("Route to storage failed")
+                raise SSPError("Route to storage failed", response)
+            self._set_cached_route(current_action["amount"], current_action["currency"], Route.PAYOUT)
+
+        elif current_action["action"] == Actions.PAYOUT:
+            if current_action.get("test"):
+                # The unit checks it can pay the amount, without paying it
+                response = self.essp.ssp6_payout(self.sspC, current_action["amount"], current_action["currency"].encode(), Status.SSP6_OPTION_BYTE_TEST.value)
+                if response != Status.SSP_RESPONSE_OK:
+                    error = PayoutError("Payout test failed", response, self._response()[1] if response != Status.SSP_RESPONSE_TIMEOUT else None)
+                    action_log.debug("%s", error)
+                    raise error
+            response = self.essp.ssp6_payout(self.sspC, current_action["amount"], current_action["currency"].encode(), Status.SSP6_OPTION_BYTE_DO.value)
+            if response == Status.SSP_RESPONSE_OK:
+                if self.essp.ssp6_configure_bezel(self.sspC, 0, 0, 255, 0) != Status.SSP_RESPONSE_OK:
+                    action_log.warning("Can't configure bezel color")
+                self.busy = True
+                return current_action.get("plan")
+            else:
+                error = PayoutError("Payout failed", response, self._response()[1] if response != Status.SSP_RESPONSE_TIMEOUT else None)
+                action_log.debug("%s", error)
+                raise error
+
+        elif current_action["action"] == Actions.DISABLE_VALIDATOR:
+            response = self.essp.ssp6_disable(self.sspC)
+            if response != Status.SSP_RESPONSE_OK:
+                action_log.debug("Disable failed")
+                raise SSPError("Disable failed", response)
+
+        elif current_action["action"] == Actions.DISABLE_PAYOUT:
+            response = self.essp.ssp6_disable_payout(self.sspC)
+            if response != Status.SSP_RESPONSE_OK:
+                action_log.debug("Disable payout failed")
+                raise SSPError("Disable payout failed", response)
+
+        elif current_action["action"] == Actions.GET_NOTE_AMOUNT:
+            response = self.essp.ssp6_get_note_amount(self.sspC, current_action["amount"], current_action["currency"].encode())
+            if response == Status.SSP_RESPONSE_OK:
+                response_data = self._response()
+                inventory_log.debug("Note amount %d", response_data[1])
+                # The number of note
+                self.response_data['getnoteamount_response'] = response_data[1]
+                return response_data[1]
+            else:
+                action_log.debug("Can't read the note amount")
+                # There can't be 9999 notes
+                self.response_data['getnoteamount_response'] = 9999
+                raise SSPError("Can't read the note amount", response)
+
+        elif current_action["action"] == Actions.EMPTY_STORAGE:  # Empty the storage ( Send all to the cashbox )
+            response = self.essp.ssp6_empty(self.sspC)
+            if response == Status.SSP_RESPONSE_OK:
+                if self.essp.ssp6_configure_bezel(self.sspC, 255, 255, 0, 0) != Status.SSP_RESPONSE_OK:
+                    action_log.warning("Can't configure bezel color")
+                self.busy = True
+                action_log.debug("Emptying")
+            else:
+                action_log.debug("Can't empty the storage")
+                raise SSPError("Can't empty the storage", response)
 
-            elif current_action["action"] == Actions.PAYOUT:
-                if self.essp.ssp6_payout(self.sspC, current_action["amount"], current_action["currency"].encode(), Status.SSP6_OPTION_BYTE_DO.value) == Status.SSP_RESPONSE_OK:
-                    if self.essp.ssp6_configure_bezel(self.sspC, 0, 0, 255, 0) != Status.SSP_RESPONSE_OK:
-                        self.print_debug("ERROR: Can't configure bezel color")
-                    self.busy = True
-                else:
-                    response_data = cast(self.essp.ssp_get_response_data(self.sspC), POINTER(c_ubyte))
-                    if response_data[1] == PayoutResponse.SMART_PAYOUT_NOT_ENOUGH:
-                        response_info = str(PayoutResponse.SMART_PAYOUT_NOT_ENOUGH)
-                    elif response_data[1] == PayoutResponse.SMART_PAYOUT_EXACT_AMOUNT:
-                        response_info = str(PayoutResponse.SMART_PAYOUT_EXACT_AMOUNT)
-                    elif response_data[1] == PayoutResponse.SMART_PAYOUT_BUSY:
-                        response_info = str(PayoutResponse.SMART_PAYOUT_BUSY)
-                    elif response_data[1] == PayoutResponse.SMART_PAYOUT_DISABLED:
-                        response_info = str(PayoutResponse.SMART_PAYOUT_DISABLED)
-                    else:
-                        response_info = str(response_data[1])
-                    self.print_debug(f"ERROR: Payout failed, {response_info}")
-
-            elif current_action["action"] == Actions.DISABLE_VALIDATOR:
-                if self.essp.ssp6_disable(self.sspC) != Status.SSP_RESPONSE_OK:
-                    self.print_debug("ERROR: Disable failed")
-
-            elif current_action["action"] == Actions.DISABLE_PAYOUT:
-                if self.essp.ssp6_disable_payout(self.sspC) != Status.SSP_RESPONSE_OK:
-                    self.print_debug("ERROR: Disable payout failed")
-
-            elif current_action["action"] == Actions.GET_NOTE_AMOUNT:
-                if self.essp.ssp6_get_note_amount(self.sspC, current_action["amount"], current_action["currency"]) == Status.SSP_RESPONSE_OK:
-                    response_data = cast(self.essp.ssp_get_response_data(self.sspC), POINTER(c_ubyte))
-                    self.print_debug(response_data[1])
-                    # The number of note
-                    self.response_data['getnoteamount_response'] = response_data[1]
-                else:
-                    self.print_debug("ERROR: Can't read the note amount")
-                    # There can't be 9999 notes
-                    self.response_data['getnoteamount_response'] = 9999
-
-            elif current_action["action"] == Actions.EMPTY_STORAGE:  # Empty the storage ( Send all to the cashbox )
-                if self.essp.ssp6_empty(self.sspC) == Status.SSP_RESPONSE_OK:
-                    if self.essp.ssp6_configure_bezel(self.sspC, 255, 255, 0, 0) != Status.SSP_RESPONSE_OK:
-                        self.print_debug("ERROR: Can't configure bezel color")
-                    self.busy = True
-                    self.print_debug("Emptying, please wait...")
-                else:
-                    self.print_debug("ERROR: Can't empty the storage")
+        elif current_action["action"] == Actions.DOWNLOAD:
+            return self._download(current_action["path"], current_action["progress"], current_action["block_retries"])
 
-            elif current_action["action"] == Actions.CONFIGURE_BEZEL:
-                if self.essp.ssp6_configure_bezel(self.sspC, current_action["red"], current_action["green"], current_action["blue"], current_action["volatile"]) != Status.SSP_RESPONSE_OK:
-                    self.print_debug("ERROR: Can't configure bezel color")
+        elif current_action["action"] == Actions.CONFIGURE_BEZEL:
+            response = self.essp.ssp6_configure_bezel(self.sspC, current_action["red"], current_action["green"], current_action["blue"], current_action["volatile"])
+            if response != Status.SSP_RESPONSE_OK:
+                action_log.debug("Can't configure bezel color")
+                raise SSPError("Can't configure bezel color", response)
 
-            else:
-                self.print_debug("Unknow action")
+        else:
+            action_log.error("Unknown action %s", current_action["action"])
+            raise ValueError("Unknown action %s" % current_action["action"])
+        return True
 
     def print_debug(self, text):
-        if self.debug:
-            print(text)
+        # What subclasses of old call, the messages go through logging now
+        log.debug("%s", text)
+
+    def note_for_value(self, value):
+        """The Note worth `value` cents: the channel's own for a denomination, a new one for any other amount"""
+        note = self._notes.get(value)
+        if note is None:
+            note = Note(value / 100)
+        return note
+
+    def parse_poll(self, poll=None):
+        """Parse the poll, for getting events; `poll` defaults to the last poll reply"""
+        if poll is None:
+            poll = self.poll
+        handlers = self._poll_handlers
+        trace = self.trace
+        for events in poll.events[:poll.event_count]:
+            byte = events.event
+            if trace is not None:
+                trace(EventDecoded(monotonic(), POLL_STATUS[byte], events.data1))
+            handlers[byte](POLL_STATUS[byte], events)
+
+    # Poll event byte -> handler, called with the Status and the raw SspPollEvent6.
+    # Events without one are published as they are.
+    POLL_HANDLERS = {
+        Status.SSP_POLL_DISABLED.value: '_on_disabled',
+        Status.SSP_POLL_RESET.value: '_on_reset',
+        Status.SSP_POLL_READ.value: '_on_read',
+        Status.SSP_POLL_CREDIT.value: '_on_credit',
+        Status.SSP_POLL_STORED.value: '_on_stored',
+        Status.SSP_POLL_STACKED.value: '_on_stacked',
+        Status.SSP_POLL_DISPENSING.value: '_on_dispensing',
+        Status.SSP_POLL_DISPENSED.value: '_on_dispensed',
+        Status.SSP_POLL_CASH_BOX_REPLACED.value: '_on_cashbox_replaced',
+        Status.SSP_POLL_SMART_EMPTIED.value: '_on_smart_emptied',
+        Status.SSP_POLL_INCOMPLETE_PAYOUT.value: '_on_incomplete',
+        Status.SSP_POLL_INCOMPLETE_FLOAT.value: '_on_incomplete',
+        Status.SSP_POLL_FRAUD_ATTEMPT.value: '_on_fraud_attempt',
+        Status.SSP_POLL_CALIBRATION_FAIL.value: '_on_calibration_fail',
+    }
+
+    def _on_event(self, event, events):
+        self.events.publish(Event(None, event))
+
+    def _on_unknown(self, event, events):
+        poll_log.info("Unknown status: %s", event)
+        self.events.publish(Event(None, event))
+
+    def _on_disabled(self, event, events):
+        self.enable_validator(now=True)
+        self.events.publish(Event(None, event))
+
+    def _on_reset(self, event, events):
+        # The unit lost the session, set up again once the whole poll is parsed
+        self._resync = True
+        self.events.publish(Event(None, event))
+
+    def _on_read(self, event, events):
+        if events.data1 > 0:
+            note = self.get_note(events.data1)
+            self.last.status = event
+            self.last.note = note
+            poll_log.debug("Note Read %s", note)
+
+    def _on_credit(self, event, events):
+        note = self.get_note(events.data1)
+        self.last.status = event
+        self.last.note = note
+        poll_log.debug("Credit %s", note)
+        self._record(CREDIT, note)
+        self.events.publish(Event(note, event))
+
+    def _on_stored(self, event, events):
+        if self.last.status == Status.SSP_POLL_CREDIT:
+            self.add_note_to_storage(self.last.note)
+            poll_log.debug("Stored in payout %s", self.last.note)
+            self.last.status = self.last.note = None
+
+    def _on_stacked(self, event, events):
+        if events.data1 > 0:
+            self.last.note = self.get_note(events.data1)
+        if self.last.note is not None:
+            self.stacked += self.last.note.value
+            self._record(STACKED, self.last.note)
+        poll_log.debug("Stacked in cashbox %s", self.last.note)
+        self.last.status = self.last.note = None
+
+    def _on_dispensing(self, event, events):
+        if events.data1 > 0:
+            self.last.status = event
+            self.last.note = self.note_for_value(events.data1)
+            poll_log.debug("Dispensing %s", self.last.note)
+            self.events.publish(Event(self.last.note, event))
+        else:
+            poll_log.debug("Dispensing")
+
+    def _on_dispensed(self, event, events):
+        if events.data1 > 0:
+            self.last.note = self.note_for_value(events.data1)
+        poll_log.debug("Dispensed %s", self.last.note)
+        self._record(DISPENSED, self.last.note)
+        # Which notes went out only the unit knows
+        self.refresh_inventory()
+        self.events.publish(Event(self.last.note, event))
+        self.last.status = self.last.note = None
+
+    def _on_cashbox_replaced(self, event, events):
+        self.stacked = 0
+        self._record(CASHBOX, count=0)
+        poll_log.debug("Cashbox replaced")
+        self.events.publish(Event(None, event))
 
-    def parse_poll(self):
-        """Parse the poll, for getting events"""
-        for events in self.poll.events[:self.poll.event_count]:
-            try:
-                event = Status(events.event)
-                #self.print_debug(event)
-            except ValueError:
-                event = events.event
-                self.print_debug('Unknown status: {}'.format(event))
-
-            if event == Status.SSP_POLL_DISABLED:
-                self.enable_validator(now=True)
-
-            if event == Status.SSP_POLL_RESET:
-                if self.essp.ssp6_host_protocol(self.sspC, 0x06) != Status.SSP_RESPONSE_OK:
-                    raise Exception("Host protocol failed")
-                    self.close()
-
-            elif event == Status.SSP_POLL_READ:
-                if events.data1 > 0:
-                    note = self.get_note(events.data1)
-                    self.last.status = event
-                    self.last.note = note
-                    self.print_debug("Note Read %s" % (note))
-                    #self.events.append((note, event))
-
-            elif event == Status.SSP_POLL_CREDIT:
-                note = self.get_note(events.data1)
-                self.last.status = event
-                self.last.note = note
-                self.print_debug("Credit %s" % (note))
-                self.events.append((note, event))
-
-            elif event == Status.SSP_POLL_STORED:
-                if (self.last.status == Status.SSP_POLL_CREDIT):
-                    self.add_note_to_storage(self.last.note)
-                    self.print_debug("Stored in payout %s" % (self.last.note))
-                    self.last = Last(None, None)
-
-            elif event == Status.SSP_POLL_STACKED:
-                if events.data1 > 0:
-                    self.last.note = self.get_note(events.data1)
-                self.stacked += self.last.note.value
-                self.print_debug("Stacked in cashbox %s" % (self.last.note))
-                #self.events.append((note, event))
-                self.last = Last(None, None)
-
-            elif event == Status.SSP_POLL_DISPENSING:
-                if events.data1 > 0:
-                    self.last.status = event
-                    self.last.note = Note(events.data1 / 100)#, events.cc.decode())
-                    self.print_debug("Dispensing %s" % (str(self.last.note)))
-                    self.events.append((self.last.note, event))
+    def _on_smart_emptied(self, event, events):
+        storage_amount = 0
+        for channel in self.storage.values():
+            storage_amount += channel.note.value * channel.amount
+            channel.amount = 0
+            self.planner.set_level(channel.note.value, channel.note.currency, 0)
+        self.stacked += storage_amount
+        self._record(EMPTIED)
+        emptied = self.note_for_value(storage_amount * 100)
+        poll_log.debug("Emptied to cashbox %s", emptied)
+        self.events.publish(Event(emptied, event))
+
+    def _on_incomplete(self, event, events):
+        poll_log.info("%s %s of %s %s", event, events.data1, events.data2, events.cc.decode())
+
+    def _on_fraud_attempt(self, event, events):
+        note = self.get_note(events.data1)
+        poll_log.warning("Fraud Attempt %s", note)
+        self.events.publish(Event(note, event))
+
+    def _on_calibration_fail(self, event, events):
+        poll_log.warning("Calibration fail: %s", FailureStatus(events.data1))
+        if events.data1 == FailureStatus.COMMAND_RECAL:
+            poll_log.info("Trying to run autocalibration")
+            self.essp.ssp6_run_calibration(self.sspC)
+
+    def poll_once(self):
+        """Poll the unit and parse the events, return the poll response status"""
+        trace = self.trace
+        if trace is not None:
+            start = monotonic()
+            trace(CommandStart(start, Command.POLL))
+        rsp_status = self.essp.ssp6_poll(self.sspC, byref(self.poll))
+        if trace is not None:
+            end = monotonic()
+            trace(CommandEnd(end, Command.POLL, rsp_status == Status.SSP_RESPONSE_OK, end - start))
+            trace(PollResult(end, rsp_status, self.poll.event_count))
+        port_reconnects = self.essp.ssp_port_reconnects(self.sspC)
+        if port_reconnects != self._port_reconnects:
+            # Since the last poll, by this poll's command or an action's
+            link_log.info("Reconnected to %s", self.com_port)
+            self._port_reconnects = port_reconnects
+        if rsp_status != Status.SSP_RESPONSE_OK:  # If there's a problem, check what is it
+            self._dump_capture_on_error()
+            if rsp_status == Status.SSP_RESPONSE_TIMEOUT:  # Timeout
+                link_log.info("SSP poll timeout on %s", self.com_port)
+                self._set_link(LinkState.DOWN)
+            elif rsp_status == Status.SSP_POLL_KEY_NOT_SET:
+                # The self has responded with key not set, so we should try to negotiate one
+                if self.essp.ssp6_setup_encryption(self.sspC, c_ulonglong( 0x123456701234567)) == Status.SSP_RESPONSE_OK:
+                    link_log.debug("Encryption setup")
                 else:
-                    self.print_debug("Dispensing")
-
-            elif event == Status.SSP_POLL_DISPENSED:
-                if events.data1 > 0:
-                    self.last.note = Note(events.data1 / 100)#, events.cc.decode())
-                self.print_debug("Dispensed %s" % (str(self.last.note)))
-                self.events.append((self.last.note, event))
-                self.last = Last(None, None)
-
-            elif event == Status.SSP_POLL_CASH_BOX_REPLACED:
-                self.stacked = 0
-                self.print_debug("Cashbox replaced")
-                self.events.append((None, event))
-
-            elif event == Status.SSP_POLL_SMART_EMPTIED:
-                storage_amount = 0
-                for channel in self.storage.values():
-                    storage_amount += channel.note.value * channel.amount
-                    channel.amount = 0
-                self.stacked += storage_amount
-                emptied = Note(storage_amount)
-                self.print_debug("Emptied to cashbox %s" % (str(emptied)))
-                self.events.append((emptied, event))
-
-            elif event == Status.SSP_POLL_INCOMPLETE_PAYOUT:
-                self.print_debug(
-                    "Incomplete payout %s of %s %s" %
-                    (events.data1, events.data2, events.cc.decode()))
-
-            elif event == Status.SSP_POLL_INCOMPLETE_FLOAT:
-                self.print_debug(
-                    "Incomplete float %s of %s %s" %
-                    (events.data1, events.data2, events.cc.decode()))
-
-            elif event == Status.SSP_POLL_FRAUD_ATTEMPT:
-                note = self.get_note(events.data1)
-                self.print_debug("Fraud Attempt %s" % (note))
-                self.events.append((note, event))
-
-            elif event == Status.SSP_POLL_CALIBRATION_FAIL:
-                self.print_debug("Calibration fail: ")
-                self.print_debug(FailureStatus(events.data1))
-                if events.data1 == Status.COMMAND_RECAL:
-                    self.print_debug("trying to run autocalibration")
-                    self.essp.ssp6_run_calibration(self.sspC)
-            
+                    link_log.warning("Encryption failed")
             else:
-                self.events.append((None, event))
+                # Not theses two, stop the program
+                raise Exception("SSP poll error {}".format(rsp_status))
+            return rsp_status
+        if self.poll.event_count > 0:
+            if not self.busy:
+                self.busy = True
+                poll_log.debug("Busy")
+            self.parse_poll()
+            if self._resync and not self.resync():
+                self._set_link(LinkState.DOWN)
+        elif self.busy:
+            self.busy = False
+            poll_log.debug("Free")
+        return rsp_status
 
     def system_loop(self):  # Looping for getting the alive signal ( obligation in eSSP6 )
-        while True:
-            rsp_status = self.essp.ssp6_poll(self.sspC, byref(self.poll))
-            if rsp_status != Status.SSP_RESPONSE_OK:  # If there's a problem, check what is it
-                if rsp_status == Status.SSP_RESPONSE_TIMEOUT:  # Timeout
-                    self.print_debug("SSP poll timeout")
-                    self.close()
-                    exit(0)
-                else:
-                    if rsp_status == Status.SSP_POLL_KEY_NOT_SET:
-                        # The self has responded with key not set, so we should try to negotiate one
-                        if self.essp.ssp6_setup_encryption(self.sspC, c_ulonglong( 0x123456701234567)) == Status.SSP_RESPONSE_OK:
-                            self.print_debug("Encryption setup")
-                        else:
-                            self.print_debug("Encryption failed")
-                    else:
-                        # Not theses two, stop the program
-                        raise Exception("SSP poll error {}".format(rsp_status))
-                        exit(1)
-            if self.poll.event_count > 0:
-                if not self.busy:
-                    self.busy = True
-                    self.print_debug("Busy")
-                self.parse_poll()
-            elif self.busy:
-                self.busy = False
-                self.print_debug("Free")
+        while not self._closing.is_set():
+            try:
+                self.poll_once()
+            except Exception as e:
+                # Whatever the unit answered, starting the session again is the way back
+                link_log.warning("Poll of %s failed: %s", self.com_port, e)
+                self._set_link(LinkState.DOWN)
+            if self.link_state != LinkState.UP and not self.recover():
+                return
             self.do_actions()
-            sleep(0.5)
+            self.scheduler.wait(self.busy)
+
+    def poll_stats(self):
+        """Poll schedule parameters and achieved jitter"""
+        return self.scheduler.stats()
+
+    def action_stats(self):
+        """Actions waiting per priority class, and how many were sent, coalesced, cancelled or expired"""
+        return self.actions.stats()
+
+    def metrics(self):
+        """Link counters and round trip histogram of every command sent so far, by command name
+
+        Round trips are in seconds, the buckets are cumulative (upper bound, replies) pairs.
+        """
+        metrics = self.essp.ssp_get_metrics(self.sspC)
+        if not metrics:
+            return {}
+        # One copy, the poll thread goes on counting into the native one
+        snapshot = SspMetrics.from_buffer_copy(metrics.contents)
+        result = {}
+        for code, command in enumerate(snapshot.Command):
+            if not command.Commands:
+                continue
+            try:
+                name = Command(code).name
+            except ValueError:
+                name = "0x%02X" % code
+            result[name] = {
+                "commands": command.Commands,
+                "replies": command.Replies,
+                "retries": command.Retries,
+                "timeouts": command.Timeouts,
+                "crc_errors": command.CrcErrors,
+                "counter_errors": command.CounterErrors,
+                "port_errors": command.PortErrors,
+                "bytes_out": command.BytesOut,
+                "bytes_in": command.BytesIn,
+                "rtt_sum": command.RttTotal / 1e6,
+                "rtt_max": command.RttMax / 1e6,
+                "rtt_buckets": tuple(zip(self.RTT_BOUNDS + (float("inf"),), accumulate(command.RttBuckets))),
+            }
+        return result
+
+    def captured_frames(self):
+        """The plain frames in the capture ring, oldest first, empty without capture"""
+        capture = self.essp.ssp_get_capture(self.sspC)
+        if not capture:
+            return []
+        capture = capture.contents
+        size, first = capture.Size, capture.Written
+        records = cast(capture.Records, POINTER(SspCaptureRecord * size)).contents
+        records = (SspCaptureRecord * size).from_buffer_copy(records)
+        last = capture.Written
+        # Frames captured while copying may be torn, and so may the ones they overwrote
+        return [Frame(record.Time / 1e6, record.Direction, record.Address, record.Status, bytes(record.Data[:record.Length]))
+                for record in (records[n % size] for n in range(max(0, last - size), first))]
+
+    def dump_capture(self, path=None):
+        """Write the capture ring to path (capture_path if None) for eSSP.replay, return the number of frames"""
+        descriptor = getattr(self, "descriptor", None)
+        header = {
+            "port": self.com_port,
+            "baud_rate": getattr(self, "baud_rate", 9600),
+            "descriptor": asdict(descriptor) if descriptor is not None else None,
+        }
+        return write_capture(path or self.capture_path, self.captured_frames(), header)
+
+    def _dump_capture_on_error(self):
+        if self.capture_path is not None:
+            try:
+                self.dump_capture()
+            except OSError as e:
+                log.warning("Capture dump failed: %s", e)
+
+    def tx_stats(self):
+        """Frames sent (retries included) and the time spent handing them to the port, in seconds"""
+        frames, last, total = c_ulong(), c_ulong(), c_ulonglong()
+        self.essp.ssp_get_tx_stats(self.sspC, byref(frames), byref(last), byref(total))
+        return {
+            "frames": frames.value,
+            "last": last.value / 1e6,
+            "mean": total.value / 1e6 / frames.value if frames.value else 0.0,
+        }
 
     def get_last_event(self):
         """Get the last event and delete it from the event list"""
-        if len(self.events) > 0:
-            event = self.events.pop(0)
-            return event
-        return None
+        return self.events.get_nowait()
+
+    def get_event(self, timeout=None):
+        """Wait up to timeout seconds for the next event, None if there was none"""
+        return self.events.get(timeout)
 
-    def enable_validator(self, now=False):
+    def subscribe(self, callback, event=None):
+        """Call callback((note, event)) from the poll thread for each event of a type, or for all"""
+        self.events.subscribe(callback, event)
+
+    def unsubscribe(self, callback, event=None):
+        self.events.unsubscribe(callback, event)
+
+    def enable_validator(self, now=False, deadline=None):
         # Send this command to enable a disabled device.
         # device: 'NV9USB', 'NV10USB', 'BV20', 'BV50', 'BV100', 'NV200', 'SMART Hopper', 'NV11'
-        if not now:       
+        if not now:
             queued_action = { "action": Actions.ENABLE_VALIDATOR }
-            self.actions.put(queued_action)
-            return
+            return self.queue_action(queued_action, deadline)
         
-        setup_req = Ssp6SetupRequestData()
         if self.essp.ssp6_enable(self.sspC) != Status.SSP_RESPONSE_OK:
-            self.print_debug("ERROR: Enable failed")
+            action_log.debug("Enable failed")
             return False
         
-        # SMART Hopper requires different inhibit commands, so use setup
-        # request to see if it is an SH
-        if self.essp.ssp6_setup_request(self.sspC, byref(setup_req)) != Status.SSP_RESPONSE_OK:
-            self.print_debug("Setup request failed")
-            return False
-        
-        if setup_req.UnitType == UnitType.SMART_HOPPER:
+        if self.unit == UnitType.SMART_HOPPER:
             # SMART Hopper requires different inhibit commands
-            for channel in setup_req.ChannelData:
-                self.essp.ssp6_set_coinmech_inhibits(self.sspC, channel.value, channel.cc, Status.ENABLED.value)
+            self._enable_coin_channels()
         else:
             if self.essp.ssp6_set_inhibits(self.sspC, 0xFF, 0xFF) != Status.SSP_RESPONSE_OK:  # Magic numbers here too
-                self.print_debug("Inhibits Failed")
+                action_log.debug("Inhibits failed")
                 return False
         
         # Set bezel color
         self.configure_bezel(0, 255, 0)
 
-    def update_payout(self, now=False):
+    def update_payout(self, now=False, deadline=None):
+        return self.refresh_inventory(now, deadline)
+
+    def refresh_inventory(self, now=False, deadline=None):
+        """Read the level of every channel and swap in the new storage in one go
+
+        One GET ALL LEVELS round trip when the unit knows it, two per channel
+        otherwise. Routes only change through this class, so they are read
+        once per channel and kept afterwards.
+        """
         if self.unit not in {UnitType.SMART_PAYOUT, UnitType.NOTE_FLOAT}:
             # No payout device
             return False
 
-        if not now:       
+        if not now:
             queued_action = { "action": Actions.UPDATE_PAYOUT }
-            self.actions.put(queued_action)
-            return
-        
+            return self.queue_action(queued_action, deadline)
+
+        levels = self._read_levels()
+        storage = {}
+        for number, channel in self.storage.items():
+            amount = levels.get(channel.note, channel.amount) if levels is not None else self._read_note_amount(channel)
+            route = channel.route if channel.route is not None else self._read_route(channel)
+            storage[number] = Channel(channel.note, amount, route)
+
+        if self.route_to_storage:
+            # Once, at start up: later changes of route are the owner's business
+            for channel in storage.values():
+                if channel.note.value <= self.route_to_storage and channel.route != Route.PAYOUT:
+                    if self.essp.ssp6_set_route(self.sspC, channel.note.value * 100, channel.note.currency.encode(), Route.PAYOUT.value) == Status.SSP_RESPONSE_OK:
+                        channel.route = Route.PAYOUT
+                        inventory_log.debug("Route to storage %s", channel.note)
+                    else:
+                        inventory_log.warning("Route to storage %s failed", channel.note)
+            self.route_to_storage = None
+
+        # Readers see either the old or the new levels, never half of each
+        self.storage = storage
+        for channel in storage.values():
+            self.planner.set_level(channel.note.value, channel.note.currency, channel.amount)
+        if self.ledger is not None:
+            self.ledger.reconcile({(channel.note.value, channel.note.currency): channel.amount for channel in storage.values()})
+
+    def _read_levels(self):
+        """Note -> level of every denomination from GET ALL LEVELS, None when the unit can't tell"""
+        if not self.all_levels:
+            return None
+        response = self.essp.ssp6_get_all_levels(self.sspC, byref(self.levels))
+        if response != Status.SSP_RESPONSE_OK:
+            if response == Response.UNKNOWN_COMMAND.value:
+                inventory_log.info("GET ALL LEVELS unknown, reading levels per channel")
+                self.all_levels = False
+            return None
+        return {Note(level.Value // 100, level.cc.decode(errors='replace')): level.Level
+                for level in self.levels.Levels[:self.levels.NumberOfDenominations]}
+
+    def _read_note_amount(self, channel):
+        if self.essp.ssp6_get_note_amount(self.sspC, channel.note.value * 100, channel.note.currency.encode()) == Status.SSP_RESPONSE_OK:
+            response_data = self._response()
+            return response_data[1] + (response_data[2] << 8)
+        return channel.amount
+
+    def _read_route(self, channel):
+        if self.essp.ssp6_get_routing(self.sspC, channel.note.value * 100, channel.note.currency.encode()) == Status.SSP_RESPONSE_OK:
+            try:
+                return Route(self._response()[1])
+            except ValueError:
+                pass
+        return None
+
+    def _set_cached_route(self, amount, currency, route):
         for channel in self.storage.values():
-            if self.essp.ssp6_get_note_amount(self.sspC, channel.note.value * 100, channel.note.currency.encode()) == Status.SSP_RESPONSE_OK:
-                response_data = cast(self.essp.ssp_get_response_data(self.sspC), POINTER(c_ubyte))
-                channel.amount = response_data[1]
-            if self.essp.ssp6_get_routing(self.sspC, channel.note.value * 100, channel.note.currency.encode()) == Status.SSP_RESPONSE_OK:
-                response_data = cast(self.essp.ssp_get_response_data(self.sspC), POINTER(c_ubyte))
-                try:
-                    channel.route = Route(response_data[1])
-                except ValueError:
-                    channel.route = None
+            if channel.note.value * 100 == amount and channel.note.currency == currency:
+                channel.route = route
 
-    def set_route_cashbox(self, amount, currency=DEFAULT_CURRENCY):
+    def set_route_cashbox(self, amount, currency=DEFAULT_CURRENCY, deadline=None):
         # This command will configure the denomination to be either routed to the cashbox on detection or stored to be made available for later possible payout.
         # device: 'SMART Hopper', 'SMART Payout', 'NV11'
         queued_action = { "action": Actions.ROUTE_TO_CASHBOX, "amount": amount*100, "currency": currency }
-        self.actions.put(queued_action)
+        return self.queue_action(queued_action, deadline)
 
-    def set_route_storage(self, amount, currency=DEFAULT_CURRENCY):
+    def set_route_storage(self, amount, currency=DEFAULT_CURRENCY, deadline=None):
         # This command will configure the denomination to be either routed to the cashbox on detection or stored to be made available for later possible payout.
         # device: 'SMART Hopper', 'SMART Payout', 'NV11'
         queued_action = { "action": Actions.ROUTE_TO_STORAGE, "amount": amount*100, "currency": currency }
-        self.actions.put(queued_action)
+        return self.queue_action(queued_action, deadline)
 
-    def payout(self, amount, currency=DEFAULT_CURRENCY):
+    def payout(self, amount, currency=DEFAULT_CURRENCY, test=False, deadline=None):
         # A command to set the monetary value to be paid by the payout unit. Using protocol version 6, the host also sends a pre-test option byte (TEST_PAYOUT_AMOUT 0x19, PAYOUT_AMOUNT 0x58), which will determine if the command amount is tested or paid out. This is useful for multi-payout systems so that the ability to pay a split down amount can be tested before committing to actual payout.
         # device: 'SMART Hopper', 'SMART Payout'
-        queued_action = { "action": Actions.PAYOUT, "amount": amount*100, "currency":currency }
-        self.actions.put(queued_action)
-
-    def get_note_amount(self, amount, currency=DEFAULT_CURRENCY):
+        # An amount the stored notes can't make fails at once; with test=True the unit tests it too before paying
+        try:
+            queued_action = self.payout_action(amount, currency, test)
+        except PayoutError as e:
+            future = Future()
+            future.set_exception(e)
+            return future
+        return self.queue_action(queued_action, deadline)
+
+    def payout_action(self, amount, currency=DEFAULT_CURRENCY, test=False):
+        """The PAYOUT action for amount with its planned notes, PayoutError if the known levels can't make it"""
+        queued_action = { "action": Actions.PAYOUT, "amount": amount*100, "currency": currency, "test": test }
+        if self.inventory_loaded is not None and self.inventory_loaded.done():
+            plan = self.plan_payout(amount, currency)
+            if plan is None:
+                if amount > self.planner.stored_value(currency):
+                    raise PayoutError("Payout impossible", reason=PayoutResponse.SMART_PAYOUT_NOT_ENOUGH.value)
+                raise PayoutError("Payout impossible", reason=PayoutResponse.SMART_PAYOUT_EXACT_AMOUNT.value)
+            queued_action["plan"] = plan
+        return queued_action
+
+    def can_pay(self, amount, currency=DEFAULT_CURRENCY):
+        """Whether the stored notes make exactly amount, from the tracked levels without asking the unit"""
+        return self.planner.can_pay(amount, currency)
+
+    def plan_payout(self, amount, currency=DEFAULT_CURRENCY):
+        """{Note: count} paying exactly amount from the stored notes, largest first, or None"""
+        plan = self.planner.plan(amount, currency)
+        if plan is None:
+            return None
+        return {Note(value, currency): count for value, count in plan.items()}
+
+    def get_note_amount(self, amount, currency=DEFAULT_CURRENCY, deadline=None):
         # This command returns the level of a denomination stored in a payout device as a 2 byte value. In protocol versions greater or equal to 6, the host adds a 3 byte ascii country code to give multi-currency functionality. Send the requested denomination to find its level. In this case a request to find the amount of 0.10c coins in protocol version 5.
         # device: 'SMART Hopper', 'SMART Payout'
         queued_action = { "action": Actions.GET_NOTE_AMOUNT, "amount": amount*100, "currency": currency }
-        self.actions.put(queued_action)
+        return self.queue_action(queued_action, deadline)
+
+    def download_file(self, path, progress=None, block_retries=3, deadline=None):
+        """Download an ITL firmware or dataset file to the unit, return a Future of the final DownloadProgress
+
+        Polling stops for the transfer, which goes at the rate the file asks
+        for; progress(DownloadProgress) is called from the poll thread after
+        each block, a block the unit got wrong is sent again up to
+        `block_retries` times. The unit restarts with the file and is then
+        reconnected and described again like after a lost link.
+        """
+        queued_action = { "action": Actions.DOWNLOAD, "path": path, "progress": progress, "block_retries": block_retries }
+        return self.queue_action(queued_action, deadline)
+
+    def _download(self, path, progress, block_retries):
+        start = monotonic()
+        last = [DownloadProgress(0, 0, 0, 0, 0.0)]
+
+        def report(block, blocks, sent, retries):
+            last[0] = DownloadProgress(block, blocks, sent, retries, monotonic() - start)
+            if progress is not None:
+                try:
+                    progress(last[0])
+                except Exception as e:
+                    download_log.warning("Download progress callback failed: %s", e)
+
+        callback = DownloadCallback(report)
+        with self._port_lock:
+            status = self.essp.DownloadFileToPort(self.sspC, path.encode(), self.com_port.encode(), block_retries, callback)
+        download_log.info("Download %s: 0x%06X", path, status)
+        if status in (DownloadStatus.OPEN_FILE_ERROR, DownloadStatus.READ_FILE_ERROR, DownloadStatus.NOT_ITL_FILE, DownloadStatus.IN_PROGRESS):
+            # Nothing was sent, the session goes on
+            raise DownloadError("Download of %s failed" % path, status)
+        # The unit restarts into the new file, or stays in its loader: a new session either way
+        self._describe = True
+        self._set_link(LinkState.DOWN)
+        if status != DownloadStatus.COMPLETE:
+            raise DownloadError("Download of %s failed" % path, status)
+        return last[0]
 
     def reset(self):
-        self.print_debug("Starting reset")
+        action_log.debug("Starting reset")
         self.essp.ssp6_reset(self.sspC)
-        self.print_debug("Reset complete")
+        action_log.debug("Reset complete")
 
-    def empty_storage(self):
+    def empty_storage(self, deadline=None):
         # Empties payout device of contents, maintaining a count of value emptied. The current total value emptied is given is response to a poll command. All coin counters will be set to 0 after running this command. Use Cashbox Payout Operation Data command to retrieve a breakdown of the denomination routed to the cashbox through this operation.
         # device: 'SMART Hopper', 'SMART Payout', 'NV11'
         queued_action = { "action": Actions.EMPTY_STORAGE }
-        self.actions.put(queued_action)
+        return self.queue_action(queued_action, deadline)
 
-    def disable_payout(self):
+    def disable_payout(self, deadline=None):
         # All accepted notes will be routed to the stacker and payout commands will not be accepted.
         # device: 'SMART Payout', 'NV11'
         queued_action = { "action": Actions.DISABLE_PAYOUT }
-        self.actions.put(queued_action)
+        return self.queue_action(queued_action, deadline)
 
-    def disable_validator(self):
+    def disable_validator(self, deadline=None):
         # The peripheral will switch to its disabled state, it will not execute any more commands or perform any actions until enabled, any poll commands will report disabled.
         # device: 'NV9USB', 'NV10USB', 'BV20', 'BV50', 'BV100', 'NV200', 'SMART Hopper', 'NV11'
         queued_action = { "action": Actions.DISABLE_VALIDATOR }
-        self.actions.put(queued_action)
+        return self.queue_action(queued_action, deadline)
 
-    def configure_bezel(self, red, green, blue, volatile = 0):
+    def configure_bezel(self, red, green, blue, volatile = 0, deadline=None):
         # This command allows the host to configure a supported BNV bezel. If the bezel is not supported the command will return generic response COMMAND NOT KNOWN 0xF2.
         # device: 'NV200'
         queued_action = { "action": Actions.CONFIGURE_BEZEL, "red": red, "green": green, "blue": blue, "volatile": volatile }
-        self.actions.put(queued_action)
+        return self.queue_action(queued_action, deadline)
 
     def __str__(self):
         cashbox_text = f"Cashbox: {self.stacked} {DEFAULT_CURRENCY}\n"
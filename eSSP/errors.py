@@ -0,0 +1,47 @@
+from .constants import Response, PayoutResponse, DownloadStatus
+
+
+class SSPError(Exception):
+    """The unit refused a command or did not answer it"""
+
+    def __init__(self, message, response=None):
+        try:
+            response = Response(response)
+        except ValueError:
+            pass
+        self.response = response
+        if response is not None:
+            message = "%s: %s" % (message, response)
+        super().__init__(message)
+
+
+class PayoutError(SSPError):
+    """A payout request was refused, `reason` tells why"""
+
+    def __init__(self, message, response=None, reason=None):
+        try:
+            reason = PayoutResponse(reason)
+        except ValueError:
+            pass
+        self.reason = reason
+        super().__init__(message, response)
+        if reason is not None:
+            self.args = ("%s, %s" % (self.args[0], reason),)
+
+
+class DownloadError(SSPError):
+    """A file download failed, `status` tells where"""
+
+    def __init__(self, message, status=None):
+        try:
+            status = DownloadStatus(status)
+        except ValueError:
+            pass
+        self.status = status
+        super().__init__(message)
+        if status is not None:
+            self.args = ("%s: %s" % (self.args[0], status),)
+
+
+class ActionExpired(TimeoutError):
+    """A queued action was not sent before its deadline"""
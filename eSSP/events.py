@@ -0,0 +1,94 @@
+import threading
+from collections import deque
+
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+
+
+class EventBus(object):
+    """Bounded, thread-safe queue of (note, event) tuples with per-event callbacks
+
+    The poll thread publishes, any number of threads consume with get().
+    When the queue is full the oldest (or the new) event is dropped and
+    counted, so a stalled consumer can't grow memory without limit.
+    Callbacks run in the publishing thread, before the event is queued.
+    """
+
+    def __init__(self, maxlen=1024, overflow=DROP_OLDEST):
+        if overflow not in (DROP_OLDEST, DROP_NEWEST):
+            raise ValueError("Unknown overflow policy %s" % overflow)
+        if maxlen < 1:
+            raise ValueError("maxlen must be at least 1")
+        self.maxlen = maxlen
+        self.overflow = overflow
+        self._events = deque()
+        self._cond = threading.Condition()
+        self._callbacks = {}
+        self.published = 0
+        self.dropped = 0
+        self.callback_errors = 0
+
+    def subscribe(self, callback, event=None):
+        """Call callback((note, event)) for every event of this type, or for all events if None"""
+        key = None if event is None else int(event)
+        with self._cond:
+            # Copy on write, publish() iterates without the lock
+            self._callbacks[key] = self._callbacks.get(key, ()) + (callback,)
+
+    def unsubscribe(self, callback, event=None):
+        key = None if event is None else int(event)
+        with self._cond:
+            callbacks = tuple(c for c in self._callbacks.get(key, ()) if c != callback)
+            if callbacks:
+                self._callbacks[key] = callbacks
+            else:
+                self._callbacks.pop(key, None)
+
+    def publish(self, item):
+        if self._callbacks:
+            event = item[1]
+            for callback in self._callbacks.get(None, ()) + self._callbacks.get(int(event), ()):
+                try:
+                    callback(item)
+                except Exception:
+                    self.callback_errors += 1
+        with self._cond:
+            self.published += 1
+            if len(self._events) >= self.maxlen:
+                self.dropped += 1
+                if self.overflow == DROP_NEWEST:
+                    return
+                self._events.popleft()
+            self._events.append(item)
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """Oldest event, waiting up to timeout seconds (forever if None); None if there is none"""
+        with self._cond:
+            if not self._events and not self._cond.wait_for(lambda: self._events, timeout):
+                return None
+            return self._events.popleft()
+
+    def get_nowait(self):
+        with self._cond:
+            if self._events:
+                return self._events.popleft()
+            return None
+
+    def clear(self):
+        with self._cond:
+            self._events.clear()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "queued": len(self._events),
+                "maxlen": self.maxlen,
+                "overflow": self.overflow,
+                "published": self.published,
+                "dropped": self.dropped,
+                "callback_errors": self.callback_errors,
+            }
+
+    def __len__(self):
+        return len(self._events)
@@ -0,0 +1,205 @@
+import mmap
+import os
+import struct
+import threading
+import zlib
+from time import time
+
+MAGIC = b"ESSPLDG1"
+
+# kind, count, value, currency, time in microseconds, crc32 of what comes before
+RECORD = struct.Struct("<BxHI3sxqI")
+
+CREDIT = 1      # a note was accepted, where it went follows
+STORED = 2      # a note went to the payout
+STACKED = 3     # a note went to the cashbox
+DISPENSED = 4   # value was paid out, the levels follow at the next reconciliation
+EMPTIED = 5     # the payout was emptied into the cashbox
+LEVEL = 6       # absolute level of a denomination, from the unit or a snapshot
+CASHBOX = 7     # absolute cashbox total, from a snapshot or a cashbox swap
+
+
+class LedgerState(object):
+    """Counts rebuilt from the records"""
+
+    def __init__(self):
+        self.levels = {}   # (value, currency) -> notes in the payout
+        self.cashbox = 0   # value stacked in the cashbox
+        # Since the last snapshot
+        self.credits = 0
+        self.dispensed = 0
+
+    def apply(self, kind, count, value, currency):
+        if kind == CREDIT:
+            self.credits += count
+        elif kind == STORED:
+            key = (value, currency)
+            self.levels[key] = self.levels.get(key, 0) + count
+        elif kind == STACKED:
+            self.cashbox += value * count
+        elif kind == DISPENSED:
+            self.dispensed += value
+        elif kind == EMPTIED:
+            self.cashbox += sum(value * level for (value, _), level in self.levels.items())
+            self.levels = dict.fromkeys(self.levels, 0)
+        elif kind == LEVEL:
+            self.levels[(value, currency)] = count
+        elif kind == CASHBOX:
+            self.cashbox = value
+
+
+class Ledger(object):
+    """Append-only, crash-safe file of what went in and out of the unit
+
+    Records are fixed size and each carries its own CRC, so a record torn by
+    a crash is detected and cut off when the file is replayed. append() never
+    blocks on the disk: a writer thread collects whatever was appended since
+    its last pass, writes it at once and makes it durable with a single fsync
+    (group commit). Every `compact_every` records the file is rewritten as a
+    snapshot of the current levels, keeping replay short.
+    """
+
+    def __init__(self, path, commit_interval=0.005, compact_every=10000):
+        self.path = path
+        self.commit_interval = commit_interval
+        self.compact_every = compact_every
+        self.state = LedgerState()
+        self.records = 0
+        self.commits = 0
+        self.compactions = 0
+        self.truncated = 0
+        self._pending = []
+        self._appended = 0
+        self._durable = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self.replay()
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        self._thread = threading.Thread(target=self._writer, daemon=True)
+        self._thread.start()
+
+    def replay(self):
+        """Rebuild the state from the file, cutting off anything after the first bad record"""
+        if not os.path.exists(self.path) or os.path.getsize(self.path) < len(MAGIC):
+            self._write_file([])
+            return
+        with open(self.path, "r+b") as f:
+            size = os.fstat(f.fileno()).st_size
+            with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as data:
+                if data[:len(MAGIC)] != MAGIC:
+                    raise ValueError("%s is not a ledger" % self.path)
+                offset = len(MAGIC)
+                while offset + RECORD.size <= size:
+                    kind, count, value, currency, _, crc = RECORD.unpack_from(data, offset)
+                    if zlib.crc32(data[offset:offset + RECORD.size - 4]) != crc:
+                        break
+                    self.state.apply(kind, count, value, currency.decode(errors="replace"))
+                    self.records += 1
+                    offset += RECORD.size
+            if offset != size:
+                # Torn or damaged tail, appending after it would hide the new records
+                self.truncated += size - offset
+                f.truncate(offset)
+                os.fsync(f.fileno())
+
+    @staticmethod
+    def _pack(kind, count, value, currency):
+        record = RECORD.pack(kind, count, value, currency.encode()[:3], int(time() * 1e6), 0)
+        return record[:-4] + struct.pack("<I", zlib.crc32(record[:-4]))
+
+    def append(self, kind, count=1, value=0, currency=""):
+        """Record an event, it is durable once flush() returns"""
+        record = self._pack(kind, count, value, currency)
+        with self._cond:
+            if self._closed:
+                raise ValueError("Ledger is closed")
+            self.state.apply(kind, count, value, currency)
+            self._pending.append(record)
+            self._appended += 1
+            self._cond.notify_all()
+
+    def reconcile(self, levels, cashbox=None):
+        """Record the levels the unit reported where they differ from the ledger's, return how many did"""
+        differ = 0
+        for (value, currency), count in levels.items():
+            if self.state.levels.get((value, currency)) != count:
+                self.append(LEVEL, count, value, currency)
+                differ += 1
+        if cashbox is not None and cashbox != self.state.cashbox:
+            self.append(CASHBOX, 0, cashbox)
+            differ += 1
+        return differ
+
+    def flush(self, timeout=None):
+        """Wait until everything appended so far is on disk"""
+        with self._cond:
+            target = self._appended
+            return self._cond.wait_for(lambda: self._durable >= target, timeout)
+
+    def close(self):
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+        os.close(self._fd)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "records": self.records,
+                "pending": len(self._pending),
+                "commits": self.commits,
+                "compactions": self.compactions,
+                "truncated": self.truncated,
+            }
+
+    def _writer(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending or self._closed)
+                if not self._pending and self._closed:
+                    return
+            if self.commit_interval and not self._closed:
+                # Let a burst of notes gather into the same commit
+                with self._cond:
+                    self._cond.wait_for(lambda: self._closed, self.commit_interval)
+            with self._cond:
+                batch, self._pending = self._pending, []
+                appended = self._appended
+            os.write(self._fd, b"".join(batch))
+            os.fsync(self._fd)
+            with self._cond:
+                self.records += len(batch)
+                self.commits += 1
+                if self.compact_every and self.records >= self.compact_every:
+                    self._compact()
+                    appended = self._appended
+                self._durable = appended
+                self._cond.notify_all()
+
+    def _compact(self):
+        # Under the lock: nothing is appended while the file is swapped
+        records = [self._pack(LEVEL, count, value, currency) for (value, currency), count in self.state.levels.items()]
+        records.append(self._pack(CASHBOX, 0, self.state.cashbox, ""))
+        # The pending records are applied to the state already
+        self._write_file(records)
+        os.close(self._fd)
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+        self.records = len(records)
+        self._pending = []
+        self.compactions += 1
+
+    def _write_file(self, records):
+        tmp = "%s.%d.tmp" % (self.path, os.getpid())
+        with open(tmp, "wb") as f:
+            f.write(MAGIC + b"".join(records))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
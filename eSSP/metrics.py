@@ -0,0 +1,68 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# eSSP.metrics() key, metric name, help text
+COUNTERS = (
+    ("commands", "essp_commands_total", "Commands sent"),
+    ("replies", "essp_replies_total", "Commands answered"),
+    ("retries", "essp_retries_total", "Frames sent again for want of a reply"),
+    ("timeouts", "essp_timeouts_total", "Commands left unanswered after all retries"),
+    ("crc_errors", "essp_crc_errors_total", "Reply frames or decrypted packets with a bad CRC"),
+    ("counter_errors", "essp_counter_errors_total", "Encrypted replies with the wrong packet counter"),
+    ("port_errors", "essp_port_errors_total", "Reads or writes the serial port refused"),
+    ("bytes_out", "essp_bytes_sent_total", "Bytes written to the line"),
+    ("bytes_in", "essp_bytes_received_total", "Bytes read from the line"),
+)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _labels(**labels):
+    return ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                    for name, value in labels.items())
+
+
+def prometheus_text(*validators):
+    """eSSP.metrics() of every validator in the Prometheus text format, labelled by port and command"""
+    snapshots = [(validator.com_port, validator.metrics()) for validator in validators]
+    lines = []
+    for key, name, text in COUNTERS:
+        lines.append("# HELP %s %s" % (name, text))
+        lines.append("# TYPE %s counter" % name)
+        for unit, snapshot in snapshots:
+            for command, metrics in snapshot.items():
+                lines.append("%s{%s} %d" % (name, _labels(unit=unit, command=command), metrics[key]))
+    lines.append("# HELP essp_rtt_seconds Time from sending a command to its reply")
+    lines.append("# TYPE essp_rtt_seconds histogram")
+    for unit, snapshot in snapshots:
+        for command, metrics in snapshot.items():
+            for bound, count in metrics["rtt_buckets"]:
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append("essp_rtt_seconds_bucket{%s} %d" % (_labels(unit=unit, command=command, le=le), count))
+            labels = _labels(unit=unit, command=command)
+            lines.append("essp_rtt_seconds_sum{%s} %r" % (labels, metrics["rtt_sum"]))
+            lines.append("essp_rtt_seconds_count{%s} %d" % (labels, metrics["replies"]))
+    return "\n".join(lines) + "\n"
+
+
+def serve_prometheus(validators, port=9464, host=""):
+    """Answer scrapes of /metrics from a daemon thread, return the server (shutdown() stops it)"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = prometheus_text(*validators).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
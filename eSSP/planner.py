@@ -0,0 +1,137 @@
+import threading
+from functools import reduce
+from itertools import accumulate
+from math import gcd
+
+
+def _multiply(ways, m):
+    """ways * (1 - x^m), cut to the length of ways"""
+    if m < len(ways):
+        ways[m:] = [a - b for a, b in zip(ways[m:], ways)]
+
+
+def _divide(ways, m):
+    """ways / (1 - x^m), cut to the length of ways"""
+    for r in range(min(m, len(ways))):
+        ways[r::m] = list(accumulate(ways[r::m]))
+
+
+class _Stock(object):
+    """Stored notes of one currency and the number of ways to pay every amount with them
+
+    ways[a] is the coefficient of x^a in the product, over the denominations,
+    of 1 + x^v + x^2v + ... + x^cv for c notes of value v, amounts counted in
+    steps of the greatest common divisor of the values. Going from c to c'
+    notes multiplies by (1 - x^(c'+1)v) / (1 - x^(c+1)v): two passes over
+    the table, however many notes came or went.
+    """
+
+    def __init__(self):
+        self.levels = {}
+        self.step = 0
+        self.ways = [1]
+
+    def set_level(self, value, count):
+        old = self.levels.get(value)
+        if old == count:
+            return
+        self.levels[value] = count
+        if old is None and gcd(self.step, value) != self.step:
+            self._rebuild()
+            return
+        k = value // self.step
+        size = self._size()
+        if size > len(self.ways):
+            self.ways.extend([0] * (size - len(self.ways)))
+        _multiply(self.ways, (count + 1) * k)
+        _divide(self.ways, ((old or 0) + 1) * k)
+        del self.ways[size:]
+
+    def _size(self):
+        return sum(value // self.step * count for value, count in self.levels.items()) + 1
+
+    def _rebuild(self):
+        self.step = reduce(gcd, self.levels)
+        self.ways = [1] + [0] * (self._size() - 1)
+        for value, count in self.levels.items():
+            k = value // self.step
+            _multiply(self.ways, (count + 1) * k)
+            _divide(self.ways, k)
+
+    def can_pay(self, amount):
+        if amount == 0:
+            return True
+        if not self.step or amount % self.step:
+            return False
+        amount //= self.step
+        return amount < len(self.ways) and self.ways[amount] > 0
+
+    def plan(self, amount):
+        """value -> notes, largest notes first, or None"""
+        if not self.can_pay(amount):
+            return None
+        if amount == 0:
+            return {}
+        rest = amount // self.step
+        ways = self.ways[:rest + 1]
+        plan = {}
+        for value in sorted(self.levels, reverse=True):
+            count, k = self.levels[value], value // self.step
+            # Leaves the ways to pay with the smaller notes only
+            _multiply(ways, k)
+            _divide(ways, (count + 1) * k)
+            for n in range(min(count, rest // k), -1, -1):
+                if ways[rest - n * k] > 0:
+                    break
+            if n:
+                plan[value] = n
+                rest -= n * k
+        return plan
+
+
+class PayoutPlanner(object):
+    """Tells at once whether an amount can be paid from the stored notes, and with which
+
+    Levels are whole notes per (value, currency), values in whole currency
+    units like payout() takes them. Every level change updates a table of
+    the number of ways to pay each amount, so a question costs one lookup
+    and a breakdown one pass per denomination.
+    """
+
+    def __init__(self):
+        self._stock = {}
+        self._lock = threading.Lock()
+
+    def set_level(self, value, currency, count):
+        with self._lock:
+            self._stock.setdefault(currency, _Stock()).set_level(value, max(count, 0))
+
+    def add(self, value, currency, count=1):
+        with self._lock:
+            stock = self._stock.setdefault(currency, _Stock())
+            stock.set_level(value, max(stock.levels.get(value, 0) + count, 0))
+
+    def remove(self, value, currency, count=1):
+        self.add(value, currency, -count)
+
+    def level(self, value, currency):
+        with self._lock:
+            return self._stock[currency].levels.get(value, 0) if currency in self._stock else 0
+
+    def stored_value(self, currency):
+        with self._lock:
+            stock = self._stock.get(currency)
+            return sum(value * count for value, count in stock.levels.items()) if stock else 0
+
+    def can_pay(self, amount, currency):
+        with self._lock:
+            stock = self._stock.get(currency)
+            return amount == 0 if stock is None else stock.can_pay(amount)
+
+    def plan(self, amount, currency):
+        """value -> number of notes paying exactly amount, or None if the stored notes can't"""
+        with self._lock:
+            stock = self._stock.get(currency)
+            if stock is None:
+                return {} if amount == 0 else None
+            return stock.plan(amount)
@@ -0,0 +1,110 @@
+# !/usr/bin/env python3
+"""Feed the poll replies of a capture back through the poll decoding, offline
+
+    PYTHONPATH=. python3 -m eSSP.replay /var/log/essp.cap
+    PYTHONPATH=. python3 -m eSSP.replay /var/log/essp.cap --frames
+    PYTHONPATH=. python3 -m eSSP.replay /var/log/essp.cap --rounds 1000
+
+Every successful reply to a POLL is decoded by the library's ssp6_decode_poll
+and handed to eSSP.parse_poll(), exactly as the poll loop does it, and the
+events that come out are printed. Commands the handlers would have sent are
+listed instead of sent. With --rounds the replies are decoded that many times
+over and only the timing is printed.
+"""
+import argparse
+from ctypes import byref, create_string_buffer
+from time import perf_counter
+
+from . import eSSP
+from .capture import TX, RX, REPLY_OK, read_capture
+from .constants import Command, Status
+from .descriptor import UnitDescriptor
+
+
+class _NoDevice(object):
+    """Decodes with the native library, records the commands it is asked to send"""
+
+    def __init__(self, lib):
+        self.ssp6_decode_poll = lib.ssp6_decode_poll
+        self.sent = []
+
+    def __getattr__(self, name):
+        def send(*args):
+            self.sent.append(name)
+            return Status.SSP_RESPONSE_OK.value
+        return send
+
+
+class ReplayESSP(eSSP):
+    """An eSSP without a port, set up from the descriptor a capture was taken with"""
+
+    def __init__(self, descriptor, debug=False):
+        self._init_state(None, debug)
+        self.essp = _NoDevice(eSSP.essp)
+        self.sspC = None
+        self._load_descriptor(descriptor, {})
+
+    def decode(self, data):
+        """Decode one poll reply into self.poll, like ssp6_poll does after receiving it"""
+        self.essp.ssp6_decode_poll(create_string_buffer(bytes(data), 255), len(data), byref(self.poll))
+        return self.poll
+
+
+def poll_replies(frames):
+    """Reply data of every answered POLL, in capture order"""
+    replies = []
+    command = None
+    for frame in frames:
+        if frame.direction == TX:
+            command = frame.data[0] if frame.data else None
+        elif frame.direction == RX:
+            if command == Command.POLL.value and frame.status == REPLY_OK and frame.data[:1] == bytes((Status.SSP_RESPONSE_OK.value,)):
+                replies.append(frame.data)
+            command = None
+    return replies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("capture", help="file written by eSSP.dump_capture()")
+    parser.add_argument("--frames", action="store_true", help="print every captured frame first")
+    parser.add_argument("--rounds", type=int, default=0, help="time this many passes instead of printing events")
+    args = parser.parse_args()
+
+    header, frames = read_capture(args.capture)
+    if header.get("descriptor") is None:
+        parser.error("%s was captured before the unit was described" % args.capture)
+    descriptor = UnitDescriptor.from_dict(header["descriptor"])
+    validator = ReplayESSP(descriptor)
+    replies = poll_replies(frames)
+    print("%s, %d frames, %d poll replies" % (header.get("port"), len(frames), len(replies)))
+
+    if args.frames:
+        for frame in frames:
+            print(frame)
+
+    if args.rounds:
+        elapsed = 0.0
+        for _ in range(args.rounds):
+            # Every pass starts from the same levels, as the capture did
+            validator = ReplayESSP(descriptor)
+            start = perf_counter()
+            for data in replies:
+                validator.parse_poll(validator.decode(data))
+            elapsed += perf_counter() - start
+        print("per poll %8.2f us" % (elapsed / (args.rounds * len(replies) or 1) * 1e6))
+        return
+
+    for data in replies:
+        validator.parse_poll(validator.decode(data))
+        while True:
+            event = validator.events.get_nowait()
+            if event is None:
+                break
+            print("%-24s %s" % (event.event, event.note if event.note is not None else ""))
+    if validator.essp.sent:
+        print("would have sent: %s" % ", ".join(validator.essp.sent))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import threading
+from time import monotonic
+
+# The unit disables itself when it is not polled for this long
+POLL_WATCHDOG = 5.0
+
+
+class PollScheduler(object):
+    """Decide when the next poll goes on the wire
+
+    Polls every `busy_interval` while the unit reports events, then backs off
+    by `backoff` per quiet poll up to `idle_interval`. `wake()` cuts the
+    current wait short, e.g. when an action has been queued.
+    """
+
+    def __init__(self, idle_interval=0.5, busy_interval=0.05, backoff=2.0, watchdog=POLL_WATCHDOG):
+        if not 0 < busy_interval <= idle_interval:
+            raise ValueError("busy_interval must be positive and not above idle_interval")
+        if idle_interval > watchdog / 2:
+            raise ValueError("idle_interval %s is too close to the %s s poll watchdog" % (idle_interval, watchdog))
+        if backoff < 1:
+            raise ValueError("backoff must be at least 1")
+        self.idle_interval = idle_interval
+        self.busy_interval = busy_interval
+        self.backoff = backoff
+        self.watchdog = watchdog
+        self.interval = busy_interval
+        self._wakeup = threading.Event()
+        self._last = monotonic()
+        self.polls = 0
+        self.wakeups = 0
+        self.jitter_total = 0.0
+        self.jitter_max = 0.0
+
+    def wake(self):
+        """Poll as soon as possible"""
+        self._wakeup.set()
+
+    def next_interval(self, busy):
+        """Interval to the next poll, after a poll that did (busy) or did not report events"""
+        if busy:
+            self.interval = self.busy_interval
+        else:
+            self.interval = min(self.interval * self.backoff, self.idle_interval)
+        return self.interval
+
+    def wait(self, busy):
+        """Sleep until the next poll is due; return True if woken early"""
+        deadline = self.due(busy)
+        self._wakeup.wait(max(deadline - monotonic(), 0))
+        return self.polled(deadline)
+
+    def due(self, busy):
+        """When the next poll is due, once per poll for whoever waits for it instead of wait()"""
+        return self._last + self.next_interval(busy)
+
+    def woken(self):
+        return self._wakeup.is_set()
+
+    def polled(self, deadline):
+        """Count the poll going out now for the `deadline` due() gave; return True if it was woken early"""
+        woken = self._wakeup.is_set()
+        self._wakeup.clear()
+        now = monotonic()
+        self._last = now
+        self.polls += 1
+        if woken:
+            self.wakeups += 1
+            # Work is waiting, poll fast until the unit goes quiet again
+            self.interval = self.busy_interval
+        else:
+            jitter = max(now - deadline, 0.0)
+            self.jitter_total += jitter
+            self.jitter_max = max(self.jitter_max, jitter)
+        return woken
+
+    def stats(self):
+        """Schedule parameters and the timing achieved so far"""
+        timed = self.polls - self.wakeups
+        return {
+            "idle_interval": self.idle_interval,
+            "busy_interval": self.busy_interval,
+            "backoff": self.backoff,
+            "watchdog": self.watchdog,
+            "interval": self.interval,
+            "polls": self.polls,
+            "wakeups": self.wakeups,
+            "jitter_mean": self.jitter_total / timed if timed else 0.0,
+            "jitter_max": self.jitter_max,
+        }
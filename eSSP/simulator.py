@@ -0,0 +1,830 @@
+# !/usr/bin/env python3
+"""Software NV200 / SMART Payout stand-in speaking SSP on a pseudo-terminal"""
+import os
+import random
+import select
+import socket
+import termios
+import threading
+import tty
+from collections import deque
+from ctypes import c_ubyte, c_ulonglong, create_string_buffer
+from dataclasses import dataclass
+from time import monotonic, sleep
+from .constants import Status, Response, PayoutResponse, UnitType, Route, Command
+
+SSP_STX = 0x7F
+SSP_STEX = 0x7E
+CRC_SSP_SEED = 0xFFFF
+CRC_SSP_POLY = 0x8005
+C_AES_MODE_ECB = 1
+DEFAULT_FIXED_KEY = 0x0123456701234567
+
+TEST_PAYOUT_AMOUNT = Status.SSP6_OPTION_BYTE_TEST.value
+# Set baud rate argument -> bits per second
+BAUD_RATES = {0: 9600, 1: 38400, 2: 115200}
+SSP_PROGRAM_RAM = 0x03
+# Byte the download loader acknowledges its start and the header with
+LOADER_ACK = 0x32
+TERMIOS_SPEEDS = {getattr(termios, "B%d" % rate): rate for rate in (9600, 19200, 38400, 57600, 115200)}
+
+
+def _crc_table():
+    table = []
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ CRC_SSP_POLY) & 0xFFFF
+            else:
+                crc = (crc << 1) & 0xFFFF
+        table.append(crc)
+    return table
+
+CRC_TABLE = _crc_table()
+
+def crc16(data, seed=CRC_SSP_SEED):
+    """Table driven equivalent of cal_crc_loop_CCITT_A"""
+    crc = seed
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFF) ^ CRC_TABLE[((crc >> 8) ^ byte) & 0xFF]
+    return crc
+
+def stuff(frame):
+    """Build a wire frame from address/seq byte and data, with CRC and byte stuffing"""
+    crc = crc16(frame)
+    body = bytes(frame) + bytes((crc & 0xFF, crc >> 8))
+    return bytes((SSP_STX,)) + body.replace(b'\x7f', b'\x7f\x7f')
+
+
+class FrameReader(object):
+    """Framing state machine, the device side counterpart of SSPDataIn"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.buffer = bytearray()
+        self.check_stuff = False
+        self.length = 3
+
+    def feed(self, data):
+        """Feed received bytes, return the list of complete (address byte, data) frames"""
+        frames = []
+        for byte in data:
+            if not self.buffer:
+                if byte == SSP_STX:
+                    self.buffer.append(byte)
+                continue
+            if self.check_stuff:
+                self.check_stuff = False
+                if byte != SSP_STX:
+                    # A lone STX starts a new packet
+                    self.buffer = bytearray((SSP_STX, byte))
+                    self.length = 3
+                    continue
+                self.buffer.append(byte)
+            elif byte == SSP_STX:
+                self.check_stuff = True
+                continue
+            else:
+                self.buffer.append(byte)
+            if len(self.buffer) == 3:
+                self.length = self.buffer[2] + 5
+            if len(self.buffer) == self.length:
+                packet = bytes(self.buffer)
+                self.reset()
+                crc = crc16(packet[1:-2])
+                if packet[-2] == crc & 0xFF and packet[-1] == crc >> 8:
+                    frames.append((packet[1], packet[3:-2]))
+        return frames
+
+
+class Loader(object):
+    """Download loader a device runs after PROGRAM, fed the raw bytes of the transfer
+
+    The RAM part is answered with the checksum from the header; after the
+    restart into the loader the start byte and the header are acknowledged,
+    then every block is answered with the XOR of what was received, and
+    only taken when the host's checksum agrees.
+    """
+
+    def __init__(self, device, header, block_size):
+        self.device = device
+        self.header = header
+        self.block_size = block_size
+        self.ram_bytes = int.from_bytes(header[7:11], 'big')
+        main_bytes = int.from_bytes(header[17:21], 'big')
+        header_block = int.from_bytes(header[0x3e:0x40], 'big') or 4096
+        self.blocks = -(-main_bytes // header_block)
+        self.baud_rate = 38400
+        if header[5] not in (0x09, 0x0A):
+            self.baud_rate = int.from_bytes(header[68:72], 'big') or 38400
+        self.phase = "ram"
+        self.buffer = bytearray()
+        self.data = bytearray()
+        self.retries = 0
+
+    def feed(self, data):
+        """Take received bytes, return the bytes to answer with"""
+        reply = bytearray()
+        for byte in data:
+            self.buffer.append(byte)
+            if self.phase == "ram" and len(self.buffer) == self.ram_bytes:
+                reply.append(self.header[0x10])
+                self.phase, self.buffer = "start", bytearray()
+            elif self.phase == "start":
+                if byte == self.header[6]:
+                    reply.append(LOADER_ACK)
+                    self.phase = "header"
+                self.buffer = bytearray()
+            elif self.phase == "header" and len(self.buffer) == 128:
+                if bytes(self.buffer) == bytes(self.header):
+                    reply.append(LOADER_ACK)
+                    self.phase = "blocks"
+                self.buffer = bytearray()
+            elif self.phase == "blocks" and len(self.buffer) == self.block_size + 1:
+                block = bytes(self.buffer[:-1])
+                self.buffer = bytearray()
+                chk = 0
+                for value in block:
+                    chk ^= value
+                if self.device.corrupt_blocks:
+                    self.device.corrupt_blocks -= 1
+                    chk ^= 0xFF
+                reply.append(chk)
+                if chk != byte:
+                    self.retries += 1
+                    continue
+                self.data += block
+                if len(self.data) == self.blocks * self.block_size:
+                    self.device.downloaded = bytes(self.header) + bytes(self.data)
+                    self.device.power_cycle()
+                    break
+        return bytes(reply)
+
+
+@dataclass
+class SimChannel:
+    value: int
+    currency: str
+    level: int = 0
+    route: Route = Route.CASHBOX
+
+
+class SimulatedDevice(object):
+    """State and command handling of one SSP slave on the simulated line"""
+
+    def __init__(self, address=0, channels=None, unit_type=UnitType.SMART_PAYOUT, firmware="0400",
+                 serial=12345678, fixed_key=DEFAULT_FIXED_KEY, note_step_time=0.0, dispense_time=0.0):
+        self.address = address
+        self.unit_type = unit_type
+        self.firmware = firmware
+        self.serial = serial
+        self.fixed_key = fixed_key
+        # Time between two stages of a note insertion and per dispensed note
+        self.note_step_time = note_step_time
+        self.dispense_time = dispense_time
+        if channels is None:
+            channels = [(50, "RUB"), (100, "RUB"), (200, "RUB"), (500, "RUB"), (1000, "RUB"), (2000, "RUB"), (5000, "RUB")]
+        self.channels = [SimChannel(value, currency) for value, currency in channels]
+        self.cashbox = 0
+        self.bezel = (0, 0, 0)
+        self.commands = 0
+        # Rate a power cycle comes back at, changed by a persistent set baud rate
+        self.default_baud_rate = 9600
+        # Block size the loader asks for, what the last complete download sent, blocks to take in damaged
+        self.download_block_size = 4096
+        self.downloaded = None
+        self.corrupt_blocks = 0
+        self.lock = threading.RLock()
+        self.power_up()
+
+    def power_up(self):
+        self.baud_rate = self.default_baud_rate
+        self.enabled = False
+        self.payout_enabled = False
+        self.protocol = 6
+        self.key = None
+        self.count = 0
+        self.generator = None
+        self.modulus = None
+        self.last_seq = None
+        self.last_frame = None
+        self.last_reply = None
+        self.jam = None
+        self.timeline = deque()
+        self.busy_until = 0.0
+        self.program = False
+        self.loader = None
+
+    # ---- Scripting ---- #
+
+    def _schedule(self, delay, event):
+        """Queue raw poll event bytes to be reported `delay` seconds after the previous step"""
+        start = max(monotonic(), self.timeline[-1][0] if self.timeline else 0.0)
+        self.timeline.append((start + delay, bytes(event)))
+
+    def insert_note(self, channel):
+        """Script a note insertion on a 1-based channel; routed to storage or cashbox as the device is set"""
+        with self.lock:
+            sim_channel = self.channels[channel - 1]
+            step = self.note_step_time
+            self._schedule(0, (Status.SSP_POLL_READ.value, 0))
+            self._schedule(step, (Status.SSP_POLL_READ.value, channel))
+            self._schedule(step, (Status.SSP_POLL_CREDIT.value, channel, Status.SSP_POLL_STACKING.value))
+            if sim_channel.route == Route.PAYOUT and self.payout_enabled:
+                sim_channel.level += 1
+                self._schedule(step, (Status.SSP_POLL_STORED.value,))
+            else:
+                self.cashbox += sim_channel.value
+                self._schedule(step, (Status.SSP_POLL_STACKED.value,))
+
+    def reject_note(self, channel):
+        """Script a note that is read and then handed back to the customer"""
+        with self.lock:
+            step = self.note_step_time
+            self._schedule(0, (Status.SSP_POLL_READ.value, channel))
+            self._schedule(step, (Status.SSP_POLL_REJECTING.value,))
+            self._schedule(step, (Status.SSP_POLL_REJECTED.value,))
+
+    def set_level(self, channel, level, route=Route.PAYOUT):
+        with self.lock:
+            self.channels[channel - 1].level = level
+            self.channels[channel - 1].route = route
+
+    def inject_event(self, event, *data):
+        """Queue an arbitrary poll event"""
+        with self.lock:
+            self._schedule(0, (int(event),) + data)
+
+    def jam_next_payout(self, after_notes=0, safe=True):
+        """Make the next payout stop with a jam after `after_notes` notes"""
+        with self.lock:
+            self.jam = (after_notes, safe)
+
+    def corrupt_download_blocks(self, count=1):
+        """The next `count` download blocks arrive damaged and have to be sent again"""
+        with self.lock:
+            self.corrupt_blocks += count
+
+    def remove_cashbox(self):
+        with self.lock:
+            self._schedule(0, (Status.SSP_POLL_CASH_BOX_REMOVED.value,))
+
+    def replace_cashbox(self):
+        with self.lock:
+            self.cashbox = 0
+            self._schedule(0, (Status.SSP_POLL_CASH_BOX_REPLACED.value,))
+
+    def power_cycle(self):
+        """Forget the session as a real power loss would and report a reset"""
+        with self.lock:
+            self.power_up()
+            self._schedule(0, (Status.SSP_POLL_RESET.value,))
+
+    # ---- Helpers ---- #
+
+    def find_channel(self, value, currency):
+        for channel in self.channels:
+            if channel.value * 100 == value and channel.currency == currency:
+                return channel
+        return None
+
+    def stored_value(self, currency):
+        return sum(c.value * c.level for c in self.channels if c.currency == currency)
+
+    def plan(self, amount, currency):
+        """Bounded change making over the stored notes, largest first with backtracking"""
+        stored = sorted((c for c in self.channels if c.currency == currency and c.level), key=lambda c: -c.value)
+
+        def search(index, rest):
+            if rest == 0:
+                return []
+            if index == len(stored):
+                return None
+            channel = stored[index]
+            for n in range(min(channel.level, rest // channel.value), -1, -1):
+                found = search(index + 1, rest - n * channel.value)
+                if found is not None:
+                    return [channel] * n + found
+            return None
+
+        return search(0, amount)
+
+    @staticmethod
+    def _value_event(event, value, currency):
+        return (int(event), 1) + tuple(int(value).to_bytes(4, 'little')) + tuple(currency.encode()[:3])
+
+    # ---- Command handling ---- #
+
+    def handle(self, data):
+        """Execute one plain command, return the plain response bytes"""
+        if self.program:
+            # The frame after PROGRAM is the file header, then the loader takes the line
+            self.program = False
+            if len(data) != 128 or data[:3] != b"ITL":
+                return bytes((Response.HEADER_FAILURE.value,))
+            self.loader = Loader(self, data, self.download_block_size)
+            return bytes(self.ok())
+        handler = self.HANDLERS.get(data[0])
+        if handler is None:
+            return bytes((Response.UNKNOWN_COMMAND.value,))
+        try:
+            return bytes(handler(self, data[1:]))
+        except (IndexError, ValueError):
+            return bytes((Response.INCORRECT_PARAMETERS.value,))
+
+    def ok(self, *data):
+        return (Status.SSP_RESPONSE_OK.value,) + data
+
+    def cmd_sync(self, args):
+        return self.ok()
+
+    def cmd_reset(self, args):
+        self.power_cycle()
+        return self.ok()
+
+    def cmd_host_protocol(self, args):
+        if args[0] > 8:
+            return (Response.FAILURE.value,)
+        self.protocol = args[0]
+        return self.ok()
+
+    def cmd_setup_request(self, args):
+        channels = self.channels
+        data = [int(self.unit_type)]
+        data += self.firmware.encode()[:4]
+        data += channels[0].currency.encode()[:3]
+        data += (0, 0, 1)
+        data.append(len(channels))
+        data += [min(c.value, 255) for c in channels]
+        data += [2] * len(channels)
+        data += (0, 0, 100)
+        data.append(self.protocol)
+        for channel in channels:
+            data += channel.currency.encode()[:3]
+        for channel in channels:
+            data += channel.value.to_bytes(4, 'little')
+        return self.ok(*data)
+
+    def cmd_unit_data(self, args):
+        data = [int(self.unit_type)]
+        data += self.firmware.encode()[:4]
+        data += self.channels[0].currency.encode()[:3]
+        data += (0, 0, 1)
+        data.append(self.protocol)
+        return self.ok(*data)
+
+    def cmd_serial_number(self, args):
+        return self.ok(*self.serial.to_bytes(4, 'big'))
+
+    def cmd_enable(self, args):
+        self.enabled = True
+        return self.ok()
+
+    def cmd_disable(self, args):
+        self.enabled = False
+        return self.ok()
+
+    def cmd_enable_payout(self, args):
+        self.payout_enabled = True
+        return self.ok()
+
+    def cmd_disable_payout(self, args):
+        self.payout_enabled = False
+        return self.ok()
+
+    def cmd_accept(self, args):
+        return self.ok()
+
+    def cmd_poll(self, args):
+        now = monotonic()
+        events = []
+        while self.timeline and self.timeline[0][0] <= now and len(events) < 200:
+            events += self.timeline.popleft()[1]
+        if not self.enabled and not events:
+            events.append(Status.SSP_POLL_DISABLED.value)
+        return self.ok(*events)
+
+    def cmd_get_note_amount(self, args):
+        channel = self.find_channel(int.from_bytes(args[0:4], 'little'), args[4:7].decode())
+        if channel is None:
+            return (Response.INVALID_PARAMETER.value,)
+        return self.ok(*channel.level.to_bytes(2, 'little'))
+
+    def cmd_get_all_levels(self, args):
+        levels = (len(self.channels),)
+        for channel in self.channels:
+            levels += (tuple(channel.level.to_bytes(2, 'little')) + tuple((channel.value * 100).to_bytes(4, 'little')) +
+                       tuple(channel.currency.encode()[:3]))
+        return self.ok(*levels)
+
+    def cmd_set_routing(self, args):
+        channel = self.find_channel(int.from_bytes(args[1:5], 'little'), args[5:8].decode())
+        if channel is None or args[0] not in (Route.PAYOUT.value, Route.CASHBOX.value):
+            return (Response.INVALID_PARAMETER.value,)
+        channel.route = Route(args[0])
+        return self.ok()
+
+    def cmd_get_routing(self, args):
+        channel = self.find_channel(int.from_bytes(args[0:4], 'little'), args[4:7].decode())
+        if channel is None:
+            return (Response.INVALID_PARAMETER.value,)
+        return self.ok(channel.route.value)
+
+    def cmd_payout(self, args):
+        amount = int.from_bytes(args[0:4], 'little')
+        currency = args[4:7].decode()
+        option = args[7] if len(args) > 7 else Status.SSP6_OPTION_BYTE_DO.value
+        if not self.payout_enabled or not self.enabled:
+            return (Response.COMMAND_NOT_PROCESSED.value, PayoutResponse.SMART_PAYOUT_DISABLED.value)
+        if self.timeline or monotonic() < self.busy_until:
+            return (Response.COMMAND_NOT_PROCESSED.value, PayoutResponse.SMART_PAYOUT_BUSY.value)
+        if amount % 100 or amount // 100 > self.stored_value(currency):
+            return (Response.COMMAND_NOT_PROCESSED.value, PayoutResponse.SMART_PAYOUT_NOT_ENOUGH.value)
+        notes = self.plan(amount // 100, currency)
+        if notes is None:
+            return (Response.COMMAND_NOT_PROCESSED.value, PayoutResponse.SMART_PAYOUT_EXACT_AMOUNT.value)
+        if option == TEST_PAYOUT_AMOUNT:
+            return self.ok()
+        self._dispense(notes, currency, Status.SSP_POLL_DISPENSING, Status.SSP_POLL_DISPENSED)
+        return self.ok()
+
+    def _dispense(self, notes, currency, progress, done):
+        paid = 0
+        jam, self.jam = self.jam, None
+        for i, channel in enumerate(notes):
+            if jam is not None and i == jam[0]:
+                self._schedule(self.dispense_time, self._value_event(Status.SSP_POLL_JAMMED, paid * 100, currency))
+                self._schedule(0, (Status.SSP_POLL_SAFE_JAM.value if jam[1] else Status.SSP_POLL_UNSAFE_JAM.value,))
+                return
+            channel.level -= 1
+            paid += channel.value
+            self._schedule(self.dispense_time, self._value_event(progress, paid * 100, currency))
+        self._schedule(0, self._value_event(done, paid * 100, currency))
+
+    def cmd_empty(self, args):
+        for channel in self.channels:
+            self.cashbox += channel.value * channel.level
+            channel.level = 0
+        self._schedule(0, (Status.SSP_POLL_EMPTYING.value,))
+        self._schedule(self.dispense_time, (Status.SSP_POLL_EMPTY.value,))
+        return self.ok()
+
+    def cmd_smart_empty(self, args):
+        currency = self.channels[0].currency
+        total = 0
+        for channel in self.channels:
+            total += channel.value * channel.level
+            channel.level = 0
+        self.cashbox += total
+        self._schedule(0, self._value_event(Status.SSP_POLL_SMART_EMPTYING, 0, currency))
+        self._schedule(self.dispense_time, self._value_event(Status.SSP_POLL_SMART_EMPTIED, total * 100, currency))
+        return self.ok()
+
+    def cmd_configure_bezel(self, args):
+        self.bezel = tuple(args[0:3])
+        return self.ok()
+
+    def cmd_set_generator(self, args):
+        self.generator = int.from_bytes(args[0:8], 'little')
+        return self.ok()
+
+    def cmd_set_modulus(self, args):
+        self.modulus = int.from_bytes(args[0:8], 'little')
+        return self.ok()
+
+    def cmd_key_exchange(self, args):
+        if not self.generator or not self.modulus:
+            return (Response.COMMAND_NOT_PROCESSED.value,)
+        host_inter = int.from_bytes(args[0:8], 'little')
+        slave_random = random.randrange(1, 2 ** 31)
+        slave_inter = pow(self.generator, slave_random, self.modulus)
+        self.key = pow(host_inter, slave_random, self.modulus)
+        self.count = 0
+        return self.ok(*slave_inter.to_bytes(8, 'little'))
+
+    def cmd_program(self, args):
+        if args[0] != SSP_PROGRAM_RAM:
+            return (Response.COMMAND_NOT_PROCESSED.value,)
+        self.program = True
+        return self.ok(*self.download_block_size.to_bytes(2, 'little'))
+
+    def cmd_set_baud_rate(self, args):
+        # Answered at the current rate, the simulator paces it before the change shows
+        baud_rate = BAUD_RATES.get(args[0])
+        if baud_rate is None or args[1] > 1:
+            return (Response.INVALID_PARAMETER.value,)
+        self.baud_rate = baud_rate
+        if args[1]:
+            self.default_baud_rate = baud_rate
+        return self.ok()
+
+    HANDLERS = {
+        Command.SYNC.value: cmd_sync,
+        Command.RESET.value: cmd_reset,
+        Command.HOST_PROTOCOL.value: cmd_host_protocol,
+        Command.SETUP_REQUEST.value: cmd_setup_request,
+        Command.UNIT_DATA.value: cmd_unit_data,
+        Command.SERIAL_NUMBER.value: cmd_serial_number,
+        Command.POLL.value: cmd_poll,
+        Command.ENABLE.value: cmd_enable,
+        Command.DISABLE.value: cmd_disable,
+        Command.ENABLE_PAYOUT.value: cmd_enable_payout,
+        Command.DISABLE_PAYOUT.value: cmd_disable_payout,
+        Command.SET_INHIBITS.value: cmd_accept,
+        Command.REJECT_NOTE.value: cmd_accept,
+        Command.PAYOUT_AMOUNT.value: cmd_payout,
+        Command.GET_NOTE_AMOUNT.value: cmd_get_note_amount,
+        Command.GET_ALL_LEVELS.value: cmd_get_all_levels,
+        Command.SET_ROUTING.value: cmd_set_routing,
+        Command.GET_ROUTING.value: cmd_get_routing,
+        Command.EMPTY.value: cmd_empty,
+        Command.SMART_EMPTY.value: cmd_smart_empty,
+        Command.CONFIGURE_BEZEL.value: cmd_configure_bezel,
+        Command.SET_GENERATOR.value: cmd_set_generator,
+        Command.SET_MODULUS.value: cmd_set_modulus,
+        Command.REQUEST_KEY_EXCHANGE.value: cmd_key_exchange,
+        Command.SET_BAUD_RATE.value: cmd_set_baud_rate,
+        Command.PROGRAM.value: cmd_program,
+    }
+
+    # ---- Encryption ---- #
+
+    def _aes_key(self):
+        return (self.fixed_key.to_bytes(8, 'little') + (self.key or 0).to_bytes(8, 'little'))
+
+    def _aes(self, encrypt, data):
+        from .eSSP import eSSP  # the native AES of libessp, loaded by the package
+        key = create_string_buffer(self._aes_key(), 16)
+        plain = (c_ubyte * len(data)).from_buffer_copy(data)
+        cipher = (c_ubyte * len(data))()
+        if encrypt:
+            eSSP.essp.aes_encrypt(C_AES_MODE_ECB, key, 16, None, 0, plain, cipher, len(data))
+            return bytes(cipher)
+        eSSP.essp.aes_decrypt(C_AES_MODE_ECB, key, 16, None, 0, cipher, plain, len(data))
+        return bytes(cipher)
+
+    def decrypt(self, data):
+        """Unwrap an STEX packet, None if it does not check out"""
+        if self.key is None or (len(data) - 1) % 16:
+            return None
+        plain = self._aes(False, data[1:])
+        crc = crc16(plain[:-2])
+        if plain[-2] != crc & 0xFF or plain[-1] != crc >> 8:
+            return None
+        if int.from_bytes(plain[1:5], 'little') != self.count:
+            return None
+        self.count += 1
+        return plain[5:5 + plain[0]]
+
+    def encrypt(self, data):
+        packet = bytes((len(data),)) + self.count.to_bytes(4, 'little') + bytes(data)
+        packet += bytes(random.randrange(255) for _ in range(-(len(packet) + 2) % 16))
+        crc = crc16(packet)
+        packet += bytes((crc & 0xFF, crc >> 8))
+        return bytes((SSP_STEX,)) + self._aes(True, packet)
+
+    def transaction(self, seq, data):
+        """Handle a frame addressed to this device, return the reply frame data"""
+        with self.lock:
+            if seq == self.last_seq and data == self.last_frame:
+                # Repeated packet, the host did not get our reply
+                return self.last_reply
+            self.commands += 1
+            if data[0] == SSP_STEX:
+                plain = self.decrypt(data)
+                if plain is None:
+                    reply = bytes((Response.KEY_NOT_SET.value,))
+                else:
+                    reply = self.encrypt(self.handle(plain))
+            else:
+                reply = self.handle(data)
+            self.last_seq = seq
+            self.last_frame = data
+            self.last_reply = reply
+            return reply
+
+
+class Simulator(object):
+    """Pseudo-terminal speaking SSP for one or more SimulatedDevice
+
+    Pass `sim.port` as `com_port` to eSSP. Replies are sent as soon as a frame
+    is complete, so the link runs as fast as the pty allows, unless `pace` is
+    set: then reply bytes trickle out at the device's baud rate like on a real
+    8N2 UART. Either way a frame sent at another speed than the device's own
+    is lost, as it would be on the wire.
+
+    With `tcp` set it stands in for a serial to Ethernet converter instead:
+    `sim.port` is a tcp://127.0.0.1 address taking one connection at a time,
+    a new one replacing the last, with the line fixed at 9600 baud.
+    drop_connection() closes the current one, as a converter restarting would.
+    """
+
+    def __init__(self, devices=None, pace=False, tcp=False, **kwargs):
+        if devices is None:
+            devices = [SimulatedDevice(**kwargs)]
+        self.devices = {device.address: device for device in devices}
+        self.faults = deque()
+        self.pace = pace
+        self.reader = FrameReader()
+        self.master = self.slave = self.listener = self.connection = None
+        if tcp:
+            self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.listener.bind(("127.0.0.1", 0))
+            self.listener.listen(1)
+            self.port = "tcp://127.0.0.1:%d" % self.listener.getsockname()[1]
+            self.connections = 0
+        else:
+            self.master, self.slave = os.openpty()
+            tty.setraw(self.slave)
+            self.port = os.ttyname(self.slave)
+        self.frames_in = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.baud_mismatches = 0
+        self._stop_r, self._stop_w = os.pipe()
+        self._thread = None
+
+    @property
+    def device(self):
+        """The device at the lowest address"""
+        return self.devices[min(self.devices)]
+
+    def inject_fault(self, kind, count=1, delay=0.0):
+        """Spoil the next `count` replies: 'timeout' drops, 'crc' corrupts, 'noise' prefixes garbage, 'delay' stalls"""
+        if kind not in ('timeout', 'crc', 'noise', 'delay'):
+            raise ValueError("Unknown fault %s" % kind)
+        for _ in range(count):
+            self.faults.append((kind, delay))
+
+    def host_baud_rate(self):
+        """Speed the host has set its end of the line to"""
+        if self.listener is not None:
+            return 9600
+        speed = termios.tcgetattr(self.slave)[5]
+        return TERMIOS_SPEEDS.get(speed)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        os.write(self._stop_w, b'x')
+        if self._thread is not None:
+            self._thread.join()
+        for fd in (self.master, self.slave, self._stop_r, self._stop_w):
+            if fd is not None:
+                os.close(fd)
+        for sock in (self.connection, self.listener):
+            if sock is not None:
+                sock.close()
+
+    def drop_connection(self):
+        """Close the host's connection from this end, TCP mode only"""
+        connection = self.connection
+        if connection is not None:
+            connection.shutdown(socket.SHUT_RDWR)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _accept(self):
+        connection, _ = self.listener.accept()
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.connection is not None:
+            self.connection.close()
+        self.connection = connection
+        self.connections += 1
+        self.reader = FrameReader()
+
+    def _read(self):
+        """Bytes from the host, None when there are none after all"""
+        if self.master is not None:
+            try:
+                return os.read(self.master, 4096)
+            except OSError:
+                return None
+        try:
+            data = self.connection.recv(4096)
+        except OSError:
+            data = b''
+        if not data:
+            self.connection.close()
+            self.connection = None
+            return None
+        return data
+
+    def _write(self, data):
+        if self.master is not None:
+            os.write(self.master, data)
+        elif self.connection is not None:
+            try:
+                self.connection.sendall(data)
+            except OSError:
+                pass
+
+    def run(self):
+        while True:
+            if self.master is not None:
+                sources = [self.master, self._stop_r]
+            else:
+                sources = [self.listener, self._stop_r] + ([self.connection] if self.connection is not None else [])
+            ready, _, _ = select.select(sources, [], [])
+            if self._stop_r in ready:
+                return
+            if self.listener is not None and self.listener in ready:
+                self._accept()
+                continue
+            data = self._read()
+            if data is None:
+                continue
+            self.bytes_in += len(data)
+            loading = next((device for device in self.devices.values() if device.loader is not None), None)
+            if loading is not None:
+                self.load(loading, data)
+                continue
+            for address, frame in self.reader.feed(data):
+                self.frames_in += 1
+                device = self.devices.get(address & 0x7F)
+                if device is None:
+                    continue
+                # The rate the frame arrives at is also the rate of the reply
+                baud_rate = device.baud_rate
+                if self.host_baud_rate() != baud_rate:
+                    self.baud_mismatches += 1
+                    continue
+                reply = device.transaction(address & 0x80, frame)
+                self.send(address, reply, baud_rate)
+
+    def load(self, device, data):
+        """Raw bytes of a download, for the device's loader"""
+        with device.lock:
+            loader = device.loader
+            if loader is None:
+                return
+            if self.host_baud_rate() != loader.baud_rate:
+                self.baud_mismatches += 1
+                return
+            reply = loader.feed(data)
+        if reply:
+            self.bytes_out += len(reply)
+            self._write(reply)
+
+    def send(self, address, reply, baud_rate=9600):
+        wire = stuff(bytes((address, len(reply))) + reply)
+        if self.faults:
+            kind, delay = self.faults.popleft()
+            if kind == 'timeout':
+                return
+            elif kind == 'crc':
+                wire = wire[:-1] + bytes(((wire[-1] ^ 0x55) or 1,))
+            elif kind == 'noise':
+                wire = bytes(random.randrange(0x7F) for _ in range(8)) + wire
+            elif kind == 'delay':
+                sleep(delay)
+        self.bytes_out += len(wire)
+        if not self.pace:
+            self._write(wire)
+            return
+        # Start, 8 data and 2 stop bits per byte
+        byte_time = 11.0 / baud_rate
+        start = monotonic()
+        for i in range(len(wire)):
+            sleep(max(start + (i + 1) * byte_time - monotonic(), 0))
+            self._write(wire[i:i + 1])
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="SSP device simulator on a pseudo-terminal or a TCP port")
+    parser.add_argument("--address", type=int, default=0)
+    parser.add_argument("--note-step-time", type=float, default=0.0)
+    parser.add_argument("--dispense-time", type=float, default=0.0)
+    parser.add_argument("--pace", action="store_true", help="send replies at the device's baud rate")
+    parser.add_argument("--tcp", action="store_true", help="listen on loopback like a serial to Ethernet converter")
+    args = parser.parse_args()
+    sim = Simulator(pace=args.pace, tcp=args.tcp, address=args.address, note_step_time=args.note_step_time, dispense_time=args.dispense_time)
+    sim.start()
+    print(sim.port, flush=True)
+    try:
+        while True:
+            line = input("")
+            if line.startswith("n"):  # Insert a note: n <channel>
+                sim.device.insert_note(int(line.split()[1]))
+            elif line.startswith("j"):  # Jam the next payout
+                sim.device.jam_next_payout()
+            elif line.startswith("f"):  # Inject a fault: f <kind>
+                sim.inject_fault(line.split()[1])
+            elif line.startswith("r"):  # Power cycle
+                sim.device.power_cycle()
+            elif line.startswith("d") and args.tcp:  # Drop the connection
+                sim.drop_connection()
+    except (KeyboardInterrupt, EOFError):
+        sim.stop()
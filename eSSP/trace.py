@@ -0,0 +1,116 @@
+"""Loggers per subsystem, and trace points on the poll loop's hot path
+
+Messages go through `logging`, with the arguments apart from the format, so
+nothing is formatted unless a handler is going to write it. Each subsystem
+has a logger of its own under "eSSP", to be set to its own level:
+
+    logging.getLogger("eSSP.poll").setLevel(logging.DEBUG)
+
+Trace points are typed records stamped with time.monotonic(), handed to
+eSSP.trace: any callable, such as a TraceRing or a TraceSampler in front of
+one. With eSSP.trace None, the default, a trace point costs one test.
+"""
+import logging
+import sys
+import threading
+from collections import deque
+from typing import Any, NamedTuple
+
+log = logging.getLogger("eSSP")
+# Silent unless the application configures logging, as a library should be
+log.addHandler(logging.NullHandler())
+link_log = logging.getLogger("eSSP.link")             # port, sync, baud rate, encryption, reconnection
+poll_log = logging.getLogger("eSSP.poll")             # busy or free, what the poll events meant
+action_log = logging.getLogger("eSSP.actions")        # actions sent and what the unit said to them
+inventory_log = logging.getLogger("eSSP.inventory")   # unit description, levels and routes
+download_log = logging.getLogger("eSSP.download")     # firmware and dataset files
+
+_stdout_handler = None
+_stdout_lock = threading.Lock()
+
+
+def debug_to_stdout():
+    """Print every eSSP message on stdout, as debug=True always did"""
+    global _stdout_handler
+    with _stdout_lock:
+        if _stdout_handler is None:
+            _stdout_handler = logging.StreamHandler(sys.stdout)
+            _stdout_handler.setFormatter(logging.Formatter("%(message)s"))
+            log.addHandler(_stdout_handler)
+        log.setLevel(logging.DEBUG)
+
+
+class CommandStart(NamedTuple):
+    time: float
+    command: Any        # Command.POLL, or the Actions member of an action
+
+
+class CommandEnd(NamedTuple):
+    time: float
+    command: Any
+    ok: bool
+    elapsed: float      # seconds since its CommandStart
+
+
+class PollResult(NamedTuple):
+    time: float
+    status: Any         # response status of the poll
+    events: int         # events in the reply
+
+
+class EventDecoded(NamedTuple):
+    time: float
+    event: Any          # Status, or the byte when it is unknown
+    data: int           # first data word, a channel or a value
+
+
+class ActionDequeued(NamedTuple):
+    time: float
+    action: Any         # Actions member
+    waiting: int        # actions left in the queue
+
+
+class TraceRing(object):
+    """The last `size` trace points, oldest first; appending never waits"""
+
+    def __init__(self, size=4096):
+        self.size = size
+        self._points = deque(maxlen=size)
+
+    def __call__(self, point):
+        self._points.append(point)
+
+    def points(self, kind=None):
+        """A copy of the ring, only the points of type `kind` if given"""
+        points = list(self._points)
+        if kind is not None:
+            points = [point for point in points if type(point) is kind]
+        return points
+
+    def clear(self):
+        self._points.clear()
+
+    def __len__(self):
+        return len(self._points)
+
+
+class TraceSampler(object):
+    """Pass one point in `every` of each kind on to `sink`, and all of the kinds in `always`"""
+
+    def __init__(self, sink, every=100, always=(EventDecoded,)):
+        if every < 1:
+            raise ValueError("every must be at least 1")
+        self.sink = sink
+        self.every = every
+        self.always = frozenset(always)
+        self.seen = {}
+
+    def __call__(self, point):
+        kind = type(point)
+        seen = self.seen.get(kind, 0)
+        self.seen[kind] = seen + 1
+        if kind in self.always or seen % self.every == 0:
+            self.sink(point)
+
+    def stats(self):
+        return {kind.__name__: seen for kind, seen in self.seen.items()}
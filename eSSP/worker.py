@@ -0,0 +1,509 @@
+import itertools
+import mmap
+import multiprocessing
+import os
+import pickle
+import struct
+import threading
+from concurrent.futures import Future, InvalidStateError
+from ctypes import byref, c_ulonglong
+from multiprocessing import shared_memory
+from time import monotonic, sleep
+from typing import NamedTuple
+
+from .constants import Route
+from .errors import SSPError
+from .eSSP import eSSP, Channel, Note, DEFAULT_CURRENCY
+from .events import EventBus, DROP_OLDEST
+from .planner import PayoutPlanner
+
+MAX_CHANNELS = 20
+
+# polls, time of the last poll (monotonic), cashbox, busy, unit type, last poll status, channels
+STATUS = struct.Struct("<QdqBBBB")
+# number, value, currency, level, route (-1 unknown)
+CHANNEL = struct.Struct("<BI3sHb")
+
+# Shared memory layout: snapshot, then the ring to the worker, then the ring back
+SNAPSHOT_OFFSET = 0
+SNAPSHOT_SIZE = 1024
+COMMANDS_OFFSET = SNAPSHOT_OFFSET + SNAPSHOT_SIZE
+COMMANDS_SIZE = 64 * 1024
+REPLIES_OFFSET = COMMANDS_OFFSET + COMMANDS_SIZE
+REPLIES_SIZE = 256 * 1024
+SIZE = REPLIES_OFFSET + REPLIES_SIZE
+
+# Call id the worker answers with the outcome of the unit's first inventory load
+INVENTORY_LOADED = -1
+
+
+class Ring(object):
+    """Single producer, single consumer ring of byte records in shared memory
+
+    Two counters, each written by one side only, tell how far the producer
+    has written and the consumer has read; the bytes between them are the
+    consumer's. A counter is stored with release semantics after the bytes
+    it covers and loaded with acquire semantics before them, so neither side
+    ever takes a lock. A record that would not fit before the end of the
+    buffer leaves a skip marker and starts over at the beginning.
+    """
+
+    HEADER = 128   # the two counters, a cache line each
+    SKIP = 0xFFFFFFFF
+    LENGTH = struct.Struct("<I")
+
+    def __init__(self, buf, offset, size):
+        self.buf = buf
+        self.capacity = size - self.HEADER
+        self._data = offset + self.HEADER
+        self._lib = eSSP.essp
+        self._written = c_ulonglong.from_buffer(buf, offset)
+        self._read = c_ulonglong.from_buffer(buf, offset + 64)
+        # Each side keeps its own counter at hand, only the other one is loaded
+        self._head = self._lib.ssp_load_acquire(byref(self._written))
+        self._tail = self._lib.ssp_load_acquire(byref(self._read))
+
+    def put(self, data):
+        """Append a record, False if there is no room for it now"""
+        length = (self.LENGTH.size + len(data) + 7) & ~7
+        if length > self.capacity:
+            raise ValueError("Record of %d bytes can't fit a ring of %d" % (len(data), self.capacity))
+        head = self._head
+        index = head % self.capacity
+        room = self.capacity - index
+        needed = length if length <= room else room + length
+        if needed > self.capacity - (head - self._lib.ssp_load_acquire(byref(self._read))):
+            return False
+        if length > room:
+            self.LENGTH.pack_into(self.buf, self._data + index, self.SKIP)
+            head += room
+            index = 0
+        start = self._data + index
+        self.LENGTH.pack_into(self.buf, start, len(data))
+        self.buf[start + self.LENGTH.size:start + self.LENGTH.size + len(data)] = data
+        self._head = head + length
+        self._lib.ssp_store_release(byref(self._written), self._head)
+        return True
+
+    def get(self):
+        """The oldest record, None if there is none"""
+        tail = self._tail
+        if tail == self._lib.ssp_load_acquire(byref(self._written)):
+            return None
+        index = tail % self.capacity
+        size, = self.LENGTH.unpack_from(self.buf, self._data + index)
+        if size == self.SKIP:
+            tail += self.capacity - index
+            index = 0
+            size, = self.LENGTH.unpack_from(self.buf, self._data)
+        start = self._data + index + self.LENGTH.size
+        data = bytes(self.buf[start:start + size])
+        self._tail = tail + ((self.LENGTH.size + size + 7) & ~7)
+        self._lib.ssp_store_release(byref(self._read), self._tail)
+        return data
+
+    def release(self):
+        # The counters export the buffer, the memory can't be unmapped while they live
+        self._written = self._read = None
+
+
+class Snapshot(object):
+    """Status of the unit behind a seqlock: one writer that never waits, readers retry a torn read
+
+    The sequence number is odd while the writer is at work. A reader loads
+    it, unpacks the record straight from the shared buffer and takes the
+    values only if the number is even and still the same afterwards.
+    """
+
+    def __init__(self, buf, offset):
+        self.buf = buf
+        self._lib = eSSP.essp
+        self._sequence = c_ulonglong.from_buffer(buf, offset)
+        self._status = offset + 64
+        self._channels = self._status + STATUS.size
+
+    def write(self, status, channels):
+        sequence = self._sequence.value
+        self._lib.ssp_store_release(byref(self._sequence), sequence + 1)
+        self._lib.ssp_fence()
+        STATUS.pack_into(self.buf, self._status, *status)
+        for i, channel in enumerate(channels[:MAX_CHANNELS]):
+            CHANNEL.pack_into(self.buf, self._channels + i * CHANNEL.size, *channel)
+        self._lib.ssp_store_release(byref(self._sequence), sequence + 2)
+
+    def read(self, timeout=1.0):
+        """(status, channels) as last written; SSPError if a write stays unfinished for `timeout` seconds"""
+        deadline = None
+        while True:
+            before = self._lib.ssp_load_acquire(byref(self._sequence))
+            if before & 1:
+                # A write takes microseconds, one this old was cut off with its writer
+                if deadline is None:
+                    deadline = monotonic() + timeout
+                elif monotonic() > deadline:
+                    raise SSPError("Snapshot left half written, the worker is gone")
+                sleep(0)
+                continue
+            status = STATUS.unpack_from(self.buf, self._status)
+            channels = [CHANNEL.unpack_from(self.buf, self._channels + i * CHANNEL.size)
+                        for i in range(min(status[-1], MAX_CHANNELS))]
+            self._lib.ssp_fence()
+            if self._lib.ssp_load_acquire(byref(self._sequence)) == before:
+                return status, channels
+
+    def release(self):
+        self._sequence = None
+
+
+class _Layout(object):
+    def __init__(self, buf):
+        self.snapshot = Snapshot(buf, SNAPSHOT_OFFSET)
+        self.commands = Ring(buf, COMMANDS_OFFSET, COMMANDS_SIZE)
+        self.replies = Ring(buf, REPLIES_OFFSET, REPLIES_SIZE)
+
+    def release(self):
+        self.snapshot.release()
+        self.commands.release()
+        self.replies.release()
+
+
+class WorkerStatus(NamedTuple):
+    """The unit as the worker saw it after its last poll or action"""
+    polls: int
+    last_poll: float        # time.monotonic() of the last poll, 0 before the first
+    stacked: int
+    busy: bool
+    unit: int
+    poll_status: int        # response status of the last poll
+    storage: dict           # channel number -> Channel
+
+
+class _WorkerDevice(eSSP):
+    """eSSP writing its status into the shared snapshot after every poll and every round of actions"""
+
+    def __init__(self, snapshot, *args, **kwargs):
+        self.snapshot = snapshot
+        self.polls = 0
+        self.last_poll = 0.0
+        self.poll_status = 0
+        # The poll thread and the command thread both publish, the snapshot takes one writer at a time
+        self._publish_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def poll_once(self):
+        status = super().poll_once()
+        self.polls += 1
+        self.last_poll = monotonic()
+        self.poll_status = int(status)
+        self.publish_status()
+        return status
+
+    def do_actions(self):
+        super().do_actions()
+        self.publish_status()
+
+    def publish_status(self):
+        channels = [(number, channel.note.value, channel.note.currency.encode(), channel.amount,
+                     -1 if channel.route is None else int(channel.route.value))
+                    for number, channel in self.storage.items()]
+        with self._publish_lock:
+            self.snapshot.write((self.polls, self.last_poll, self.stacked, self.busy, int(self.unit),
+                                 self.poll_status, len(channels)), channels)
+
+
+def _attach(name, size):
+    # Mapped without SharedMemory, whose resource tracker would unlink the owner's segment
+    fd = os.open("/dev/shm/%s" % name.lstrip("/"), os.O_RDWR)
+    try:
+        return mmap.mmap(fd, size)
+    finally:
+        os.close(fd)
+
+
+def _serve(com_port, kwargs, shm_name, app_bell, worker_bell):
+    """Worker process: own the port, poll it, run what the application sends"""
+    memory = _attach(shm_name, SIZE)
+    buf = memoryview(memory)
+    layout = _Layout(buf)
+    parent = os.getppid()
+    send_lock = threading.Lock()
+    futures = {}
+
+    def send(message, drop=False):
+        data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+        with send_lock:
+            while not layout.replies.put(data):
+                if drop:
+                    return
+                sleep(0.001)
+        app_bell.set()
+
+    def settle(call_id, future):
+        futures.pop(call_id, None)
+        # What the action changed is in the snapshot before its caller hears of it
+        device.publish_status()
+        if future.cancelled():
+            send(("cancelled", call_id))
+        elif future.exception() is not None:
+            send(("result", call_id, False, future.exception()))
+        else:
+            send(("result", call_id, True, future.result()))
+
+    try:
+        # Events reach the application through the ring, the worker keeps none
+        device = _WorkerDevice(layout.snapshot, com_port, threaded=True,
+                               **dict(kwargs, event_queue_size=1, event_overflow=DROP_OLDEST))
+    except Exception as e:
+        send(("failed", e))
+        return
+    device.subscribe(lambda event: send(("event", event), drop=True))
+    device.publish_status()
+    send(("ready", device.descriptor, device.unit, device.inventory_loaded is not None))
+    if device.inventory_loaded is not None:
+        device.inventory_loaded.add_done_callback(lambda future: settle(INVENTORY_LOADED, future))
+
+    while True:
+        if not worker_bell.wait(1.0) and os.getppid() != parent:
+            # The application is gone, nobody will close the unit for it
+            device.close()
+            return
+        worker_bell.clear()
+        while True:
+            data = layout.commands.get()
+            if data is None:
+                break
+            message = pickle.loads(data)
+            if message[0] == "close":
+                device.close()
+                send(("closed",))
+                return
+            if message[0] == "cancel":
+                future = futures.get(message[1])
+                if future is not None:
+                    future.cancel()
+                continue
+            _, call_id, name, args, call_kwargs = message
+            try:
+                result = getattr(device, name)(*args, **call_kwargs)
+            except Exception as e:
+                send(("result", call_id, False, e))
+                continue
+            if isinstance(result, Future):
+                futures[call_id] = result
+                result.add_done_callback(lambda future, call_id=call_id: settle(call_id, future))
+            else:
+                send(("result", call_id, True, result))
+
+
+class WorkerESSP(object):
+    """eSSP driven by a worker process of its own, with the same methods
+
+    The worker owns the port and polls it from its own interpreter, so load
+    and garbage collection in the application can't delay a poll past the
+    unit's watchdog. Calls cross to the worker through a lock-free ring in
+    shared memory and come back as Futures, events through a second ring
+    into this side's event bus. The status (levels, cashbox, busy, last
+    poll) is read straight from a seqlock-protected snapshot the worker
+    rewrites after every poll, without asking the worker.
+    """
+
+    # Forwarded as they are, each returns a Future
+    QUEUED = ("payout", "set_route_cashbox", "set_route_storage", "get_note_amount", "empty_storage",
+              "disable_payout", "disable_validator", "enable_validator", "configure_bezel",
+              "refresh_inventory", "update_payout", "download_file")
+    # Forwarded and waited for
+    SYNCHRONOUS = ("metrics", "poll_stats", "action_stats", "tx_stats", "captured_frames", "dump_capture",
+                   "reset", "reject")
+
+    def __init__(self, com_port, start_timeout=30.0, call_timeout=10.0, event_queue_size=1024,
+                 event_overflow=DROP_OLDEST, **kwargs):
+        context = multiprocessing.get_context("spawn")
+        self.com_port = com_port
+        self.call_timeout = call_timeout
+        self.events = EventBus(maxlen=event_queue_size, overflow=event_overflow)
+        self.planner = PayoutPlanner()
+        self._memory = shared_memory.SharedMemory(create=True, size=SIZE)
+        self._layout = _Layout(self._memory.buf)
+        self._app_bell = context.Event()
+        self._worker_bell = context.Event()
+        self._send_lock = threading.Lock()
+        self._ids = itertools.count()
+        self._calls = {}
+        self._ready = Future()
+        self._closed = False
+        # Settled like a call, the worker answers it once the levels are in
+        self._inventory = self._calls[INVENTORY_LOADED] = Future()
+        self._process = context.Process(target=_serve, name="essp %s" % com_port, daemon=True,
+                                        args=(com_port, kwargs, self._memory.name, self._app_bell, self._worker_bell))
+        self._process.start()
+        self._reader = threading.Thread(target=self._read_loop, daemon=True)
+        self._reader.start()
+        try:
+            self.descriptor, self.unit, loading = self._ready.result(start_timeout)
+        except BaseException:
+            self._shutdown()
+            raise
+        self.inventory_loaded = self._inventory if loading else None
+
+    def _read_loop(self):
+        while True:
+            self._app_bell.wait(0.5)
+            self._app_bell.clear()
+            # Checked before draining, so whatever a dying worker sent is still read
+            alive = self._process.is_alive()
+            while True:
+                data = self._layout.replies.get()
+                if data is None:
+                    break
+                if not self._dispatch(pickle.loads(data)):
+                    return
+            if not alive:
+                self._fail_all(SSPError("Worker for %s exited" % self.com_port))
+                return
+
+    def _dispatch(self, message):
+        kind = message[0]
+        if kind == "event":
+            self.events.publish(message[1])
+        elif kind == "result":
+            future = self._calls.pop(message[1], None)
+            if future is not None:
+                try:
+                    if message[2]:
+                        future.set_result(message[3])
+                    else:
+                        future.set_exception(message[3])
+                except InvalidStateError:
+                    pass  # cancelled here meanwhile
+        elif kind == "cancelled":
+            future = self._calls.pop(message[1], None)
+            if future is not None:
+                future.cancel()
+        elif kind == "ready":
+            self._ready.set_result(message[1:])
+        elif kind == "failed":
+            self._ready.set_exception(message[1])
+            return False
+        elif kind == "closed":
+            self._fail_all(SSPError("Closed"))
+            return False
+        return True
+
+    def _fail_all(self, error):
+        if not self._ready.done():
+            self._ready.set_exception(error)
+        calls, self._calls = self._calls, {}
+        for future in calls.values():
+            try:
+                future.set_exception(error)
+            except InvalidStateError:
+                pass
+
+    def _send(self, message):
+        data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+        deadline = monotonic() + self.call_timeout
+        with self._send_lock:
+            while not self._layout.commands.put(data):
+                if monotonic() > deadline or not self._process.is_alive():
+                    raise SSPError("Worker for %s is not taking commands" % self.com_port)
+                sleep(0.001)
+        self._worker_bell.set()
+
+    def call(self, name, *args, **kwargs):
+        """Run a method of the worker's eSSP, return a Future of its result; cancelling it cancels the action"""
+        if self._closed:
+            raise SSPError("Closed")
+        call_id = next(self._ids)
+        future = Future()
+        self._calls[call_id] = future
+        future.add_done_callback(lambda done: done.cancelled() and self._cancel(call_id))
+        self._send(("call", call_id, name, args, kwargs))
+        return future
+
+    def _cancel(self, call_id):
+        if self._calls.pop(call_id, None) is not None and not self._closed:
+            self._send(("cancel", call_id))
+
+    def __getattr__(self, name):
+        if name in self.QUEUED:
+            return lambda *args, **kwargs: self.call(name, *args, **kwargs)
+        if name in self.SYNCHRONOUS:
+            return lambda *args, **kwargs: self.call(name, *args, **kwargs).result(self.call_timeout)
+        raise AttributeError(name)
+
+    def status(self):
+        """WorkerStatus from the shared snapshot, no round trip to the worker"""
+        (polls, last_poll, stacked, busy, unit, poll_status, _), channels = self._layout.snapshot.read()
+        storage = {number: Channel(Note(value, currency.decode(errors='replace')), amount, Route(route) if route >= 0 else None)
+                   for number, value, currency, amount, route in channels}
+        return WorkerStatus(polls, last_poll, stacked, bool(busy), unit, poll_status, storage)
+
+    @property
+    def storage(self):
+        return self.status().storage
+
+    @property
+    def stacked(self):
+        return self.status().stacked
+
+    @property
+    def busy(self):
+        return self.status().busy
+
+    def _sync_planner(self):
+        for channel in self.storage.values():
+            self.planner.set_level(channel.note.value, channel.note.currency, channel.amount)
+
+    def can_pay(self, amount, currency=DEFAULT_CURRENCY):
+        """Whether the stored notes make exactly amount, from the snapshot without asking the worker"""
+        self._sync_planner()
+        return self.planner.can_pay(amount, currency)
+
+    def plan_payout(self, amount, currency=DEFAULT_CURRENCY):
+        """{Note: count} paying exactly amount from the stored notes, largest first, or None"""
+        self._sync_planner()
+        plan = self.planner.plan(amount, currency)
+        if plan is None:
+            return None
+        return {Note(value, currency): count for value, count in plan.items()}
+
+    def get_last_event(self):
+        """Get the last event and delete it from the event list"""
+        return self.events.get_nowait()
+
+    def get_event(self, timeout=None):
+        """Wait up to timeout seconds for the next event, None if there was none"""
+        return self.events.get(timeout)
+
+    def subscribe(self, callback, event=None):
+        """Call callback((note, event)) from the reader thread for each event of a type, or for all"""
+        self.events.subscribe(callback, event)
+
+    def unsubscribe(self, callback, event=None):
+        self.events.unsubscribe(callback, event)
+
+    def close(self, timeout=5.0):
+        """Close the unit in the worker and stop it"""
+        if self._closed:
+            return
+        if self._process.is_alive():
+            try:
+                self._send(("close",))
+            except SSPError:
+                pass
+        self._closed = True
+        self._process.join(timeout)
+        self._shutdown()
+
+    def _shutdown(self):
+        self._closed = True
+        if self._process.is_alive():
+            self._process.terminate()
+            self._process.join()
+        self._reader.join(1.0)
+        self._fail_all(SSPError("Closed"))
+        self._layout.release()
+        self._memory.close()
+        self._memory.unlink()
+
+    __str__ = eSSP.__str__
@@ -1,7 +1,6 @@
 import threading
 from eSSP.constants import Status
-from eSSP import eSSP
-from time import sleep
+from eSSP import eSSP, SSPError
 
 #  Create a new object ( Validator Object ) and initialize it ( In debug mode, so it will print debug infos )
 validator = eSSP(com_port="/dev/ttyACM0", ssp_address="0", route_to_storage=2000, debug=True)
@@ -9,7 +8,7 @@ validator = eSSP(com_port="/dev/ttyACM0", ssp_address="0", route_to_storage=2000
 def event_loop():
     while True:
         # ---- Example of interaction with events ---- #
-        last = validator.get_last_event()
+        last = validator.get_event(timeout=1)  # Blocks until the unit reports something
         if last is not None:
             (note, event) = last
             if note == None or event == 0:
@@ -18,7 +17,6 @@ def event_loop():
                 print(last)
                 if event == Status.SSP_POLL_CREDIT:
                     validator.print_debug("credit")
-        sleep(0.2)
 
 t1 = threading.Thread(target=event_loop)  # Create a new thread on the Validator System Loop ( needed for the signal )
 t1.daemon = True  # Set the thread as daemon because it don't catch the KeyboardInterrupt, so it will stop when we cut the main thread
@@ -29,7 +27,7 @@ try:  # Command Interpreter
         choice = input("")
         if choice == "p":  # Payout "choice" value bill ( 10, 20, 50, 100, etc. )
             choice = input("")
-            validator.payout(int(choice))
+            validator.payout(int(choice)).add_done_callback(lambda f: f.exception() and print(f.exception()))
         elif choice == "s":  # Route to storage ( In NV11, it is any amount <= than "choice" )
             choice = input("")
             validator.set_route_storage(int(choice))
@@ -49,9 +47,11 @@ try:  # Command Interpreter
             validator.empty_storage()
         elif choice == "g":  # Get the number of bills denominated with their values
             choice = input("")
-            validator.get_note_amount(int(choice))
-            sleep(1)
-            print("Number of bills of %s : %s"%(choice, validator.response_data['getnoteamount_response']))
+            try:
+                amount = validator.get_note_amount(int(choice)).result(timeout=5)
+                print("Number of bills of %s : %s"%(choice, amount))
+            except SSPError as e:
+                print(e)
         elif choice == "v":  # View validator state
             print(validator)
 